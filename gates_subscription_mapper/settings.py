@@ -146,6 +146,11 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'gates_subscription_mapper/static'),
 ]
 
+# Uploaded files of identities. The migration workers read the files from
+# here, so it needs to be shared with them.
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', 'media')
+MEDIA_URL = '/media/'
+
 # Sentry configuration
 RAVEN_CONFIG = {
     'dsn': os.environ.get('SENTRY_DSN', None)
@@ -156,6 +161,15 @@ STAGE_BASED_MESSAGING_URL = os.environ.get(
     'STAGE_BASED_MESSAGING_URL', 'http://localhost:8001/api/v1')
 STAGE_BASED_MESSAGING_TOKEN = os.environ.get(
     'STAGE_BASED_MESSAGING_TOKEN', 'replace-me')
+# The limits for the number of concurrent requests to Stage Based Messaging,
+# which adapts between them, and the response time in milliseconds above
+# which it is reduced
+STAGE_BASED_MESSAGING_MIN_CONCURRENCY = int(os.environ.get(
+    'STAGE_BASED_MESSAGING_MIN_CONCURRENCY', '1'))
+STAGE_BASED_MESSAGING_MAX_CONCURRENCY = int(os.environ.get(
+    'STAGE_BASED_MESSAGING_MAX_CONCURRENCY', '20'))
+STAGE_BASED_MESSAGING_LATENCY_THRESHOLD = int(os.environ.get(
+    'STAGE_BASED_MESSAGING_LATENCY_THRESHOLD', '2000'))
 
 # Celery config
 CELERY_BROKER_URL = os.environ.get(
@@ -165,6 +179,59 @@ CELERY_WORKER_CONCURRENCY = int(os.environ.get(
 CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.environ.get(
     'CELERY_WORKER_PREFETCH_MULTIPLIER', '1'))
 
+# HTTP client config
+# The connection pools for Stage Based Messaging and Rapidpro keep connections
+# alive between requests. The number of hosts to keep pools for, the maximum
+# number of connections to each host, the connect and read timeouts in
+# seconds, and how many times to retry connection errors.
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '10'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))
+
+# Migration config
+# The number of identities that each migration task migrates concurrently
+MIGRATION_CONCURRENCY = int(os.environ.get('MIGRATION_CONCURRENCY', '1'))
+# How identities are migrated: 'threads', or 'asyncio', which needs Python 3,
+# and makes its requests over HTTP_POOL_SIZE connections
+MIGRATION_ENGINE = os.environ.get('MIGRATION_ENGINE', 'threads')
+# The number of identities that the asyncio engine migrates concurrently
+MIGRATION_ASYNC_CONCURRENCY = int(os.environ.get(
+    'MIGRATION_ASYNC_CONCURRENCY', '500'))
+# How many identities are read ahead of the identities being migrated
+MIGRATION_READ_AHEAD = int(os.environ.get('MIGRATION_READ_AHEAD', '1000'))
+# How many identities ahead of the identities being migrated to look up the
+# subscriptions of, in the background
+MIGRATION_LOOKAHEAD = int(os.environ.get('MIGRATION_LOOKAHEAD', '0'))
+# The number of threads that look up the subscriptions of upcoming identities
+MIGRATION_LOOKAHEAD_CONCURRENCY = int(os.environ.get(
+    'MIGRATION_LOOKAHEAD_CONCURRENCY', '4'))
+# How often migration tasks save their progress and check for cancellation,
+# in number of identities, or in milliseconds, whichever comes first
+MIGRATION_CHECKPOINT_SIZE = int(os.environ.get(
+    'MIGRATION_CHECKPOINT_SIZE', '100'))
+MIGRATION_CHECKPOINT_INTERVAL = int(os.environ.get(
+    'MIGRATION_CHECKPOINT_INTERVAL', '1000'))
+# How often, in seconds, repeated log messages about individual identities
+# are combined and saved
+MIGRATION_LOG_SUMMARY_INTERVAL = int(os.environ.get(
+    'MIGRATION_LOG_SUMMARY_INTERVAL', '60'))
+# How many times migrating an identity is retried when Stage Based Messaging
+# is overloaded, before the identity is recorded as failed, and the base delay
+# in milliseconds of the exponential backoff between retries
+MIGRATION_IDENTITY_RETRIES = int(os.environ.get(
+    'MIGRATION_IDENTITY_RETRIES', '3'))
+MIGRATION_IDENTITY_RETRY_DELAY = int(os.environ.get(
+    'MIGRATION_IDENTITY_RETRY_DELAY', '500'))
+# Whether every sequence number of the messageset is mapped forward and back
+# before a run migrates any identities, using the lengths of the messagesets,
+# and how far from where it started a sequence number can map back to
+MIGRATION_VERIFY_MAPPINGS = os.environ.get(
+    'MIGRATION_VERIFY_MAPPINGS', 'true').lower() == 'true'
+MIGRATION_MAPPING_MAX_DRIFT = int(os.environ.get(
+    'MIGRATION_MAPPING_MAX_DRIFT', '1'))
+
 # Rapidpro config
 RAPIDPRO_UUID_FIELD = os.environ.get(
     'RAPIDPRO_UUID_FIELD', 'seed_identity_uuid')
@@ -9,3 +9,7 @@ TEMPLATE_DEBUG = True
 PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
 
 CELERY_TASK_ALWAYS_EAGER = True
+
+MIGRATION_IDENTITY_RETRY_DELAY = 0
+
+MIGRATION_VERIFY_MAPPINGS = False
@@ -6,17 +6,31 @@ from django.db import models
 from django.contrib import admin
 
 from .models import (
-    LogEvent, MigrateSubscription, MigratedIdentity, RevertedIdentity)
+    FailedIdentity, IdentityShard, LogEvent, MappingRule, MappingVersion,
+    MigrateSubscription, MigratedIdentity, RevertedIdentity)
 
 
 @admin.register(MigrateSubscription)
 class MigrateSubscriptionAdmin(admin.ModelAdmin):
     readonly_fields = (
-        'created_at', 'completed_at', 'current', 'total', 'status', 'task_id')
+        'created_at', 'completed_at', 'current', 'total', 'total_is_estimate',
+        'excluded', 'status', 'task_id', 'mapping_version', 'plan_file',
+        'plan_summary', 'subscriptions_file')
     date_hierarchy = 'created_at'
     list_display = (
-        'task_id', 'status', 'table_name', 'column_name', 'current', 'total',
-        'created_at')
+        'task_id', 'status', 'table_name', 'column_name', 'num_shards',
+        'dry_run', 'current', 'total', 'created_at')
+    formfield_overrides = {
+        models.TextField: {'widget': forms.TextInput},
+    }
+
+
+@admin.register(IdentityShard)
+class IdentityShardAdmin(admin.ModelAdmin):
+    readonly_fields = ('current', 'last_identity', 'completed_at')
+    list_display = (
+        'migrate_subscription', 'index', 'lower_bound', 'upper_bound',
+        'current', 'completed_at')
     formfield_overrides = {
         models.TextField: {'widget': forms.TextInput},
     }
@@ -39,8 +53,55 @@ class MigratedIdentityAdmin(admin.ModelAdmin):
     list_display = ('migrate_subscription', 'identity_uuid', 'created_at')
 
 
+@admin.register(FailedIdentity)
+class FailedIdentityAdmin(admin.ModelAdmin):
+    readonly_fields = ('created_at',)
+    date_hierarchy = 'created_at'
+    list_display = (
+        'migrate_subscription', 'identity_uuid', 'attempts', 'created_at')
+
+
 @admin.register(RevertedIdentity)
 class RevertedIdentityAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at',)
     date_hierarchy = 'created_at'
     list_display = ('migrate_subscription', 'identity_uuid', 'created_at')
+
+
+@admin.register(MappingRule)
+class MappingRuleAdmin(admin.ModelAdmin):
+    """
+    Every change to the rules creates a new mapping version, which new
+    migration runs use.
+    """
+    list_display = (
+        'direction', 'from_messageset', 'start', 'to_messageset', 'scale',
+        'divisor', 'offset')
+    list_filter = ('direction', 'from_messageset')
+    formfield_overrides = {
+        models.TextField: {'widget': forms.TextInput},
+    }
+
+    def get_actions(self, request):
+        # Deleting in bulk doesn't go through delete_model, so it wouldn't
+        # create a new version
+        actions = super(MappingRuleAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def save_model(self, request, obj, form, change):
+        super(MappingRuleAdmin, self).save_model(request, obj, form, change)
+        MappingVersion.create_from_rules()
+
+    def delete_model(self, request, obj):
+        super(MappingRuleAdmin, self).delete_model(request, obj)
+        MappingVersion.create_from_rules()
+
+
+@admin.register(MappingVersion)
+class MappingVersionAdmin(admin.ModelAdmin):
+    readonly_fields = ('rules', 'created_at')
+    list_display = ('id', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
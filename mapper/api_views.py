@@ -8,13 +8,12 @@ from rest_framework.response import Response
 from rest_framework.status import HTTP_400_BAD_REQUEST
 from rest_framework.viewsets import ViewSet
 from rest_framework import serializers
-from seed_services_client.stage_based_messaging import (
-    StageBasedMessagingApiClient)
-from temba_client.v2 import TembaClient
 from uuid import UUID
 
+from mapper import clients
 from mapper.models import MigratedIdentity, RevertedIdentity
-from mapper.sequence_mapper import map_backward, NoMappingFound
+from mapper.mappings import get_mapper
+from mapper.sequence_mapper import NoMappingFound
 
 
 class RapidproOptoutSerializer(serializers.Serializer):
@@ -32,11 +31,8 @@ class RapidproOptout(ViewSet):
     user.
     """
     authentication_classes = (TokenAuthentication,)
-    rapidpro_client = TembaClient(
-        settings.RAPIDPRO_URL, settings.RAPIDPRO_TOKEN)
-    sbm_client = StageBasedMessagingApiClient(
-        settings.STAGE_BASED_MESSAGING_TOKEN,
-        settings.STAGE_BASED_MESSAGING_URL)
+    rapidpro_client = clients.rapidpro_client
+    sbm_client = clients.sbm_client
 
     def __init__(self, *args, **kwargs):
         self.messagesets = {}
@@ -114,12 +110,14 @@ class RapidproOptout(ViewSet):
                 'revert'.format(seed_uuid)
             )
 
+        # Reverse the migration with the mapping rules that it was made with
+        mapper = get_mapper(migration.mapping_version_id)
         new_subs = []
         for old_sub in existing_subs:
             self.sbm_client.update_subscription(
                 old_sub['id'], {'active': False})
             try:
-                messageset, sequence = map_backward(
+                messageset, sequence = mapper.map_backward(
                     self.get_messageset(old_sub['messageset'])['short_name'],
                     old_sub['next_sequence_number']
                 )
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+The asyncio engine for migrating identities, which is used instead of the
+pool of threads when MIGRATION_ENGINE is 'asyncio'. It needs Python 3.5 or
+later, so it is only imported when it is used.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from concurrent import futures
+from demands import HTTPServiceError
+from django.conf import settings
+from requests import RequestException, Response
+from requests import exceptions as requests_exceptions
+from threading import Thread
+from urllib.parse import urlencode, urlsplit
+import asyncio
+import json
+import time
+
+from mapper.clients import get_retry
+from mapper.concurrency import is_overloaded, sbm_limiter
+from mapper.tasks import IdentityProgress
+
+
+class AsyncSBMClient(object):
+    """
+    A Stage Based Messaging client for the asyncio engine, with the methods of
+    the Stage Based Messaging client that migrating an identity uses. Requests
+    are made within the concurrency limit of `limiter`, over a pool of up to
+    `pool_size` keep-alive connections, and wait for a free connection, so
+    that any number of requests can be waiting. Connection errors are retried
+    with the same policy as the pooled sessions of the other clients, and
+    errors are raised as the same exceptions as the requests that the Stage
+    Based Messaging client makes, so that they are handled the same. Must be
+    created in the event loop that it is used in.
+    """
+    CONTENT_TYPE = 'application/json;charset=utf-8'
+    # The methods that are safe to retry after they have been sent, which are
+    # the same as for the pooled sessions
+    IDEMPOTENT_METHODS = frozenset([
+        'DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE'])
+    # How often, in seconds, to check for capacity in the limiter, which can't
+    # notify the event loop when a request elsewhere finishes
+    LIMITER_POLL_INTERVAL = 0.005
+
+    def __init__(self, url, token, pool_size, limiter):
+        parts = urlsplit(url)
+        self.url = url.rstrip('/')
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path.rstrip('/')
+        self.headers = [
+            ('Host', parts.netloc),
+            ('Authorization', 'Token ' + token),
+            ('Content-Type', self.CONTENT_TYPE),
+            ('Accept', 'application/json'),
+        ]
+        self.limiter = limiter
+        self.retry = get_retry()
+        self.slots = asyncio.Semaphore(pool_size)
+        # The (reader, writer) of each open connection that isn't in use
+        self.idle = []
+        self.connections = 0
+        self.requests = 0
+
+    async def get_subscriptions(self, params=None):
+        return await self.request('GET', '/subscriptions/', params=params)
+
+    async def update_subscription(self, subscription, data=None):
+        return await self.request(
+            'PATCH', '/subscriptions/{}/'.format(subscription), data=data)
+
+    async def create_subscription(self, subscription):
+        return await self.request(
+            'POST', '/subscriptions/', data=subscription)
+
+    async def get_messagesets(self, params=None):
+        return await self.request('GET', '/messageset/', params=params)
+
+    async def acquire(self):
+        """
+        Waits for capacity for another request in the limiter, without
+        blocking the event loop.
+        """
+        while not self.limiter.try_acquire():
+            await asyncio.sleep(self.LIMITER_POLL_INTERVAL)
+
+    async def request(self, method, path, params=None, data=None):
+        """
+        Makes the request within the concurrency limit, returning the decoded
+        JSON of the response, or None if it is empty. Raises HTTPServiceError
+        for responses that aren't successful.
+        """
+        await self.acquire()
+        start = time.time()
+        overloaded = False
+        try:
+            return await self.send(method, path, params, data)
+        except Exception as e:
+            overloaded = is_overloaded(e)
+            raise
+        finally:
+            self.limiter.release(time.time() - start, overloaded)
+
+    async def send(self, method, path, params, data):
+        target = self.path + path
+        if params:
+            target += '?' + urlencode(params, doseq=True)
+        body = b'' if data is None else json.dumps(
+            data, default=str).encode('utf-8')
+
+        async with self.slots:
+            errors = 0
+            while True:
+                sent = False
+                try:
+                    connection = await self.connect()
+                    sent = True
+                    status, content = await self.send_on(
+                        connection, method, target, body)
+                    break
+                except (requests_exceptions.ConnectionError,
+                        requests_exceptions.Timeout):
+                    # Requests that failed after they were sent can have been
+                    # handled, so they are only retried if they are safe to
+                    # repeat
+                    errors += 1
+                    if errors > self.retry.total or (
+                            sent and method not in self.IDEMPOTENT_METHODS):
+                        raise
+                    await asyncio.sleep(self.get_backoff(errors))
+            self.requests += 1
+
+        if status >= 300:
+            response = Response()
+            response.status_code = status
+            response.url = self.url + path
+            response._content = content
+            raise HTTPServiceError(response)
+        if not content:
+            return None
+        return json.loads(content.decode('utf-8'))
+
+    def get_backoff(self, errors):
+        """
+        Returns how long to wait, in seconds, before retrying after `errors`
+        consecutive errors, the same as the retries of the pooled sessions.
+        """
+        if errors <= 1:
+            return 0
+        return self.retry.backoff_factor * (2 ** (errors - 1))
+
+    async def send_on(self, connection, method, target, body):
+        """
+        Sends the request on the connection, returning the status code and
+        body of the response, and putting the connection back in the pool if
+        it can be reused.
+        """
+        try:
+            status, content, keep_alive = await asyncio.wait_for(
+                self.exchange(connection, method, target, body),
+                settings.HTTP_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.close_connection(connection)
+            raise requests_exceptions.ReadTimeout(
+                "{method} {target} timed out".format(
+                    method=method, target=target))
+        except (OSError, EOFError, ValueError,
+                asyncio.LimitOverrunError) as e:
+            self.close_connection(connection)
+            raise requests_exceptions.ConnectionError(e)
+        if keep_alive:
+            self.idle.append(connection)
+        else:
+            self.close_connection(connection)
+        return status, content
+
+    async def connect(self):
+        """
+        Returns an idle connection, or a new one if there aren't any. Idle
+        connections that the server has closed are skipped.
+        """
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection[0].at_eof():
+                return connection
+            self.close_connection(connection)
+        try:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host, self.port, ssl=True if self.https else None),
+                settings.HTTP_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise requests_exceptions.ConnectTimeout(
+                "Connecting to {host} timed out".format(host=self.host))
+        except OSError as e:
+            raise requests_exceptions.ConnectionError(e)
+        self.connections += 1
+        return connection
+
+    async def exchange(self, connection, method, target, body):
+        """
+        Sends an HTTP/1.1 request on the connection, and reads its response.
+        Returns the status code, the body, and whether the connection can be
+        reused.
+        """
+        reader, writer = connection
+        lines = ['{method} {target} HTTP/1.1'.format(
+            method=method, target=target)]
+        lines.extend(
+            '{name}: {value}'.format(name=name, value=value)
+            for name, value in self.headers)
+        lines.append('Content-Length: {}'.format(len(body)))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError("Connection closed without a response")
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise EOFError("Connection closed in the response headers")
+            if line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (
+            version == 'HTTP/1.1' and
+            headers.get('connection', '').lower() != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self.read_chunked(reader)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(
+                int(headers['content-length']))
+        elif status in (204, 304):
+            content = b''
+        else:
+            # The body is ended by closing the connection
+            content = await reader.read()
+            keep_alive = False
+        return status, content, keep_alive
+
+    async def read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip any trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def close_connection(self, connection):
+        connection[1].close()
+
+    async def close(self):
+        while self.idle:
+            self.close_connection(self.idle.pop())
+
+
+class AsyncResult(object):
+    """
+    The result of an identity migrated by the asyncio engine, with the
+    interface of the results of a ThreadPool.
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def get(self):
+        return self.future.result()
+
+
+class AsyncEngine(object):
+    """
+    Migrates identities with coroutines on an event loop in a background
+    thread, instead of in a pool of threads, so that a task can have many
+    more Stage Based Messaging requests in flight, over a small pool of
+    connections. It has the interface of the ThreadPool that
+    process_identities uses, so reading the identities, saving the progress
+    and checking for cancellation are the same for both engines, and
+    migrating an identity has the same side effects as the thread engine's
+    `migrate_identity_with_retries`. Up to `concurrency` identities are
+    migrated at the same time.
+    """
+    def __init__(self, task, concurrency):
+        self.task = task
+        self.futures = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client, self.slots = self.run(self.setup(concurrency))
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def setup(self, concurrency):
+        # Created in the event loop, so that they belong to it
+        client = AsyncSBMClient(
+            settings.STAGE_BASED_MESSAGING_URL,
+            settings.STAGE_BASED_MESSAGING_TOKEN, settings.HTTP_POOL_SIZE,
+            sbm_limiter)
+        return client, asyncio.Semaphore(concurrency)
+
+    def run(self, coroutine):
+        """
+        Runs the coroutine in the event loop, and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def apply_async(self, func, args):
+        """
+        Starts running the coroutine function `func` with `args` in the event
+        loop, returning an AsyncResult.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.limit(func, args), self.loop)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return AsyncResult(future)
+
+    async def limit(self, func, args):
+        async with self.slots:
+            return await func(*args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        """
+        Waits for the identities that are being migrated, and then stops the
+        event loop and closes its connections.
+        """
+        futures.wait(list(self.futures))
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def get_existing_subscriptions(self, migrate, identity, state):
+        if state.prefetched_subscriptions is not None:
+            return state.prefetched_subscriptions.get(str(identity), [])
+        response = await self.client.get_subscriptions({
+            'identity': identity,
+            'messageset': migrate.from_messageset,
+            'active': True,
+        })
+        return list(response['results'])
+
+    async def migrate_identity(self, migrate, identity, state, progress):
+        """
+        The coroutine version of the task's `migrate_identity`.
+        """
+        existing_subs = self.task.check_existing_subscriptions(
+            migrate, identity,
+            await self.get_existing_subscriptions(migrate, identity, state),
+            progress, state)
+        if existing_subs is None:
+            return
+
+        await self.recreate_subscriptions(migrate, identity, state, progress)
+        for sub in existing_subs:
+            await self.client.update_subscription(
+                sub['id'], data={'active': False})
+            progress.cancelled.append(sub)
+            await self.recreate_subscriptions(
+                migrate, identity, state, progress)
+        self.task.add_migrated_identity(migrate, identity, state)
+
+    async def get_messageset_by_short_name(self, short_name):
+        """
+        The coroutine version of the task's `get_messageset_by_short_name`,
+        which fetches messagesets that aren't cached through the client, so
+        that it doesn't block the event loop.
+        """
+        messageset = getattr(
+            self.task, 'messagesets_by_short_name', {}).get(short_name)
+        if messageset is not None:
+            return messageset
+        response = await self.client.get_messagesets(
+            {'short_name': short_name})
+        return self.task.add_messageset(
+            short_name, response['results'][0])
+
+    async def recreate_subscriptions(self, migrate, identity, state, progress):
+        while progress.cancelled:
+            sub = progress.cancelled[0]
+            (messageset, sequence) = self.task.map_subscription(
+                migrate, state.mapper, sub)
+            await self.client.create_subscription(
+                self.task.get_new_subscription(
+                    identity,
+                    await self.get_messageset_by_short_name(messageset),
+                    sequence, sub))
+            progress.cancelled.pop(0)
+            progress.migrated.add(sub['id'])
+
+    async def migrate_identity_with_retries(self, migrate, identity, state):
+        """
+        The coroutine version of the task's `migrate_identity_with_retries`.
+        """
+        progress = IdentityProgress()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                await self.migrate_identity(
+                    migrate, identity, state, progress)
+                return True
+            except (HTTPServiceError, RequestException) as e:
+                if not self.task.should_retry(e, attempts):
+                    self.task.record_failure(
+                        migrate, identity, e, attempts, state,
+                        progress.cancelled)
+                    return False
+                await asyncio.sleep(self.task.get_retry_delay(attempts))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from demands import JSONServiceClient
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from seed_services_client.stage_based_messaging import (
+    StageBasedMessagingApiClient)
+from temba_client import clients as temba_clients, utils as temba_utils
+from temba_client.clients import BaseClient
+from temba_client.v2 import TembaClient
+from threading import local
+import json
+
+from mapper.concurrency import LimitedClient, sbm_limiter
+
+
+def get_retry():
+    """
+    Returns the retry policy for connection errors. Requests that fail after
+    they are sent are only retried for idempotent methods, so that we don't
+    for example create a subscription twice.
+    """
+    return Retry(
+        total=settings.HTTP_RETRIES, connect=settings.HTTP_RETRIES,
+        read=settings.HTTP_RETRIES, redirect=0, status=0,
+        backoff_factor=0.1, raise_on_status=False)
+
+
+def get_timeout():
+    return (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+
+
+def mount_pool(session):
+    """
+    Replaces the connection pools of the session with pools of the configured
+    size, that keep connections alive between requests, so that we don't pay
+    for connection setup and TLS handshakes on every request.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_HOSTS,
+        pool_maxsize=settings.HTTP_POOL_SIZE, pool_block=True,
+        max_retries=get_retry())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def pool_stats(session):
+    """
+    Returns a list with the utilisation of each of the session's connection
+    pools, for monitoring.
+    """
+    stats = []
+    adapters = {id(a): a for a in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            # The pool's queue holds the idle connections, and placeholders
+            # for the connections that haven't been opened yet
+            idle = pool.pool.qsize() if pool.pool is not None else 0
+            stats.append({
+                'host': pool.host,
+                'size': settings.HTTP_POOL_SIZE,
+                'in_use': settings.HTTP_POOL_SIZE - idle,
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+            })
+    return stats
+
+
+def describe_pools(session):
+    return ', '.join(
+        "{host} {in_use}/{size} in use, {connections} connections opened, "
+        "{requests} requests".format(**stats)
+        for stats in pool_stats(session)) or "no connections"
+
+
+# The session that the RapidPro client making a request in this thread uses
+_pooled = local()
+
+
+def pooled_request(method, url, **kwargs):
+    """
+    Replaces the hook that RapidPro clients make all of their requests
+    through, so that the requests of a PooledRequestsMixin client go through
+    its session, with the configured timeouts.
+    """
+    session = getattr(_pooled, 'session', None)
+    if session is None:
+        return temba_utils.request(method, url, **kwargs)
+    if 'data' in kwargs:
+        kwargs['data'] = json.dumps(kwargs['data'])
+    return session.request(method, url, timeout=get_timeout(), **kwargs)
+
+
+temba_clients.request = pooled_request
+
+
+class PooledRequestsMixin(BaseClient):
+    """
+    Makes the requests of a RapidPro client through a session with a
+    connection pool, instead of a new connection for every request. This sits
+    between the cursor client and the base client, so that requests that are
+    retried when rate limited also use the session.
+    """
+    session = None
+
+    def _request(self, *args, **kwargs):
+        previous = getattr(_pooled, 'session', None)
+        _pooled.session = self.session
+        try:
+            return super(PooledRequestsMixin, self)._request(*args, **kwargs)
+        finally:
+            _pooled.session = previous
+
+
+class PooledTembaClient(TembaClient, PooledRequestsMixin):
+    def __init__(self, *args, **kwargs):
+        super(PooledTembaClient, self).__init__(*args, **kwargs)
+        self.session = mount_pool(Session())
+
+
+def get_sbm_client():
+    """
+    Returns a Stage Based Messaging client with a connection pool, that makes
+    its requests within the adaptive concurrency limit.
+    """
+    session = mount_pool(JSONServiceClient(
+        url=settings.STAGE_BASED_MESSAGING_URL,
+        headers={
+            'Authorization': 'Token ' + settings.STAGE_BASED_MESSAGING_TOKEN},
+        timeout=get_timeout(),
+        # demands sets the retries of the adapters on every request
+        max_retries=get_retry()))
+    return LimitedClient(StageBasedMessagingApiClient(
+        settings.STAGE_BASED_MESSAGING_TOKEN,
+        settings.STAGE_BASED_MESSAGING_URL, session=session), sbm_limiter)
+
+
+def get_rapidpro_client():
+    return PooledTembaClient(settings.RAPIDPRO_URL, settings.RAPIDPRO_TOKEN)
+
+
+# Shared by everything in the process, so that they share connections
+sbm_client = get_sbm_client()
+rapidpro_client = get_rapidpro_client()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+from django.conf import settings
+from functools import WRAPPER_ASSIGNMENTS, update_wrapper
+from requests import exceptions as requests_exceptions
+from threading import Condition
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def is_overloaded(error):
+    """
+    Returns whether the error raised by a request is a sign that the service
+    is overloaded, ie. it was rate limited, had a server error, or could not
+    be reached in time.
+    """
+    if isinstance(error, (
+            requests_exceptions.ConnectionError,
+            requests_exceptions.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code is not None and (
+        status_code == 429 or status_code >= 500)
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of concurrent requests to a service, adapting the limit
+    to how the service is coping. While responses are fast and successful, the
+    limit grows additively, by one request for every window of `limit`
+    responses. Slow responses and overload errors shrink the limit
+    multiplicatively, at most once per window. Requests can be made from
+    multiple threads.
+    """
+    def __init__(self, name, min_limit, max_limit, latency_threshold,
+                 backoff_factor=0.5):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # Maximum healthy response time, in seconds
+        self.latency_threshold = latency_threshold
+        self.backoff_factor = backoff_factor
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.backoffs = 0
+        self.responses_since_backoff = 0
+        self.condition = Condition()
+
+    @property
+    def current_limit(self):
+        return max(self.min_limit, int(self.limit))
+
+    def acquire(self):
+        """
+        Blocks until there is capacity for another request.
+        """
+        with self.condition:
+            while self.in_flight >= self.current_limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """
+        Takes capacity for another request if there is any, without blocking.
+        Returns whether it did.
+        """
+        with self.condition:
+            if self.in_flight >= self.current_limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, overloaded=False):
+        """
+        Records the response to a request, and adjusts the limit.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            self.responses_since_backoff += 1
+            if overloaded:
+                self.errors += 1
+            if overloaded or latency > self.latency_threshold:
+                if self.responses_since_backoff >= self.current_limit:
+                    self.backoff()
+            else:
+                self.limit = min(
+                    self.max_limit, self.limit + 1.0 / self.current_limit)
+            self.condition.notify_all()
+
+    def backoff(self):
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        self.backoffs += 1
+        self.responses_since_backoff = 0
+        logger.info(
+            "Reduced the concurrency limit for %s to %s", self.name,
+            self.current_limit)
+
+    @contextmanager
+    def request(self):
+        """
+        Makes the request in the body of the with statement within the limit,
+        timing it, and checking any error it raises for signs of overload.
+        """
+        self.acquire()
+        start = time.time()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_overloaded(e)
+            raise
+        finally:
+            self.release(time.time() - start, overloaded)
+
+    def stats(self):
+        """
+        Returns the current limits and counters, for monitoring.
+        """
+        with self.condition:
+            return {
+                'name': self.name,
+                'limit': self.current_limit,
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'errors': self.errors,
+                'backoffs': self.backoffs,
+            }
+
+
+class LimitedClient(object):
+    """
+    Wraps an API client, so that all of its method calls are made through the
+    limiter.
+    """
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.limiter.request():
+                return attr(*args, **kwargs)
+        # Python 2 fails to wrap callables without all of the attributes, like
+        # partials and mocks, so we only copy the ones that the callable has
+        return update_wrapper(call, attr, assigned=[
+            a for a in WRAPPER_ASSIGNMENTS if hasattr(attr, a)])
+
+
+# Shared by everything in the process that calls Stage Based Messaging
+sbm_limiter = AdaptiveLimiter(
+    'Stage Based Messaging',
+    settings.STAGE_BASED_MESSAGING_MIN_CONCURRENCY,
+    settings.STAGE_BASED_MESSAGING_MAX_CONCURRENCY,
+    settings.STAGE_BASED_MESSAGING_LATENCY_THRESHOLD / 1000.0)
@@ -8,8 +8,12 @@ from .models import MigrateSubscription
 
 class MigrateSubscriptionForm(forms.ModelForm):
     from_messageset = forms.ChoiceField()
-    table_name = forms.ChoiceField()
-    column_name = forms.ChoiceField()
+    table_name = forms.ChoiceField(required=False)
+    column_name = forms.ChoiceField(required=False)
+    filter_column = forms.ChoiceField(
+        label="Filter by column", required=False)
+    num_shards = forms.IntegerField(
+        label="Shards", min_value=1, initial=1, required=False)
 
     def __init__(self, messagesets, db_info, *args, **kwargs):
         super(MigrateSubscriptionForm, self).__init__(*args, **kwargs)
@@ -20,13 +24,26 @@ class MigrateSubscriptionForm(forms.ModelForm):
             (n, n) for n in db_info.keys())
         self.fields['column_name'].choices = sorted(set(
             (n, n) for columns in db_info.values() for n in columns))
+        self.fields['filter_column'].choices = [('', "No filter")] + \
+            self.fields['column_name'].choices
+
+    def clean_table_name(self):
+        """
+        The table isn't used when the identities are read from a file.
+        """
+        if self.cleaned_data.get('identity_file'):
+            return ''
+        return self.cleaned_data['table_name']
 
     def clean_column_name(self):
         """
         Ensure that the column name is a column in the specified table.
         """
-        if self.cleaned_data['column_name'] not in self.db_info[
-                self.cleaned_data['table_name']]:
+        if self.cleaned_data.get('identity_file'):
+            return ''
+        table_name = self.cleaned_data.get('table_name')
+        if table_name and self.cleaned_data['column_name'] not in \
+                self.db_info[table_name]:
             raise forms.ValidationError(
                 "Column %(column)s is not a column in %(table)s", params={
                     'column': self.cleaned_data['column_name'],
@@ -34,7 +51,69 @@ class MigrateSubscriptionForm(forms.ModelForm):
                 }, code='invalid')
         return self.cleaned_data['column_name']
 
+    def clean_filter_column(self):
+        """
+        Ensure that the filter column is a column in the specified table.
+        """
+        filter_column = self.cleaned_data['filter_column']
+        table_name = self.cleaned_data.get('table_name')
+        if filter_column and table_name and \
+                filter_column not in self.db_info[table_name]:
+            raise forms.ValidationError(
+                "Column %(column)s is not a column in %(table)s", params={
+                    'column': filter_column,
+                    'table': table_name,
+                }, code='invalid')
+        return filter_column
+
+    def clean_num_shards(self):
+        """
+        Default to processing the identities in a single shard.
+        """
+        return self.cleaned_data['num_shards'] or 1
+
+    def clean(self):
+        """
+        Ensure that the identities are read from either a file, or a table
+        and column, and that runs that read from a file aren't sharded,
+        snapshotted or filtered, which all need the identities to be in a
+        table. Filters need an operator.
+        """
+        cleaned_data = super(MigrateSubscriptionForm, self).clean()
+        if cleaned_data.get('filter_column'):
+            if not cleaned_data.get('filter_operator'):
+                self.add_error('filter_operator', forms.ValidationError(
+                    "Choose an operator for the filter", code='required'))
+        else:
+            cleaned_data['filter_operator'] = ''
+            cleaned_data['filter_value'] = ''
+        if cleaned_data.get('identity_file'):
+            if cleaned_data.get('filter_column'):
+                self.add_error('filter_column', forms.ValidationError(
+                    "Runs from a file of identities cannot be filtered",
+                    code='invalid'))
+            if cleaned_data.get('num_shards', 1) > 1:
+                self.add_error('num_shards', forms.ValidationError(
+                    "Runs from a file of identities cannot be sharded",
+                    code='invalid'))
+            if cleaned_data.get('use_snapshot'):
+                self.add_error('use_snapshot', forms.ValidationError(
+                    "Runs from a file of identities cannot use a snapshot",
+                    code='invalid'))
+        elif not cleaned_data.get('table_name') or \
+                not cleaned_data.get('column_name'):
+            raise forms.ValidationError(
+                "Choose a table and column, or a file of identities",
+                code='required')
+        return cleaned_data
+
     class Meta:
         model = MigrateSubscription
         fields = (
-            'from_messageset', 'table_name', 'column_name')
+            'from_messageset', 'identity_file', 'table_name', 'column_name',
+            'filter_column', 'filter_operator', 'filter_value', 'num_shards',
+            'prefetch_subscriptions', 'use_snapshot', 'exclude_reverted',
+            'exclude_migrated', 'dry_run')
+        widgets = {
+            'filter_value': forms.TextInput,
+        }
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+from django.utils import six
+from uuid import UUID
+import mmap
+import os
+
+
+class FileIdentity(six.text_type):
+    """
+    An identity read from an identity file, which knows the byte offset in
+    the file just after its line, so that the run can be resumed from there.
+    """
+    def __new__(cls, value, offset):
+        identity = super(FileIdentity, cls).__new__(cls, value)
+        identity.offset = offset
+        return identity
+
+
+class IdentityFile(object):
+    """
+    Iterates over the identities in a file with one identity UUID per line,
+    or a CSV file with the identity UUIDs in the first column, starting from
+    the byte offset `offset`.
+
+    The file is memory mapped and parsed a chunk of `chunk_size` bytes at a
+    time, so that only one chunk needs to be in memory. Lines that aren't
+    identity UUIDs, like a CSV header, are skipped, as are repeats of any of
+    the last `window` identities that were read, so that the memory needed
+    doesn't grow with the size of the file. Identities that are repeated
+    further apart, or from before the offset, are not skipped.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    # About 150 bytes of memory for each identity
+    WINDOW = 100000
+    BOM = b'\xef\xbb\xbf'
+
+    def __init__(self, path, offset=0, chunk_size=CHUNK_SIZE, window=WINDOW):
+        self.path = path
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.window = window
+        self.duplicates = 0
+        self.invalid = 0
+
+    def __iter__(self):
+        # The recently read identities, oldest first
+        recent = OrderedDict()
+        for line, offset in self.read_lines():
+            identity = self.parse_line(line)
+            if identity is None:
+                self.invalid += 1
+            elif identity.bytes in recent:
+                self.duplicates += 1
+            else:
+                recent[identity.bytes] = None
+                if len(recent) > self.window:
+                    recent.popitem(last=False)
+                yield FileIdentity(str(identity), offset)
+
+    def read_lines(self):
+        """
+        Yields a tuple of (line, offset) for each non blank line of the file
+        after the starting offset, where offset is the byte offset just after
+        the line.
+        """
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # Empty files can't be memory mapped
+            if self.offset >= size:
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                position = self.offset
+                while position < size:
+                    end = self.find_chunk_end(mapped, position, size)
+                    offset = position
+                    for line in mapped[position:end].split(b'\n'):
+                        offset = min(offset + len(line) + 1, end)
+                        if line.strip():
+                            yield line, offset
+                    position = end
+            finally:
+                mapped.close()
+
+    def find_chunk_end(self, mapped, position, size):
+        """
+        Returns the end of the chunk starting at `position`, which is just
+        after the last full line that fits in the chunk size, or the end of
+        the first line if it doesn't fit.
+        """
+        end = position + self.chunk_size
+        if end >= size:
+            return size
+        newline = mapped.rfind(b'\n', position, end)
+        if newline == -1:
+            newline = mapped.find(b'\n', end)
+            if newline == -1:
+                return size
+        return newline + 1
+
+    def parse_line(self, line):
+        """
+        Returns the identity UUID in the first column of the line, or None if
+        it isn't a UUID.
+        """
+        value = line.split(b',', 1)[0].strip()
+        if value.startswith(self.BOM):
+            value = value[len(self.BOM):]
+        value = value.strip(b'"\' ')
+        try:
+            return UUID(value.decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            return None
+
+    def count_lines(self):
+        """
+        Counts the lines of the file, which is a quick estimate of the
+        number of identities in it.
+        """
+        count = 0
+        last = b'\n'
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                count += chunk.count(b'\n')
+                last = chunk[-1:]
+        # The last line doesn't need to end with a newline
+        if last != b'\n':
+            count += 1
+        return count
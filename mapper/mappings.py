@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from threading import Lock
+
+from mapper.models import MappingRule, MappingVersion
+from mapper import sequence_mapper
+
+
+def compile_rules(rules):
+    """
+    Compiles the rules of a mapping version into a SequenceMapper.
+    """
+    mappings = {MappingRule.FORWARD: {}, MappingRule.BACKWARD: {}}
+    for rule in rules:
+        # Versions from before table rules don't have sequences
+        if rule.get('sequences') is not None:
+            mappings[rule['direction']][rule['from_messageset']] = (
+                sequence_mapper.Table(
+                    rule['to_messageset'], rule['start'],
+                    rule['sequences']))
+            continue
+        mappings[rule['direction']].setdefault(
+            rule['from_messageset'], []).append(sequence_mapper.Segment(
+                rule['start'], rule['to_messageset'], scale=rule['scale'],
+                divisor=rule['divisor'], offset=rule['offset']))
+    return sequence_mapper.SequenceMapper(
+        forward=mappings[MappingRule.FORWARD],
+        backward=mappings[MappingRule.BACKWARD])
+
+
+class MappingRegistry(object):
+    """
+    Keeps the compiled SequenceMapper of each version of the mapping rules
+    that the process has used. Versions never change, so each version is only
+    loaded from the database and compiled the first time that it is used, and
+    mapping sequence numbers never needs the database. A version of None is
+    the mappings in the code.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.mappers = {None: sequence_mapper.mapper}
+        # The verified and precomputed mappers, with the lengths of the
+        # messagesets that they were verified with
+        self.precomputed = {}
+
+    def get(self, version_id):
+        """
+        Returns the SequenceMapper for the version of the mapping rules.
+        """
+        mapper = self.mappers.get(version_id)
+        if mapper is not None:
+            return mapper
+        with self.lock:
+            if version_id not in self.mappers:
+                version = MappingVersion.objects.get(pk=version_id)
+                self.mappers[version_id] = compile_rules(version.get_rules())
+            return self.mappers[version_id]
+
+    def get_precomputed(self, version_id, messageset, get_length, max_drift):
+        """
+        Returns the SequenceMapper for the version of the mapping rules, with
+        the forward mapping of the messageset verified and precomputed, using
+        `get_length` to get the length of each messageset. The result is
+        reused until the length of one of the messagesets changes. Raises
+        MappingError if the mapping isn't correct.
+        """
+        key = (version_id, messageset, max_drift)
+        cached = self.precomputed.get(key)
+        if cached is not None:
+            lengths, mapper = cached
+            if all(get_length(name) == length
+                   for name, length in lengths.items()):
+                return mapper
+
+        lengths = {}
+
+        def get_recorded_length(name):
+            if name not in lengths:
+                lengths[name] = get_length(name)
+            return lengths[name]
+
+        mapper = self.get(version_id).precompute_forward(
+            messageset, get_recorded_length, max_drift)
+        self.precomputed[key] = (lengths, mapper)
+        return mapper
+
+
+# Shared by everything in the process
+registry = MappingRegistry()
+get_mapper = registry.get
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0007_remove_migratesubscription_to_messageset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='last_identity',
+            field=models.TextField(blank=True, null=True, verbose_name='Last processed identity'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 10:41
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0008_migratesubscription_last_identity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='num_shards',
+            field=models.PositiveIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Number of shards to split the identities into'),
+        ),
+        migrations.CreateModel(
+            name='IdentityShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField(verbose_name='Index of the shard in the run')),
+                ('lower_bound', models.TextField(blank=True, null=True, verbose_name='Exclusive lower bound of the identities')),
+                ('upper_bound', models.TextField(blank=True, null=True, verbose_name='Inclusive upper bound of the identities')),
+                ('current', models.IntegerField(default=0, verbose_name='Current count of processed identities')),
+                ('last_identity', models.TextField(blank=True, null=True, verbose_name='Last processed identity')),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('migrate_subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='mapper.MigrateSubscription')),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='identityshard',
+            unique_together=set([('migrate_subscription', 'index')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 11:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0009_identityshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='prefetch_subscriptions',
+            field=models.BooleanField(default=False, verbose_name='Prefetch all subscriptions to the messageset'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 13:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0010_migratesubscription_prefetch_subscriptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='total_is_estimate',
+            field=models.BooleanField(default=False, verbose_name='Whether the total is an estimate'),
+        ),
+    ]
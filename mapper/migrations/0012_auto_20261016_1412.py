@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0011_migratesubscription_total_is_estimate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='snapshot_table',
+            field=models.TextField(blank=True, null=True, verbose_name='Table in the identities database with the snapshot of identities'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='use_snapshot',
+            field=models.BooleanField(default=False, verbose_name='Migrate from a snapshot of the identities'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 15:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0012_auto_20261016_1412'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedIdentity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identity_uuid', models.UUIDField()),
+                ('error', models.TextField(verbose_name='Last error')),
+                ('attempts', models.PositiveIntegerField(default=1, verbose_name='Number of attempts')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('migrate_subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='failed_identities', to='mapper.MigrateSubscription')),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'verbose_name_plural': 'failed identities',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0013_failedidentity'),
+    ]
+
+    operations = [
+        # Resumed runs could migrate an identity more than once, so we remove
+        # the duplicates before adding the constraint
+        migrations.RunSQL(
+            'DELETE FROM mapper_migratedidentity AS a '
+            'USING mapper_migratedidentity AS b '
+            'WHERE a.migrate_subscription_id = b.migrate_subscription_id '
+            'AND a.identity_uuid = b.identity_uuid AND a.id > b.id',
+            migrations.RunSQL.noop),
+        migrations.AlterUniqueTogether(
+            name='migratedidentity',
+            unique_together=set([('migrate_subscription', 'identity_uuid')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 15:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0014_migratedidentity_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='exclude_migrated',
+            field=models.BooleanField(default=False, verbose_name='Exclude identities migrated on previous runs'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='exclude_reverted',
+            field=models.BooleanField(default=False, verbose_name='Exclude identities that opted out of a previous migration'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='excluded',
+            field=models.IntegerField(default=0, verbose_name='Count of identities excluded from processing'),
+        ),
+    ]
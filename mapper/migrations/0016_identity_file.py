@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 16:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0015_auto_20261016_1537'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='identity_file',
+            field=models.FileField(blank=True, null=True, upload_to='identity_files/', verbose_name='File of identity IDs'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='last_offset',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Byte offset in the file after the last processed identity'),
+        ),
+        migrations.AlterField(
+            model_name='migratesubscription',
+            name='column_name',
+            field=models.TextField(blank=True, verbose_name='Column in table for identity IDs'),
+        ),
+        migrations.AlterField(
+            model_name='migratesubscription',
+            name='table_name',
+            field=models.TextField(blank=True, verbose_name='Database table for identity IDs'),
+        ),
+    ]
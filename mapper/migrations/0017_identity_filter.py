@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 16:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0016_identity_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='filter_column',
+            field=models.TextField(blank=True, verbose_name='Column in table to filter the identities by'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='filter_operator',
+            field=models.CharField(blank=True, choices=[('=', 'equals'), ('<>', 'does not equal'), ('<', 'is less than'), ('<=', 'is less than or equal to'), ('>', 'is greater than'), ('>=', 'is greater than or equal to'), ('IS NULL', 'is empty'), ('IS NOT NULL', 'is not empty')], max_length=11, verbose_name='Operator to filter the identities with'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='filter_value',
+            field=models.TextField(blank=True, verbose_name='Value to filter the identities by'),
+        ),
+    ]
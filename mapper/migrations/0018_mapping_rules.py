@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0017_identity_filter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MappingRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('F', 'Forward'), ('B', 'Backward')], default='F', max_length=1, verbose_name='Direction of the mapping')),
+                ('from_messageset', models.TextField(verbose_name='Short name of the messageset to map from')),
+                ('start', models.PositiveIntegerField(verbose_name='First sequence number of the rule')),
+                ('to_messageset', models.TextField(verbose_name='Short name of the messageset to map to')),
+                ('scale', models.IntegerField(default=1, verbose_name='Scale of the sequence number')),
+                ('divisor', models.PositiveIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Divisor of the scaled sequence number')),
+                ('offset', models.IntegerField(default=0, verbose_name='Offset of the mapped sequence number')),
+            ],
+            options={
+                'ordering': ['direction', 'from_messageset', 'start'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MappingVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rules', models.TextField(verbose_name='JSON of the mapping rules')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-pk'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='mappingrule',
+            unique_together=set([('direction', 'from_messageset', 'start')]),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='mapping_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='migrations', to='mapper.MappingVersion'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0018_mapping_rules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='dry_run',
+            field=models.BooleanField(default=False, verbose_name='Plan the run without migrating any subscriptions'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='plan_file',
+            field=models.FileField(blank=True, null=True, upload_to='plans/', verbose_name='File with the plan of the dry run'),
+        ),
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='plan_summary',
+            field=models.TextField(blank=True, verbose_name='JSON summary of the plan of the dry run'),
+        ),
+    ]
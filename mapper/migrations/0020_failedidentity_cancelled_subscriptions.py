@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0019_dry_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='failedidentity',
+            name='cancelled_subscriptions',
+            field=models.TextField(blank=True, verbose_name='JSON list of the subscriptions that were cancelled, but not recreated'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 15:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0020_failedidentity_cancelled_subscriptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratesubscription',
+            name='subscriptions_file',
+            field=models.FileField(blank=True, null=True, upload_to='subscriptions/', verbose_name='File with the prefetched subscriptions for the shards'),
+        ),
+    ]
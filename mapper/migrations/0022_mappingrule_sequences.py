@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import json
+
+
+RULE_FIELDS = (
+    'direction', 'from_messageset', 'start', 'to_messageset', 'scale',
+    'divisor', 'offset')
+
+# The mappings in the code when this migration was written, as rules. They
+# are copied here, so that this migration always seeds the same rules, however
+# the mappings in the code change.
+CODE_RULES = [
+    {'direction': 'F', 'from_messageset': 'test.gates.messageset.1',
+     'start': 0, 'to_messageset': 'test.gates.messageset.2', 'scale': 0,
+     'divisor': 1, 'offset': 0, 'sequences': None},
+    {'direction': 'F', 'from_messageset': 'test.gates.messageset.1',
+     'start': 1, 'to_messageset': 'test.gates.messageset.2', 'scale': 2,
+     'divisor': 1, 'offset': -1, 'sequences': None},
+    {'direction': 'B', 'from_messageset': 'test.gates.messageset.2',
+     'start': 0, 'to_messageset': 'test.gates.messageset.1', 'scale': 1,
+     'divisor': 2, 'offset': 1, 'sequences': None},
+]
+
+
+def seed_code_mappings(apps, schema_editor):
+    """
+    Adds the mappings in the code as mapping rules, for each messageset and
+    direction that doesn't have any rules yet, so that editing the rules in
+    the admin doesn't drop them. If the rules have already been changed, a
+    new version with the merged rules is created.
+    """
+    MappingRule = apps.get_model('mapper', 'MappingRule')
+    MappingVersion = apps.get_model('mapper', 'MappingVersion')
+    db = schema_editor.connection.alias
+
+    existing = set(MappingRule.objects.using(db).values_list(
+        'direction', 'from_messageset'))
+    created = False
+    for rule in CODE_RULES:
+        if (rule['direction'], rule['from_messageset']) in existing:
+            continue
+        sequences = rule['sequences']
+        MappingRule.objects.using(db).create(
+            sequences='' if sequences is None else json.dumps(sequences),
+            **{field: rule[field] for field in RULE_FIELDS})
+        created = True
+
+    if created and MappingVersion.objects.using(db).exists():
+        rules = []
+        for rule in MappingRule.objects.using(db).order_by(
+                'direction', 'from_messageset', 'start'):
+            data = {field: getattr(rule, field) for field in RULE_FIELDS}
+            data['sequences'] = (
+                json.loads(rule.sequences) if rule.sequences else None)
+            rules.append(data)
+        MappingVersion.objects.using(db).create(rules=json.dumps(rules))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapper', '0021_migratesubscription_subscriptions_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mappingrule',
+            name='sequences',
+            field=models.TextField(blank=True, default='', verbose_name='JSON list of the sequence numbers of a table rule'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            seed_code_mappings, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,151 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.db import connections, models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
+import json
 import logging
 
 
+@python_2_unicode_compatible
+class MappingRule(models.Model):
+    """
+    A rule for mapping the sequence numbers of one messageset to another.
+    Sequence numbers from `start`, up to the start of the next rule for the
+    same messageset and direction, map to
+    `scale * sequence // divisor + offset` in `to_messageset`. A table rule,
+    which has `sequences`, is the only rule for its messageset and direction,
+    and maps sequence number `start + i` to `sequences[i]` in
+    `to_messageset`, where null means that it has no mapping.
+    """
+    FORWARD = 'F'
+    BACKWARD = 'B'
+    DIRECTION_CHOICES = (
+        (FORWARD, 'Forward'),
+        (BACKWARD, 'Backward'),
+    )
+
+    direction = models.CharField(
+        "Direction of the mapping", max_length=1, choices=DIRECTION_CHOICES,
+        default=FORWARD)
+    from_messageset = models.TextField(
+        "Short name of the messageset to map from")
+    start = models.PositiveIntegerField("First sequence number of the rule")
+    to_messageset = models.TextField("Short name of the messageset to map to")
+    scale = models.IntegerField("Scale of the sequence number", default=1)
+    divisor = models.PositiveIntegerField(
+        "Divisor of the scaled sequence number", default=1,
+        validators=[MinValueValidator(1)])
+    offset = models.IntegerField(
+        "Offset of the mapped sequence number", default=0)
+    sequences = models.TextField(
+        "JSON list of the sequence numbers of a table rule", blank=True)
+
+    class Meta:
+        ordering = ['direction', 'from_messageset', 'start']
+        unique_together = (('direction', 'from_messageset', 'start'),)
+
+    def get_sequences(self):
+        """
+        The sequence numbers that a table rule maps to, or None if the rule
+        isn't a table.
+        """
+        if not self.sequences:
+            return None
+        return json.loads(self.sequences)
+
+    def clean(self):
+        if self.sequences:
+            try:
+                sequences = json.loads(self.sequences)
+            except ValueError:
+                sequences = None
+            if not isinstance(sequences, list) or not all(
+                    sequence is None or (
+                        isinstance(sequence, six.integer_types) and
+                        not isinstance(sequence, bool) and sequence >= 0)
+                    for sequence in sequences):
+                raise ValidationError({'sequences': (
+                    "Must be a JSON list of sequence numbers or nulls.")})
+        others = MappingRule.objects.filter(
+            direction=self.direction,
+            from_messageset=self.from_messageset).exclude(pk=self.pk)
+        if not self.sequences:
+            others = others.exclude(sequences='')
+        if others.exists():
+            raise ValidationError(
+                "A table rule must be the only rule for its messageset and "
+                "direction.")
+
+    def to_dict(self):
+        rule = {
+            field: getattr(self, field) for field in (
+                'direction', 'from_messageset', 'start', 'to_messageset',
+                'scale', 'divisor', 'offset')
+        }
+        rule['sequences'] = self.get_sequences()
+        return rule
+
+    def __str__(self):
+        if self.sequences:
+            return (
+                "{direction} {from_ms} from {start}: table of {count} "
+                "sequence numbers in {to_ms}".format(
+                    direction=self.get_direction_display(),
+                    from_ms=self.from_messageset, start=self.start,
+                    count=len(self.get_sequences()),
+                    to_ms=self.to_messageset))
+        return (
+            "{direction} {from_ms} from {start}: {scale} * sequence // "
+            "{divisor} + {offset} in {to_ms}".format(
+                direction=self.get_direction_display(),
+                from_ms=self.from_messageset, start=self.start,
+                scale=self.scale, divisor=self.divisor, offset=self.offset,
+                to_ms=self.to_messageset))
+
+
+@python_2_unicode_compatible
+class MappingVersion(models.Model):
+    """
+    A snapshot of all of the mapping rules, which is created every time that
+    the rules change, so that migration runs keep using the rules that they
+    were created with.
+    """
+    rules = models.TextField("JSON of the mapping rules")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-pk']
+
+    @classmethod
+    def create_from_rules(cls):
+        """
+        Creates a new version with the current mapping rules.
+        """
+        return cls.objects.create(rules=json.dumps([
+            rule.to_dict() for rule in MappingRule.objects.all()]))
+
+    @classmethod
+    def get_latest_id(cls):
+        """
+        Returns the ID of the latest version, or None if the rules have never
+        been changed, in which case the mappings in the code are used.
+        """
+        return cls.objects.values_list('pk', flat=True).first()
+
+    def get_rules(self):
+        return json.loads(self.rules)
+
+    def __str__(self):
+        return "Mapping version {id} from {created_at}".format(
+            id=self.pk, created_at=self.created_at)
+
+
 @python_2_unicode_compatible
 class MigrateSubscription(models.Model):
     STARTING = 'S'
@@ -20,6 +160,21 @@ class MigrateSubscription(models.Model):
         (ERROR, 'Error'),
         (COMPLETE, 'Complete'),
     )
+    SNAPSHOT_PREFIX = 'mapper_snapshot_'
+    # The operators that the identities can be filtered with, which are used
+    # in the SQL query for the identities
+    FILTER_OPERATOR_CHOICES = (
+        ('=', 'equals'),
+        ('<>', 'does not equal'),
+        ('<', 'is less than'),
+        ('<=', 'is less than or equal to'),
+        ('>', 'is greater than'),
+        ('>=', 'is greater than or equal to'),
+        ('IS NULL', 'is empty'),
+        ('IS NOT NULL', 'is not empty'),
+    )
+    # Operators that don't compare the column to the filter value
+    UNARY_FILTER_OPERATORS = ('IS NULL', 'IS NOT NULL')
 
     # The task ID gets filled in when the task starts, to avoid the task
     # trying to load the model before it has been saved.
@@ -30,14 +185,92 @@ class MigrateSubscription(models.Model):
         default=STARTING)
     from_messageset = models.IntegerField(
         "ID of the messageset to transfer subscriptions from")
-    table_name = models.TextField("Database table for identity IDs")
-    column_name = models.TextField("Column in table for identity IDs")
+    # The identities are read from either a table in the identities database,
+    # or an uploaded file of identity IDs
+    table_name = models.TextField(
+        "Database table for identity IDs", blank=True)
+    column_name = models.TextField(
+        "Column in table for identity IDs", blank=True)
+    identity_file = models.FileField(
+        "File of identity IDs", upload_to='identity_files/', null=True,
+        blank=True)
+    # Only the rows of the table where the filter column matches the filter
+    # value are migrated. The filter is applied by the identities database.
+    filter_column = models.TextField(
+        "Column in table to filter the identities by", blank=True)
+    filter_operator = models.CharField(
+        "Operator to filter the identities with", max_length=11,
+        choices=FILTER_OPERATOR_CHOICES, blank=True)
+    filter_value = models.TextField(
+        "Value to filter the identities by", blank=True)
     # The total number gets filled inside the task, as a count could take
     # a long time.
     total = models.IntegerField(
         "Total number of identities to process", null=True, blank=True)
+    # The total starts as an estimate, and is replaced by the exact count once
+    # the count is complete
+    total_is_estimate = models.BooleanField(
+        "Whether the total is an estimate", default=False)
     current = models.IntegerField(
         "Current count of processed identities", default=0)
+    # The key of the last processed identity, so that resuming can seek
+    # straight past the identities that have already been processed.
+    last_identity = models.TextField(
+        "Last processed identity", null=True, blank=True)
+    # For runs that read from a file, the byte offset in the file just after
+    # the last processed identity, so that resuming can seek straight to it.
+    last_offset = models.BigIntegerField(
+        "Byte offset in the file after the last processed identity",
+        null=True, blank=True)
+    # Splitting the identities into more than one shard allows the run to
+    # be processed by multiple workers in parallel.
+    num_shards = models.PositiveIntegerField(
+        "Number of shards to split the identities into", default=1,
+        validators=[MinValueValidator(1)])
+    # Instead of looking up the subscriptions of each identity, fetch all the
+    # subscriptions to the messageset up front. This is faster when most of
+    # the messageset's subscriptions are being migrated.
+    prefetch_subscriptions = models.BooleanField(
+        "Prefetch all subscriptions to the messageset", default=False)
+    # Sharded runs prefetch the subscriptions once, and share them with the
+    # shards through this file
+    subscriptions_file = models.FileField(
+        "File with the prefetched subscriptions for the shards",
+        upload_to='subscriptions/', null=True, blank=True)
+    # Copying the identities into a snapshot table before migrating means that
+    # changes to the identities table don't affect the run, and that the
+    # identities are deduplicated and indexed. This needs permission to create
+    # tables in the identities database.
+    use_snapshot = models.BooleanField(
+        "Migrate from a snapshot of the identities", default=False)
+    snapshot_table = models.TextField(
+        "Table in the identities database with the snapshot of identities",
+        null=True, blank=True)
+    # Skip identities that opted out of a previous migration, or that were
+    # migrated on a previous run, instead of migrating them again
+    exclude_reverted = models.BooleanField(
+        "Exclude identities that opted out of a previous migration",
+        default=False)
+    exclude_migrated = models.BooleanField(
+        "Exclude identities migrated on previous runs", default=False)
+    excluded = models.IntegerField(
+        "Count of identities excluded from processing", default=0)
+    # The version of the mapping rules when the run was created, which the
+    # run keeps using even if the rules change. Runs without a version use
+    # the mappings in the code.
+    mapping_version = models.ForeignKey(
+        MappingVersion, on_delete=models.PROTECT, null=True, blank=True,
+        related_name='migrations')
+    # A dry run plans the migration without changing any subscriptions,
+    # writing the plan of each subscription to a file, and a summary of the
+    # plan as JSON
+    dry_run = models.BooleanField(
+        "Plan the run without migrating any subscriptions", default=False)
+    plan_file = models.FileField(
+        "File with the plan of the dry run", upload_to='plans/', null=True,
+        blank=True)
+    plan_summary = models.TextField(
+        "JSON summary of the plan of the dry run", blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
 
@@ -47,6 +280,22 @@ class MigrateSubscription(models.Model):
             models.Index(fields=['-created_at']),
         ]
 
+    def get_snapshot_table_name(self):
+        """
+        The name of the table to create for the snapshot of the identities.
+        """
+        return '{prefix}{id}'.format(prefix=self.SNAPSHOT_PREFIX, id=self.pk)
+
+    def drop_snapshot_table(self):
+        """
+        Drops the table with the snapshot of the identities, if there is one.
+        """
+        if self.snapshot_table is None:
+            return
+        with connections['identities'].cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS {snapshot}'.format(
+                snapshot=self.snapshot_table))
+
     def can_be_cancelled(self):
         """
         Whether the task is in a state that allows it to be cancelled.
@@ -59,17 +308,105 @@ class MigrateSubscription(models.Model):
         """
         return self.status == self.CANCELLED or self.status == self.ERROR
 
+    def can_retry_failed_identities(self):
+        """
+        Whether the task is complete, and has identities that failed to
+        migrate that can be retried.
+        """
+        return (
+            self.status == self.COMPLETE and
+            self.failed_identities.exists())
+
+    def get_plan_summary(self):
+        """
+        The summary of the plan of a dry run, or None if the run hasn't been
+        planned.
+        """
+        if not self.plan_summary:
+            return None
+        return json.loads(self.plan_summary)
+
+    def get_filter_display(self):
+        """
+        A description of the filter of the identities, or an empty string if
+        there is no filter.
+        """
+        if not self.filter_column:
+            return ''
+        if self.filter_operator in self.UNARY_FILTER_OPERATORS:
+            return "{column} {operator}".format(
+                column=self.filter_column,
+                operator=self.get_filter_operator_display())
+        return "{column} {operator} {value}".format(
+            column=self.filter_column,
+            operator=self.get_filter_operator_display(),
+            value=self.filter_value)
+
+    def get_source_display(self):
+        """
+        A description of where the identities are read from.
+        """
+        if self.identity_file:
+            return self.identity_file.name
+        source = "{column} on {table}".format(
+            column=self.column_name, table=self.table_name)
+        if self.filter_column:
+            source += " where {filter}".format(
+                filter=self.get_filter_display())
+        return source
+
     def __str__(self):
         return (
-            "{status} migrate {column} on {table} from message set {from_ms} "
-            "with task {task}"
+            "{status} migrate {source} from message set {from_ms} with task "
+            "{task}"
             .format(
-                status=self.get_status_display(), column=self.column_name,
-                table=self.table_name, from_ms=self.from_messageset,
+                status=self.get_status_display(),
+                source=self.get_source_display(), from_ms=self.from_messageset,
                 task=self.task_id)
         )
 
 
+@receiver(post_delete, sender=MigrateSubscription)
+def drop_deleted_snapshot(sender, instance, **kwargs):
+    """
+    Cancelled runs keep their snapshot of the identities, so that they can be
+    resumed, so the snapshot is dropped when the run is deleted.
+    """
+    instance.drop_snapshot_table()
+
+
+@python_2_unicode_compatible
+class IdentityShard(models.Model):
+    """
+    A range of the identities of a sharded migration run, that gets processed
+    by its own task. The range excludes the lower bound and includes the upper
+    bound, with a null bound meaning that the range is unbounded on that side.
+    """
+    migrate_subscription = models.ForeignKey(
+        MigrateSubscription, on_delete=models.CASCADE, related_name='shards')
+    index = models.PositiveIntegerField("Index of the shard in the run")
+    lower_bound = models.TextField(
+        "Exclusive lower bound of the identities", null=True, blank=True)
+    upper_bound = models.TextField(
+        "Inclusive upper bound of the identities", null=True, blank=True)
+    current = models.IntegerField(
+        "Current count of processed identities", default=0)
+    last_identity = models.TextField(
+        "Last processed identity", null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['index']
+        unique_together = (('migrate_subscription', 'index'),)
+
+    def __str__(self):
+        return "Shard {index} ({lower} - {upper}] of migration run {migrate}"\
+            .format(
+                index=self.index, lower=self.lower_bound or '',
+                upper=self.upper_bound or '',
+                migrate=self.migrate_subscription_id)
+
+
 @python_2_unicode_compatible
 class LogEvent(models.Model):
     LOG_LEVEL_CHOICES = (
@@ -116,6 +453,7 @@ class MigratedIdentity(models.Model):
         indexes = [
             models.Index(fields=['identity_uuid'])
         ]
+        unique_together = (('migrate_subscription', 'identity_uuid'),)
         verbose_name_plural = "migrated identities"
 
     def __str__(self):
@@ -124,6 +462,42 @@ class MigratedIdentity(models.Model):
             migrate=self.migrate_subscription_id)
 
 
+@python_2_unicode_compatible
+class FailedIdentity(models.Model):
+    """
+    Keeps track of each identity that couldn't be migrated on a migration run,
+    so that they can be retried without reprocessing the whole run.
+    """
+    migrate_subscription = models.ForeignKey(
+        MigrateSubscription, on_delete=models.CASCADE,
+        related_name='failed_identities')
+    identity_uuid = models.UUIDField()
+    error = models.TextField("Last error")
+    attempts = models.PositiveIntegerField("Number of attempts", default=1)
+    cancelled_subscriptions = models.TextField(
+        "JSON list of the subscriptions that were cancelled, but not "
+        "recreated", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name_plural = "failed identities"
+
+    def get_cancelled_subscriptions(self):
+        """
+        The subscriptions that were cancelled before the identity failed, and
+        still need to be recreated on the messagesets that they map to.
+        """
+        if not self.cancelled_subscriptions:
+            return []
+        return json.loads(self.cancelled_subscriptions)
+
+    def __str__(self):
+        return "Failed {identity} on migration run {migrate}".format(
+            identity=str(self.identity_uuid),
+            migrate=self.migrate_subscription_id)
+
+
 @python_2_unicode_compatible
 class RevertedIdentity(models.Model):
     """
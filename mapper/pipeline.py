@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from collections import deque
+from django.utils import six
+from django.utils.six.moves.queue import Full, Queue
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, Thread
+import sys
+import time
+
+
+class PipelineStats(object):
+    """
+    Counts the identities that have passed through each stage of migrating
+    identities, so that we can report the throughput of each stage, and the
+    depth of the queues between them, to see which stage is the bottleneck.
+    Stages can be counted from multiple threads.
+    """
+    STAGES = ('read', 'migrated', 'saved')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.started_at = self.reported_at = time.time()
+
+    def add(self, stage, count=1):
+        with self.lock:
+            self.counts[stage] += count
+
+    def is_due(self, interval):
+        """
+        Whether it has been at least `interval` seconds since the last report.
+        """
+        return time.time() - self.reported_at >= interval
+
+    def report(self, queues):
+        """
+        Returns a message with the count and throughput of each stage, and the
+        depth of the queues, which is a list of (name, depth, size).
+        """
+        self.reported_at = time.time()
+        elapsed = max(self.reported_at - self.started_at, 0.001)
+        with self.lock:
+            counts = dict(self.counts)
+        return "Identities {stages}. Queues {queues}.".format(
+            stages=', '.join(
+                '{stage} {count} ({rate:.1f}/s)'.format(
+                    stage=stage, count=counts[stage],
+                    rate=counts[stage] / elapsed)
+                for stage in self.STAGES),
+            queues=', '.join(
+                '{name} {depth}/{size}'.format(
+                    name=name, depth=depth, size=size)
+                for name, depth, size in queues))
+
+
+class ReadAhead(object):
+    """
+    Iterates over `iterable` in a background thread, keeping up to `size`
+    items ready in a bounded queue, so that reading the items overlaps with
+    processing them. Errors raised while reading are raised again by the
+    iterator. `setup` is called in the background thread before reading.
+    """
+    DONE = object()
+
+    def __init__(self, iterable, size, stats=None, setup=None):
+        self.iterable = iterable
+        self.size = size
+        self.stats = stats
+        self.queue = Queue(size)
+        self.stopped = Event()
+        self.error = None
+        self.thread = Thread(target=self.read, args=(setup,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self.DONE:
+                if self.error is not None:
+                    six.reraise(*self.error)
+                return
+            yield item
+
+    def read(self, setup):
+        try:
+            if setup is not None:
+                setup()
+            for item in self.iterable:
+                if not self.put(item):
+                    return
+                if self.stats is not None:
+                    self.stats.add('read')
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            # Closing a generator runs its cleanup in this thread, which is
+            # the thread that it was running in
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+            self.put(self.DONE)
+
+    def put(self, item):
+        """
+        Puts the item on the queue, waiting for space unless the reader is
+        stopped. Returns whether the item was put on the queue.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def close(self):
+        """
+        Stops reading, and waits for the background thread to finish.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+
+class LookAhead(object):
+    """
+    Iterates over `iterable`, calling `func` in a pool of `threads` threads
+    for each item up to `size` items before the item is yielded, so that slow
+    work for upcoming items is already done by the time they are processed.
+    Items that `skip` returns True for aren't started. The results are kept
+    until they are popped, or the look ahead is closed.
+    """
+    def __init__(self, iterable, size, func, threads=1, skip=None):
+        self.iterable = iterable
+        self.size = size
+        self.func = func
+        self.skip = skip
+        # More threads than items being looked ahead would never be used
+        self.pool = ThreadPool(max(min(threads, size), 1))
+        self.results = {}
+
+    def __iter__(self):
+        upcoming = deque()
+        for item in self.iterable:
+            key = str(item)
+            if key not in self.results and not (
+                    self.skip is not None and self.skip(item)):
+                self.results[key] = self.pool.apply_async(self.func, (item,))
+            upcoming.append(item)
+            if len(upcoming) > self.size:
+                yield upcoming.popleft()
+        while upcoming:
+            yield upcoming.popleft()
+
+    def pop(self, item):
+        """
+        Removes and returns the pool result for the item, or None if it
+        wasn't started.
+        """
+        return self.results.pop(str(item), None)
+
+    def close(self):
+        """
+        Cancels the work that hasn't started yet, and discards the results.
+        Nothing should be waiting on the results when this is called.
+        """
+        self.pool.terminate()
+        self.results.clear()
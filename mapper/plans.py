@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from array import array
+from collections import Counter
+import gzip
+
+
+class MigrationPlan(object):
+    """
+    Plans the migration of identities without changing any subscriptions.
+    Each subscription that would be migrated is written to `fileobj` as a
+    gzipped CSV row of the identity, the subscription ID, its sequence number,
+    and the messageset and sequence number that it maps to, which are empty
+    if it has no mapping. The counts for the summary of the plan are kept as
+    the identities are added.
+    """
+    HEADER = (
+        'identity', 'subscription', 'sequence', 'to_messageset',
+        'to_sequence')
+
+    def __init__(self, fileobj):
+        self.file = gzip.GzipFile(fileobj=fileobj, mode='wb')
+        self.write_row(self.HEADER)
+        self.identities = 0
+        self.excluded = 0
+        self.no_subscriptions = 0
+        self.multiple_subscriptions = 0
+        self.subscriptions = 0
+        self.unmapped = 0
+        self.to_messagesets = Counter()
+
+    def write_row(self, values):
+        # Identities, IDs and messageset short names never need quoting
+        self.file.write(
+            (','.join('' if v is None else str(v) for v in values) + '\n')
+            .encode('utf-8'))
+
+    def add_excluded(self):
+        self.identities += 1
+        self.excluded += 1
+
+    def add_batch(self, mapper, messageset, identities):
+        """
+        Plans the migration of a batch of identities from the messageset.
+        `identities` is a list of (identity, subscriptions) tuples, and all of
+        the sequence numbers of the batch are mapped with a single call to the
+        mapper.
+        """
+        subscriptions = []
+        sequences = array('l')
+        for identity, subs in identities:
+            self.identities += 1
+            if not subs:
+                self.no_subscriptions += 1
+            elif len(subs) > 1:
+                self.multiple_subscriptions += 1
+            for sub in subs:
+                subscriptions.append((identity, sub))
+                sequences.append(sub['next_sequence_number'])
+
+        batch = mapper.map_forward_batch(messageset, sequences)
+        for (identity, sub), to_messageset, to_sequence, mapped in zip(
+                subscriptions, batch.messagesets, batch.sequences,
+                batch.mask):
+            self.subscriptions += 1
+            if mapped:
+                self.to_messagesets[to_messageset] += 1
+            else:
+                self.unmapped += 1
+                to_sequence = None
+            self.write_row((
+                identity, sub['id'], sub['next_sequence_number'],
+                to_messageset, to_sequence))
+
+    def close(self):
+        self.file.close()
+
+    def count_requests(self, prefetched):
+        """
+        The number of requests to Stage Based Messaging that migrating the
+        planned identities would make. Each subscription is cancelled and
+        recreated, and unless the subscriptions are prefetched, the
+        subscriptions of each identity are looked up.
+        """
+        requests = self.subscriptions * 2
+        if not prefetched:
+            requests += self.identities - self.excluded
+        return requests
+
+    def get_summary(self, prefetched, latency, concurrency):
+        """
+        Returns a dict summarising the plan. The duration of the run is
+        projected from the number of requests that it would make, at
+        `latency` seconds per request, with `concurrency` requests at a time.
+        """
+        requests = self.count_requests(prefetched)
+        return {
+            'identities': self.identities,
+            'excluded': self.excluded,
+            'no_subscriptions': self.no_subscriptions,
+            'multiple_subscriptions': self.multiple_subscriptions,
+            'subscriptions': self.subscriptions,
+            'unmapped': self.unmapped,
+            'to_messagesets': dict(self.to_messagesets),
+            'requests': requests,
+            'projected_seconds': int(round(
+                requests * latency / max(concurrency, 1))),
+        }
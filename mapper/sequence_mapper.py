@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from math import floor
+
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from django.utils import six
+import copy
+import sys
 
 
 class NoMappingFound(Exception):
@@ -10,22 +16,370 @@ class NoMappingFound(Exception):
     """
 
 
+class MappingError(Exception):
+    """
+    Raised when verifying a mapping finds sequence numbers that don't map
+    correctly.
+    """
+
+
+class Segment(namedtuple(
+        'Segment', ['start', 'messageset', 'scale', 'divisor', 'offset'])):
+    """
+    A piecewise linear mapping rule. Sequence numbers from `start`, up to the
+    start of the next segment, map to
+    `scale * sequence // divisor + offset` in `messageset`.
+    """
+    def __new__(cls, start, messageset, scale=1, divisor=1, offset=0):
+        return super(Segment, cls).__new__(
+            cls, start, messageset, scale, divisor, offset)
+
+
+class MappedBatch(namedtuple(
+        'MappedBatch', ['messagesets', 'sequences', 'mask'])):
+    """
+    The result of mapping a batch of sequence numbers. For each sequence
+    number in the batch, `messagesets` has the short name of the messageset
+    that it maps to, `sequences` has the sequence number that it maps to, and
+    `mask` is 1 if it has a mapping, or 0 if it doesn't, in which case the
+    messageset is None and the sequence number is 0.
+    """
+
+
+class Table(namedtuple('Table', ['messageset', 'first', 'sequences'])):
+    """
+    An explicit mapping rule. Sequence number `first + i` maps to
+    `sequences[i]` in `messageset`, and None in `sequences` means that the
+    sequence number has no mapping.
+    """
+
+
+# The mappings from the messageset that subscriptions are migrated from, to
+# the messageset that they are migrated to. Each messageset maps with either a
+# list of segments, or a table.
+FORWARD_MAPPINGS = {
+    'test.gates.messageset.1': [
+        Segment(0, 'test.gates.messageset.2', scale=0),
+        Segment(1, 'test.gates.messageset.2', scale=2, offset=-1),
+    ],
+}
+
+# The mappings back from the messageset that subscriptions were migrated to,
+# for when identities opt out of the migration.
+BACKWARD_MAPPINGS = {
+    'test.gates.messageset.2': [
+        Segment(0, 'test.gates.messageset.1', divisor=2, offset=1),
+    ],
+}
+
+
+def mappings_to_rules(mappings):
+    """
+    Converts a dict of mapping rules for each messageset short name into a
+    list of dicts in the form of the fields of the mapping rules that are
+    edited in the admin. A table is a single rule, with its sequence numbers.
+    """
+    rules = []
+    for messageset, mapping in sorted(mappings.items()):
+        if isinstance(mapping, Table):
+            rules.append({
+                'from_messageset': messageset, 'start': mapping.first,
+                'to_messageset': mapping.messageset, 'scale': 1,
+                'divisor': 1, 'offset': 0,
+                'sequences': list(mapping.sequences),
+            })
+            continue
+        for segment in sorted(mapping, key=lambda segment: segment.start):
+            rules.append({
+                'from_messageset': messageset, 'start': segment.start,
+                'to_messageset': segment.messageset, 'scale': segment.scale,
+                'divisor': segment.divisor, 'offset': segment.offset,
+                'sequences': None,
+            })
+    return rules
+
+
+class CompiledSegments(object):
+    """
+    The segments of a mapping, compiled into arrays, so that the segment of a
+    sequence number is found with a binary search.
+    """
+    def __init__(self, segments):
+        segments = sorted(segments, key=lambda segment: segment.start)
+        self.starts = array('l', (s.start for s in segments))
+        self.messagesets = [s.messageset for s in segments]
+        self.scales = array('l', (s.scale for s in segments))
+        self.divisors = array('l', (s.divisor for s in segments))
+        self.offsets = array('l', (s.offset for s in segments))
+
+    def map(self, sequence):
+        """
+        Returns the tuple (messageset, sequence) for the sequence number, or
+        None if there is no mapping for it.
+        """
+        index = bisect_right(self.starts, sequence) - 1
+        if index < 0:
+            return None
+        return (
+            self.messagesets[index],
+            self.scales[index] * sequence // self.divisors[index] +
+            self.offsets[index])
+
+    def map_batch(self, sequences):
+        """
+        Maps all of the sequence numbers, returning a MappedBatch.
+        """
+        starts = self.starts
+        messagesets, mapped, mask = [], [], []
+        # Sequence numbers in a batch are usually close together, so we keep
+        # the bounds of the last segment, and only search for the segment when
+        # the sequence number is outside of them
+        low = high = 0
+        messageset = scale = divisor = offset = None
+        for sequence in sequences:
+            if not low <= sequence < high:
+                index = bisect_right(starts, sequence) - 1
+                if index < 0:
+                    low = -sys.maxsize
+                    high = starts[0] if starts else sys.maxsize
+                    messageset = None
+                else:
+                    low = starts[index]
+                    high = (
+                        starts[index + 1] if index + 1 < len(starts)
+                        else sys.maxsize)
+                    messageset = self.messagesets[index]
+                    scale, divisor, offset = (
+                        self.scales[index], self.divisors[index],
+                        self.offsets[index])
+            messagesets.append(messageset)
+            if messageset is None:
+                mapped.append(0)
+                mask.append(0)
+            else:
+                mapped.append(scale * sequence // divisor + offset)
+                mask.append(1)
+        return MappedBatch(messagesets, array('l', mapped), array('b', mask))
+
+
+class CompiledTable(object):
+    """
+    A table mapping, compiled into an array indexed by sequence number.
+    """
+    # Marks the sequence numbers that have no mapping
+    MISSING = -1
+
+    def __init__(self, table):
+        self.messageset = table.messageset
+        self.first = table.first
+        self.sequences = array('l', (
+            self.MISSING if sequence is None else sequence
+            for sequence in table.sequences))
+
+    def map(self, sequence):
+        """
+        Returns the tuple (messageset, sequence) for the sequence number, or
+        None if there is no mapping for it.
+        """
+        index = sequence - self.first
+        if index < 0 or index >= len(self.sequences):
+            return None
+        mapped = self.sequences[index]
+        if mapped == self.MISSING:
+            return None
+        return self.messageset, mapped
+
+    def map_batch(self, sequences):
+        """
+        Maps all of the sequence numbers, returning a MappedBatch.
+        """
+        table, first, size = self.sequences, self.first, len(self.sequences)
+        messagesets = []
+        mapped = array('l')
+        mask = array('b')
+        for sequence in sequences:
+            index = sequence - first
+            if 0 <= index < size and table[index] != self.MISSING:
+                messagesets.append(self.messageset)
+                mapped.append(table[index])
+                mask.append(1)
+            else:
+                messagesets.append(None)
+                mapped.append(0)
+                mask.append(0)
+        return MappedBatch(messagesets, mapped, mask)
+
+
+class PrecomputedMapping(object):
+    """
+    A mapping that has been precomputed for every sequence number from 1 to
+    the length of a messageset, so that mapping them is an index into arrays.
+    Other sequence numbers are mapped with the `fallback` compiled mapping.
+    """
+    def __init__(self, messagesets, targets, sequences, fallback):
+        # The short names of the messagesets that are mapped to
+        self.messagesets = messagesets
+        # For each sequence number, the index of the messageset and the
+        # sequence number that it maps to
+        self.targets = targets
+        self.sequences = sequences
+        self.fallback = fallback
+
+    def map(self, sequence):
+        """
+        Returns the tuple (messageset, sequence) for the sequence number, or
+        None if there is no mapping for it.
+        """
+        index = sequence - 1
+        if 0 <= index < len(self.sequences):
+            return (
+                self.messagesets[self.targets[index]], self.sequences[index])
+        return self.fallback.map(sequence)
+
+    def map_batch(self, sequences):
+        """
+        Maps all of the sequence numbers, returning a MappedBatch.
+        """
+        size = len(self.sequences)
+        messagesets, mapped, mask = [], [], []
+        for sequence in sequences:
+            index = sequence - 1
+            if 0 <= index < size:
+                result = (
+                    self.messagesets[self.targets[index]],
+                    self.sequences[index])
+            else:
+                result = self.fallback.map(sequence)
+            if result is None:
+                messagesets.append(None)
+                mapped.append(0)
+                mask.append(0)
+            else:
+                messagesets.append(result[0])
+                mapped.append(result[1])
+                mask.append(1)
+        return MappedBatch(messagesets, array('l', mapped), array('b', mask))
+
+
+def compile_mappings(mappings):
+    """
+    Compiles a dict of mapping rules for each messageset short name into a
+    dict of compiled mappings.
+    """
+    return {
+        messageset: (
+            CompiledTable(rules) if isinstance(rules, Table)
+            else CompiledSegments(rules))
+        for messageset, rules in mappings.items()
+    }
+
+
 class SequenceMapper(object):
     """
-    Provides the logic for mapping from one message set to another.
+    Provides the logic for mapping from one message set to another. The
+    mapping rules are compiled when the mapper is created, so that each
+    mapping is a dict lookup and an array lookup.
     """
-    def map_test_messageset_1(self, sequence):
+    # The most problems to describe when verifying a mapping
+    MAX_PROBLEMS = 10
+
+    def __init__(self, forward=None, backward=None):
+        self.forward = compile_mappings(
+            FORWARD_MAPPINGS if forward is None else forward)
+        self.backward = compile_mappings(
+            BACKWARD_MAPPINGS if backward is None else backward)
+
+    def map(self, mappings, messageset, sequence):
+        mapping = mappings.get(messageset)
+        result = None
+        if mapping is not None and isinstance(sequence, six.integer_types):
+            result = mapping.map(sequence)
+        # If we cannot find any mapping, raise the exception
+        if result is None:
+            raise NoMappingFound(
+                "No mapping can be found for messageset {messageset} and "
+                "sequence {sequence}".format(
+                    messageset=messageset, sequence=sequence))
+        return result
+
+    def map_batch(self, mappings, messageset, sequences):
+        mapping = mappings.get(messageset)
+        if mapping is None:
+            size = len(sequences)
+            return MappedBatch(
+                [None] * size, array('l', [0]) * size, array('b', [0]) * size)
+        return mapping.map_batch(sequences)
+
+    def precompute_forward(self, messageset, get_length, max_drift=1):
         """
-        Maps from the first testing messageset to the second testing
-        messageset.
+        Maps every sequence number of the messageset, from 1 to its length,
+        forward and back again, and returns a copy of the mapper with the
+        forward mapping of the messageset precomputed. `get_length` returns
+        the number of messages in a messageset, given its short name.
+
+        Raises MappingError if any of the sequence numbers have no mapping,
+        map past the end of the messageset that they map to, have no mapping
+        back, or map back to a different messageset, or more than `max_drift`
+        away from where they started.
         """
-        return 'test.gates.messageset.2', max(0, 2 * sequence - 1)
+        mapping = self.forward.get(messageset)
+        if mapping is None:
+            raise MappingError(
+                "No mapping can be found for messageset {messageset}".format(
+                    messageset=messageset))
+        messagesets, targets, sequences = [], array('h'), array('l')
+        problems = []
+        for sequence in range(1, get_length(messageset) + 1):
+            problem, result = self.check_round_trip(
+                messageset, sequence, mapping, get_length, max_drift)
+            if problem is not None:
+                problems.append(problem)
+                continue
+            target, target_sequence = result
+            if target not in messagesets:
+                messagesets.append(target)
+            targets.append(messagesets.index(target))
+            sequences.append(target_sequence)
+        if problems:
+            raise MappingError(
+                "The mapping for messageset {messageset} has {num} problems: "
+                "{problems}{more}".format(
+                    messageset=messageset, num=len(problems),
+                    problems='; '.join(problems[:self.MAX_PROBLEMS]),
+                    more='; ...' if len(problems) > self.MAX_PROBLEMS else ''))
+        mapper = copy.copy(self)
+        mapper.forward = dict(self.forward)
+        mapper.forward[messageset] = PrecomputedMapping(
+            messagesets, targets, sequences, mapping)
+        return mapper
 
-    def map_test_messageset_2(self, sequence):
+    def check_round_trip(
+            self, messageset, sequence, mapping, get_length, max_drift):
         """
-        Maps from the second testing messageset back to the first.
+        Maps the sequence number forward with `mapping`, and back again.
+        Returns a tuple of (problem, result), where problem describes what is
+        wrong with the mapping, or is None, and result is the forward mapping.
         """
-        return 'test.gates.messageset.1', int(floor(sequence / 2.0) + 1)
+        result = mapping.map(sequence)
+        if result is None:
+            return "{ms} {seq} has no mapping".format(
+                ms=messageset, seq=sequence), None
+        target, target_sequence = result
+        description = "{ms} {seq} maps to {target} {target_seq}".format(
+            ms=messageset, seq=sequence, target=target,
+            target_seq=target_sequence)
+        if not 1 <= target_sequence <= get_length(target):
+            return "{description}, which is past the end of {target}".format(
+                description=description, target=target), result
+        backward = self.backward.get(target)
+        back = backward.map(target_sequence) if backward is not None else None
+        if back is None:
+            return "{description}, which has no mapping back".format(
+                description=description), result
+        if back[0] != messageset or abs(back[1] - sequence) > max_drift:
+            return "{description}, which maps back to {ms} {seq}".format(
+                description=description, ms=back[0], seq=back[1]), result
+        return None, result
 
     def map_forward(self, messageset, sequence):
         """
@@ -33,12 +387,7 @@ class SequenceMapper(object):
         returns the tuple (messageset, sequence) of the mapped messageset and
         sequence.
         """
-        if messageset == 'test.gates.messageset.1':
-            return self.map_test_messageset_1(sequence)
-        # If we cannot find any mapping, raise the exception
-        raise NoMappingFound(
-            "No mapping can be found for messageset {messageset} and sequence "
-            "{sequence}".format(messageset=messageset, sequence=sequence))
+        return self.map(self.forward, messageset, sequence)
 
     def map_backward(self, messageset, sequence):
         """
@@ -46,14 +395,29 @@ class SequenceMapper(object):
         returns the tuple (messageset, sequence) of the mapped messageset and
         sequence.
         """
-        if messageset == 'test.gates.messageset.2':
-            return self.map_test_messageset_2(sequence)
-        # If we cannot find any mapping, raise the exception
-        raise NoMappingFound(
-            "No mapping can be found for messageset {messageset} and sequence "
-            "{sequence}".format(messageset=messageset, sequence=sequence))
+        return self.map(self.backward, messageset, sequence)
+
+    def map_forward_batch(self, messageset, sequences):
+        """
+        Given the short_name of the messageset, and a sequence, such as an
+        array, of sequence numbers in it, returns a MappedBatch of the mapped
+        messagesets and sequences. Sequence numbers without a mapping are
+        masked out instead of raising NoMappingFound.
+        """
+        return self.map_batch(self.forward, messageset, sequences)
+
+    def map_backward_batch(self, messageset, sequences):
+        """
+        Given the short_name of the messageset, and a sequence, such as an
+        array, of sequence numbers in it, returns a MappedBatch of the mapped
+        messagesets and sequences. Sequence numbers without a mapping are
+        masked out instead of raising NoMappingFound.
+        """
+        return self.map_batch(self.backward, messageset, sequences)
 
 
 mapper = SequenceMapper()
 map_forward = mapper.map_forward
 map_backward = mapper.map_backward
+map_forward_batch = mapper.map_forward_batch
+map_backward_batch = mapper.map_backward_batch
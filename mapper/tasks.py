@@ -1,78 +1,553 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from celery import group
 from celery.task import Task
 from celery.utils.log import get_task_logger
+from collections import deque
+from datetime import timedelta
+from demands import HTTPServiceError
 from django.conf import settings
+from django.core.files import File
 from django.db import connections, transaction
 from django.db.models import F
 from django.utils import timezone
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+from functools import partial
 from logging import INFO, ERROR, WARNING
-from seed_services_client.stage_based_messaging import (
-    StageBasedMessagingApiClient)
-from uuid import uuid4
+from multiprocessing.pool import ThreadPool
+from requests import RequestException
+from threading import Lock
+from uuid import UUID, uuid4
+import gzip
+import json
+import random
+import tempfile
+import time
 
-from mapper.models import LogEvent, MigrateSubscription, MigratedIdentity
-from mapper.sequence_mapper import map_forward
+from mapper import clients
+from mapper.concurrency import is_overloaded, sbm_limiter
+from mapper.identity_files import IdentityFile
+from mapper.mappings import get_mapper, registry
+from mapper.models import (
+    FailedIdentity, IdentityShard, LogEvent, MigrateSubscription,
+    MigratedIdentity, RevertedIdentity)
+from mapper.pipeline import LookAhead, PipelineStats, ReadAhead
+from mapper.plans import MigrationPlan
+from mapper.writers import BufferedWriter, LogAggregator
+
+
+class Progress(object):
+    """
+    Keeps track of the identities that have been processed since the progress
+    of a migration was last saved, so that we only need to save the progress
+    every MIGRATION_CHECKPOINT_SIZE identities, or every
+    MIGRATION_CHECKPOINT_INTERVAL milliseconds, whichever comes first.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.excluded = 0
+        self.last_identity = None
+        self.saved_at = time.time()
+
+    def add(self, identity, excluded=False):
+        self.count += 1
+        if excluded:
+            self.excluded += 1
+        self.last_identity = identity
+
+    def is_due(self):
+        """
+        Whether the progress should be saved.
+        """
+        elapsed = (time.time() - self.saved_at) * 1000
+        return (
+            self.count >= settings.MIGRATION_CHECKPOINT_SIZE or
+            elapsed >= settings.MIGRATION_CHECKPOINT_INTERVAL)
+
+
+class RunState(object):
+    """
+    The state of a migration run while its identities are being processed.
+    Celery runs its own registered instance of each task, which is shared by
+    all of the runs in the worker process, so the state of a run is passed to
+    the methods of the task that need it, instead of being kept on the task.
+    """
+    def __init__(self):
+        # Prefetched subscriptions to the messageset that we're migrating from
+        self.prefetched_subscriptions = None
+        # Buffers the MigratedIdentity objects until the progress is saved
+        self.migrated_identities = None
+        # Buffers the FailedIdentity objects until the progress is saved
+        self.failed_identities = None
+        # Buffers the LogEvent objects, and aggregates the messages about
+        # individual identities
+        self.log_events = None
+        self.identity_logs = None
+        # Counts the identities through each stage of processing the run
+        self.pipeline_stats = None
+        # Looks up the subscriptions of the upcoming identities
+        self.lookahead = None
+        # The file that the identities are read from, if they aren't read
+        # from the identities database
+        self.identity_file = None
+        # The mapper for the run, which has been verified if
+        # MIGRATION_VERIFY_MAPPINGS is set
+        self.mapper = None
+        # The result of the exact count of identities that is running in the
+        # background
+        self.identity_count = None
+
+
+class BackgroundCount(object):
+    """
+    Runs `count` in a separate thread, with its own connection to the
+    identities database, so that the run can carry on while the identities
+    are counted, and cancel the count if it stops before the count finishes.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.connection = None
+        self.lock = Lock()
+        pool = ThreadPool(1)
+        self.result = pool.apply_async(self.run)
+        pool.close()
+
+    def run(self):
+        conn = connections['identities']
+        try:
+            conn.ensure_connection()
+            with self.lock:
+                self.connection = conn.connection
+            return self.count()
+        finally:
+            # The thread has its own connection, which isn't closed for us
+            with self.lock:
+                self.connection = None
+            conn.close()
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self):
+        return self.result.get()
+
+    def cancel(self):
+        """
+        Cancels the query of the count, if it is still running.
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.connection.cancel()
+
+
+class IdentityProgress(object):
+    """
+    Keeps track of the subscriptions of an identity that have been cancelled,
+    but not yet recreated on the messagesets that they map to, and of the
+    subscriptions that have been migrated, so that retrying the identity
+    carries on from where the previous attempt stopped, instead of losing the
+    cancelled subscriptions.
+    """
+    def __init__(self, cancelled=None):
+        self.cancelled = list(cancelled or [])
+        self.migrated = set()
+
+    def is_started(self, sub):
+        return sub['id'] in self.migrated or any(
+            c['id'] == sub['id'] for c in self.cancelled)
 
 
 class MigrateSubscriptionsTask(Task):
     CHUNK_SIZE = 1000
+    # The fields of each subscription that we need to migrate it
+    SUBSCRIPTION_FIELDS = ('id', 'next_sequence_number', 'lang')
     logger = get_task_logger(__name__)
-    sbm_client = StageBasedMessagingApiClient(
-        settings.STAGE_BASED_MESSAGING_TOKEN,
-        settings.STAGE_BASED_MESSAGING_URL)
+    sbm_client = clients.sbm_client
 
-    def log(self, migrate, level, message):
-        LogEvent.objects.create(
+    def log(self, migrate, level, message, state=None):
+        log_event = LogEvent(
             migrate_subscription=migrate, log_level=level, message=message)
+        if state is None or state.log_events is None:
+            log_event.save()
+        else:
+            state.log_events.add(log_event)
         self.logger.log(level, message)
 
+    def log_identity(
+            self, migrate, level, identity, message, plural_message,
+            state=None, **kwargs):
+        """
+        Logs a message about a single identity. While processing identities,
+        repeats of the message for different identities are combined into a
+        single log event, using `plural_message`.
+        """
+        if state is None or state.identity_logs is None:
+            self.log(
+                migrate, level, message.format(identity=identity, **kwargs),
+                state)
+            return
+        self.logger.log(level, message.format(identity=identity, **kwargs))
+        state.identity_logs.add(
+            level, identity, message, plural_message, **kwargs)
+
+    def flush_logs(self, migrate, state, force=False):
+        """
+        Saves the buffered log events. The combined messages about individual
+        identities are only saved every MIGRATION_LOG_SUMMARY_INTERVAL
+        seconds, unless `force` is True.
+        """
+        if state.identity_logs is not None and (
+                force or state.identity_logs.is_due(
+                    settings.MIGRATION_LOG_SUMMARY_INTERVAL)):
+            for level, message in state.identity_logs.pop():
+                self.log(migrate, level, message, state)
+        if state.log_events is not None:
+            state.log_events.flush()
+
+    def get_filter_condition(self, migrate):
+        """
+        Returns a tuple of (condition, params), where condition is the SQL
+        condition for the filter of the run's identities, and params are the
+        parameters for it, or (None, []) if the run has no filter.
+        """
+        if not migrate.filter_column:
+            return None, []
+        operators = dict(MigrateSubscription.FILTER_OPERATOR_CHOICES)
+        if migrate.filter_operator not in operators:
+            raise ValueError(
+                "Invalid filter operator {operator}".format(
+                    operator=migrate.filter_operator))
+        condition = '{column} {operator}'.format(
+            column=migrate.filter_column, operator=migrate.filter_operator)
+        if migrate.filter_operator in \
+                MigrateSubscription.UNARY_FILTER_OPERATORS:
+            return condition, []
+        return condition + ' %s', [migrate.filter_value]
+
     def count_identities(self, migrate):
         """
         Counts the number of identities that we need to migrate, and returns
         the value.
         """
+        query = 'SELECT COUNT(*) FROM {table}'.format(table=migrate.table_name)
+        condition, params = self.get_filter_condition(migrate)
+        if condition is not None:
+            query += ' WHERE ' + condition
         with connections['identities'].cursor() as cursor:
-            cursor.execute(
-                'SELECT COUNT(*) FROM {table}'.format(
-                    table=migrate.table_name))
+            cursor.execute(query, params)
             [count] = cursor.fetchone()
         return count
 
-    def generate_identity_query(self, migrate):
+    def estimate_identities(self, migrate):
+        """
+        Returns the query planner's estimate of the number of identities that
+        we need to migrate, or None if there is no estimate. This is much
+        faster than counting the identities.
+        """
+        condition, params = self.get_filter_condition(migrate)
+        if condition is not None:
+            return self.estimate_filtered_identities(
+                migrate, condition, params)
+        with connections['identities'].cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)',
+                [migrate.table_name])
+            row = cursor.fetchone()
+        # Tables that have never been analysed have no estimate
+        if row is None or row[0] < 0:
+            return None
+        return int(row[0])
+
+    def estimate_filtered_identities(self, migrate, condition, params):
+        """
+        Returns the query planner's estimate of the number of rows that match
+        the filter of the run.
+        """
+        with connections['identities'].cursor() as cursor:
+            cursor.execute(
+                'EXPLAIN (FORMAT JSON) SELECT 1 FROM {table} WHERE '
+                '{condition}'.format(
+                    table=migrate.table_name, condition=condition),
+                params)
+            [plan] = cursor.fetchone()
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def count_identities_in_background(self, migrate):
+        """
+        Starts counting the identities in a separate thread, and returns the
+        BackgroundCount.
+        """
+        return BackgroundCount(partial(self.count_identities, migrate))
+
+    def update_total(self, migrate, state, wait=False):
+        """
+        Replaces the estimated total with the exact count of identities, if the
+        count has finished, or waits for it to finish if `wait` is True.
+        """
+        if state.identity_count is None or not (
+                wait or state.identity_count.ready()):
+            return
+        count, state.identity_count = state.identity_count, None
+        migrate.total = count.get()
+        migrate.total_is_estimate = False
+        migrate.save(update_fields=('total', 'total_is_estimate'))
+        self.log(
+            migrate, INFO,
+            "Counted {total} identities".format(total=migrate.total), state)
+
+    def cancel_count(self, state):
+        """
+        Stops counting the identities, if the count hasn't finished, so that
+        a run that stops early doesn't wait for it.
+        """
+        if state.identity_count is not None:
+            state.identity_count.cancel()
+            state.identity_count = None
+
+    def create_snapshot(self, migrate):
+        """
+        Copies the distinct identities into a new table in the identities
+        database, so that the run reads a stable, deduplicated and indexed set
+        of identities. Returns the number of identities in the snapshot.
+        """
+        table = migrate.get_snapshot_table_name()
+        with transaction.atomic(using='identities'), \
+                connections['identities'].cursor() as cursor:
+            # In case a previous attempt didn't save the snapshot table
+            cursor.execute('DROP TABLE IF EXISTS {snapshot}'.format(
+                snapshot=table))
+            condition, params = self.get_filter_condition(migrate)
+            cursor.execute(
+                'CREATE TABLE {snapshot} AS SELECT DISTINCT {column} AS '
+                'identity FROM {table} WHERE {column} IS NOT NULL{filter}'
+                .format(
+                    snapshot=table, column=migrate.column_name,
+                    table=migrate.table_name,
+                    filter=' AND ' + condition if condition else ''),
+                params)
+            count = cursor.rowcount
+            cursor.execute(
+                'ALTER TABLE {snapshot} ADD PRIMARY KEY (identity)'.format(
+                    snapshot=table))
+        migrate.snapshot_table = table
+        migrate.save(update_fields=('snapshot_table',))
+        return count
+
+    def drop_snapshot(self, migrate):
+        """
+        Removes the snapshot of the identities, if there is one.
+        """
+        if migrate.snapshot_table is None:
+            return
+        migrate.drop_snapshot_table()
+        migrate.snapshot_table = None
+        migrate.save(update_fields=('snapshot_table',))
+
+    def get_identity_source(self, migrate):
+        """
+        Returns a tuple of (table, column) to read the identities from, which
+        is the snapshot if the run has one.
+        """
+        if migrate.snapshot_table is not None:
+            return migrate.snapshot_table, 'identity'
+        return migrate.table_name, migrate.column_name
+
+    def get_shard_bounds(self, migrate):
+        """
+        Splits the identities into `num_shards` ranges of roughly equal size,
+        and returns a sorted list of the boundaries between the ranges.
+        """
+        fractions = [
+            i / float(migrate.num_shards)
+            for i in range(1, migrate.num_shards)]
+        table, column = self.get_identity_source(migrate)
+        query = (
+            'SELECT percentile_disc(%s::double precision[]) WITHIN GROUP '
+            '(ORDER BY {column}) FROM {table}'.format(
+                column=column, table=table))
+        params = [fractions]
+        # Snapshots only have the identities that match the filter
+        if migrate.snapshot_table is None:
+            condition, filter_params = self.get_filter_condition(migrate)
+            if condition is not None:
+                query += ' WHERE ' + condition
+                params.extend(filter_params)
+        with connections['identities'].cursor() as cursor:
+            cursor.execute(query, params)
+            [bounds] = cursor.fetchone()
+        # Tables with few distinct identities can give the same boundary for
+        # multiple fractions, which would result in empty shards
+        unique_bounds = []
+        for bound in bounds or []:
+            if bound is not None and (
+                    not unique_bounds or bound != unique_bounds[-1]):
+                unique_bounds.append(bound)
+        return unique_bounds
+
+    def create_shards(self, migrate):
         """
-        Returns a string which represents the SQL query to fetch all of the
+        Creates the shards for the migration run, covering the full range of
         identities.
         """
-        return 'SELECT {column} FROM {table} ORDER BY {column} OFFSET {count}'\
-            .format(
-                column=migrate.column_name, table=migrate.table_name,
-                count=migrate.current)
+        bounds = [None] + [
+            str(bound) for bound in self.get_shard_bounds(migrate)] + [None]
+        IdentityShard.objects.bulk_create(
+            IdentityShard(
+                migrate_subscription=migrate, index=index, lower_bound=lower,
+                upper_bound=upper)
+            for index, (lower, upper) in enumerate(zip(bounds, bounds[1:]))
+        )
+
+    def generate_identity_query(self, migrate, shard=None):
+        """
+        Returns a tuple of (query, params), where query is a string which
+        represents the SQL query to fetch all of the identities that still need
+        to be processed, and params are the parameters for that query. If a
+        shard is given, only the identities in that shard are fetched.
+
+        If we have a checkpoint of the last processed identity, we seek
+        directly past it, so that resuming doesn't need to skip over all of the
+        rows that have already been processed.
+
+        If the run has a filter, only the matching rows are fetched.
+        """
+        checkpoint = migrate if shard is None else shard
+        lower_bound = checkpoint.last_identity
+        if lower_bound is None and shard is not None:
+            lower_bound = shard.lower_bound
+
+        conditions, params = [], []
+        # Snapshots only have the identities that match the filter
+        if migrate.snapshot_table is None:
+            condition, filter_params = self.get_filter_condition(migrate)
+            if condition is not None:
+                conditions.append(condition)
+                params.extend(filter_params)
+        if lower_bound is not None:
+            conditions.append('{column} > %s')
+            params.append(lower_bound)
+        if shard is not None and shard.upper_bound is not None:
+            conditions.append('{column} <= %s')
+            params.append(shard.upper_bound)
+
+        query = 'SELECT {column} FROM {table}'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY {column}'
+        # Runs that were started before we checkpointed the last identity
+        # can only be resumed using the count of processed identities
+        if checkpoint.last_identity is None and checkpoint.current:
+            query += ' OFFSET {count}'
+        table, column = self.get_identity_source(migrate)
+        return (
+            query.format(
+                column=column, table=table, count=checkpoint.current),
+            params)
 
-    def fetch_identities(self, migrate):
+    def fetch_identities(self, migrate, shard=None):
         """
         Creates a server side cursor to fetch identities in chunks. Returns
         a generator that yields the identities.
         """
         cursor_name = '_cur_get_identities_{uuid}'.format(uuid=uuid4().hex)
         conn = connections['identities']
+        query, params = self.generate_identity_query(migrate, shard)
         with transaction.atomic(using='identities'), conn.cursor() as cursor:
             cursor.execute(
                 'DECLARE {cursor_name} CURSOR for {query}'.format(
-                    cursor_name=cursor_name,
-                    query=self.generate_identity_query(migrate)
-                )
-            )
-            while True:
-                cursor.execute(
-                    'FETCH {num} from {cursor}'.format(
-                        num=self.CHUNK_SIZE, cursor=cursor_name))
-                chunk = cursor.fetchall()
-                if not chunk:
-                    break
-                for row in chunk:
-                    yield row[0]
+                    cursor_name=cursor_name, query=query),
+                params)
+            try:
+                while True:
+                    cursor.execute(
+                        'FETCH {num} from {cursor}'.format(
+                            num=self.CHUNK_SIZE, cursor=cursor_name))
+                    chunk = cursor.fetchall()
+                    if not chunk:
+                        break
+                    for row in chunk:
+                        yield row[0]
+            finally:
+                # The cursor stays open until the end of the transaction,
+                # which, inside an outer transaction, would stop the table
+                # that it reads from being dropped
+                cursor.execute('CLOSE {cursor}'.format(cursor=cursor_name))
+
+    def read_identities(self, migrate, state, shard=None):
+        """
+        Starts fetching the identities in a background thread, up to
+        MIGRATION_READ_AHEAD identities ahead of the ones being migrated.
+        Returns an iterator of the identities.
+        """
+        # The reader thread uses this thread's connection, so that it sees the
+        # same data, and we don't have to manage another connection. This
+        # thread doesn't use the connection until the reader is closed.
+        conn = connections['identities']
+        conn.allow_thread_sharing = True
+
+        def setup():
+            connections['identities'] = conn
+
+        if migrate.identity_file:
+            state.identity_file = self.open_identity_file(migrate)
+            identities = iter(state.identity_file)
+        else:
+            identities = self.fetch_identities(migrate, shard)
+        return ReadAhead(
+            identities, settings.MIGRATION_READ_AHEAD, state.pipeline_stats,
+            setup)
+
+    def open_identity_file(self, migrate):
+        """
+        Returns the identities in the file that the run reads from, after the
+        last processed identity.
+        """
+        return IdentityFile(
+            migrate.identity_file.path, offset=migrate.last_offset or 0)
+
+    def estimate_file_identities(self, migrate):
+        """
+        Returns an estimate of the number of identities in the file that the
+        run reads from, from the number of lines in the file.
+        """
+        return IdentityFile(migrate.identity_file.path).count_lines()
+
+    def get_all_results(self, get_page, params=None):
+        """
+        Returns a generator that yields all of the results from the paginated
+        SBM endpoint that `get_page` fetches, following the pagination of the
+        results.
+        """
+        while True:
+            response = get_page(params)
+            for result in response['results']:
+                yield result
+            if not response.get('next'):
+                return
+            params = parse_qs(urlparse(response['next']).query)
+
+    def load_messagesets(self):
+        """
+        Fetches all of the messagesets, so that resolving the messagesets of
+        each subscription that we migrate doesn't need any requests. Any
+        messagesets that are created after this are resolved when they are
+        first used.
+        """
+        self.messagesets = {}
+        self.messagesets_by_short_name = {}
+        for messageset in self.get_all_results(
+                self.sbm_client.get_messagesets):
+            self.messagesets[messageset['id']] = messageset
+            self.messagesets_by_short_name[messageset['short_name']] = \
+                messageset
 
     def get_messageset(self, messageset_id):
         if getattr(self, 'messagesets', None) is None:
@@ -82,114 +557,888 @@ class MigrateSubscriptionsTask(Task):
                 messageset_id)
         return self.messagesets[messageset_id]
 
-    def migrate_identity(self, migrate, identity):
+    def get_messageset_by_short_name(self, short_name):
+        if getattr(self, 'messagesets_by_short_name', None) is None:
+            self.messagesets_by_short_name = {}
+        if short_name not in self.messagesets_by_short_name:
+            self.add_messageset(short_name, self.sbm_client.get_messagesets(
+                params={'short_name': short_name})['results'][0])
+        return self.messagesets_by_short_name[short_name]
+
+    def add_messageset(self, short_name, messageset):
         """
-        Migrates an identity from one messageset to another.
+        Adds a messageset that was fetched by its short name to the resolved
+        messagesets, and returns it.
         """
-        existing_subs = list(self.sbm_client.get_subscriptions({
+        if getattr(self, 'messagesets_by_short_name', None) is None:
+            self.messagesets_by_short_name = {}
+        if getattr(self, 'messagesets', None) is None:
+            self.messagesets = {}
+        self.messagesets_by_short_name[short_name] = messageset
+        self.messagesets.setdefault(messageset['id'], messageset)
+        return messageset
+
+    def get_messageset_length(self, short_name):
+        """
+        Returns the number of messages in the messageset, which is the highest
+        sequence number of its messages.
+        """
+        messageset = self.get_messageset_by_short_name(short_name)
+        return max([
+            message['sequence_number'] for message in self.get_all_results(
+                self.sbm_client.get_messages,
+                {'messageset': messageset['id']})
+        ] or [0])
+
+    def prepare_mapper(self, migrate):
+        """
+        Returns the SequenceMapper for the run. If MIGRATION_VERIFY_MAPPINGS
+        is set, every sequence number of the messageset is first mapped
+        forward and back, using the current lengths of the messagesets, so
+        that a bad mapping stops the run before any identities are migrated,
+        and the mapping of each sequence number is precomputed.
+        """
+        if not settings.MIGRATION_VERIFY_MAPPINGS:
+            return get_mapper(migrate.mapping_version_id)
+        # The lengths of the messagesets can change between runs, so they are
+        # only kept for this run
+        lengths = {}
+
+        def get_length(short_name):
+            if short_name not in lengths:
+                lengths[short_name] = self.get_messageset_length(short_name)
+            return lengths[short_name]
+
+        short_name = self.get_messageset(migrate.from_messageset)['short_name']
+        mapper = registry.get_precomputed(
+            migrate.mapping_version_id, short_name, get_length,
+            settings.MIGRATION_MAPPING_MAX_DRIFT)
+        self.log(
+            migrate, INFO,
+            "Verified the mapping of {num} sequence numbers of {ms}".format(
+                num=get_length(short_name), ms=short_name))
+        return mapper
+
+    def prefetch_subscriptions(self, migrate):
+        """
+        Fetches all of the active subscriptions to the messageset that we're
+        migrating from, and returns a dict mapping each identity to a list of
+        its subscriptions. Only the fields that we need to migrate the
+        subscriptions are kept, to keep the dict as small as possible.
+        """
+        self.log(
+            migrate, INFO, "Prefetching subscriptions to {ms}".format(
+                ms=self.get_messageset(migrate.from_messageset)['short_name']))
+        index = {}
+        count = 0
+        for sub in self.get_all_results(self.sbm_client.get_subscriptions, {
+                'messageset': migrate.from_messageset,
+                'active': True,
+                }):
+            index.setdefault(sub['identity'], []).append(
+                {field: sub[field] for field in self.SUBSCRIPTION_FIELDS})
+            count += 1
+        self.log(
+            migrate, INFO,
+            "Prefetched {count} subscriptions for {num} identities".format(
+                count=count, num=len(index)))
+        return index
+
+    def share_subscriptions(self, migrate):
+        """
+        Prefetches the subscriptions once for all of the shards of the run,
+        and saves them to the run's subscriptions file, replacing the
+        subscriptions from any earlier attempt at the run.
+        """
+        index = self.prefetch_subscriptions(migrate)
+        with tempfile.TemporaryFile() as subscriptions_file:
+            with gzip.GzipFile(fileobj=subscriptions_file, mode='wb') as f:
+                f.write(json.dumps(index).encode('utf-8'))
+            self.delete_shared_subscriptions(migrate)
+            subscriptions_file.seek(0)
+            migrate.subscriptions_file.save(
+                'subscriptions_{id}.json.gz'.format(id=migrate.pk),
+                File(subscriptions_file), save=False)
+        migrate.save(update_fields=('subscriptions_file',))
+
+    def load_shared_subscriptions(self, migrate):
+        """
+        Returns the subscriptions that were prefetched for the shards of the
+        run.
+        """
+        storage = migrate.subscriptions_file.storage
+        with storage.open(migrate.subscriptions_file.name, 'rb') as f:
+            with gzip.GzipFile(fileobj=f, mode='rb') as unzipped:
+                return json.loads(unzipped.read().decode('utf-8'))
+
+    def delete_shared_subscriptions(self, migrate):
+        """
+        Removes the subscriptions that were prefetched for the shards of the
+        run, if there are any.
+        """
+        if not migrate.subscriptions_file:
+            return
+        migrate.subscriptions_file.delete(save=False)
+        migrate.save(update_fields=('subscriptions_file',))
+
+    def get_existing_subscriptions(self, migrate, identity, state=None):
+        """
+        Returns a list of the active subscriptions of the identity to the
+        messageset that we're migrating from.
+        """
+        if state is not None:
+            if state.prefetched_subscriptions is not None:
+                return state.prefetched_subscriptions.get(str(identity), [])
+            if state.lookahead is not None:
+                lookup = state.lookahead.pop(identity)
+                if lookup is not None:
+                    return lookup.get()
+        return self.fetch_existing_subscriptions(migrate, identity)
+
+    def fetch_existing_subscriptions(self, migrate, identity):
+        """
+        Fetches the active subscriptions of the identity to the messageset
+        that we're migrating from.
+        """
+        return list(self.sbm_client.get_subscriptions({
             'identity': identity,
             'messageset': migrate.from_messageset,
             'active': True,
         })['results'])
-        if len(existing_subs) == 0:
-            self.log(
-                migrate, ERROR,
-                "Identity {identity} has no existing subscriptions to {ms}. "
-                "Not migrating identity.".format(
-                    identity=identity, ms=self.get_messageset(
-                        migrate.from_messageset)['short_name'])
-            )
+
+    def load_migrated_identities(self, migrate):
+        """
+        Returns a set of the UUIDs of the identities that have already been
+        migrated on this run.
+        """
+        return set(
+            MigratedIdentity.objects
+            .filter(migrate_subscription=migrate)
+            .values_list('identity_uuid', flat=True)
+            .iterator())
+
+    def load_excluded_identities(self, migrate):
+        """
+        Returns a set of the UUIDs of the identities that the run should
+        exclude. The identities are in a different database, so we can't
+        exclude them in the identities query.
+        """
+        excluded = set()
+        if migrate.exclude_reverted:
+            excluded.update(
+                RevertedIdentity.objects
+                .values_list('identity_uuid', flat=True)
+                .iterator())
+        if migrate.exclude_migrated:
+            excluded.update(
+                MigratedIdentity.objects
+                .filter(
+                    migrate_subscription__created_at__lt=migrate.created_at)
+                .values_list('identity_uuid', flat=True)
+                .iterator())
+        return excluded
+
+    def contains_identity(self, uuids, identity):
+        """
+        Whether the identity is in the set of identity UUIDs.
+        """
+        if not uuids:
+            return False
+        try:
+            return UUID(str(identity)) in uuids
+        except ValueError:
+            return False
+
+    def migrate_identity(self, migrate, identity, state=None, progress=None):
+        """
+        Migrates an identity from one messageset to another. `progress` keeps
+        track of the subscriptions that have been cancelled and migrated, so
+        that if it is from an earlier attempt, the subscriptions that it
+        cancelled are recreated, and the ones that it migrated are skipped.
+        """
+        if progress is None:
+            progress = IdentityProgress()
+        existing_subs = self.check_existing_subscriptions(
+            migrate, identity,
+            self.get_existing_subscriptions(migrate, identity, state),
+            progress, state)
+        if existing_subs is None:
             return
-        elif len(existing_subs) > 1:
-            self.log(
-                migrate, WARNING,
-                "Identity {identity} has {num} subscriptions to {messageset}. "
-                "All will be cancelled.".format(
-                    identity=identity, num=len(existing_subs),
-                    messageset=self.get_messageset(
-                        migrate.from_messageset)['short_name'])
-            )
 
+        # The run keeps using the mapping rules that it was created with
+        mapper = getattr(state, 'mapper', None) or get_mapper(
+            migrate.mapping_version_id)
+        self.recreate_subscriptions(migrate, identity, mapper, progress)
         for sub in existing_subs:
             self.sbm_client.update_subscription(
                 sub['id'], data={'active': False})
-            (messageset, sequence) = map_forward(
-                self.get_messageset(migrate.from_messageset)['short_name'],
-                sub['next_sequence_number'],
-            )
-            messageset_id = self.sbm_client.get_messagesets(
-                params={'short_name': messageset})['results'][0]['id']
-            self.sbm_client.create_subscription({
-                'identity': identity,
-                'messageset': messageset_id,
-                'initial_sequence_number': sequence,
-                'next_sequence_number': sequence,
-                'lang': sub['lang'],
-                'schedule': self.get_messageset(
-                    messageset_id)['default_schedule'],
-            })
-
-        MigratedIdentity.objects.create(
+            progress.cancelled.append(sub)
+            self.recreate_subscriptions(migrate, identity, mapper, progress)
+        self.add_migrated_identity(migrate, identity, state)
+
+    def check_existing_subscriptions(
+            self, migrate, identity, existing_subs, progress, state=None):
+        """
+        Logs anything unusual about the existing subscriptions of the
+        identity, and returns the ones that still need to be cancelled, or
+        None if the identity shouldn't be migrated.
+        """
+        # Prefetched subscriptions don't know about the earlier attempt
+        existing_subs = [
+            sub for sub in existing_subs if not progress.is_started(sub)]
+        if progress.cancelled:
+            self.log_identity(
+                migrate, INFO, identity,
+                "Recreating {num} cancelled subscriptions of identity "
+                "{identity}.",
+                "Recreating the cancelled subscriptions of {count} "
+                "identities.", state=state, num=len(progress.cancelled))
+        elif len(existing_subs) == 0 and not progress.migrated:
+            self.log_identity(
+                migrate, ERROR, identity,
+                "Identity {identity} has no existing subscriptions to {ms}. "
+                "Not migrating identity.",
+                "{count} identities have no existing subscriptions to {ms}. "
+                "Not migrating identities.", state=state,
+                ms=self.get_messageset(migrate.from_messageset)['short_name'])
+            return None
+        elif len(existing_subs) > 1:
+            self.log_identity(
+                migrate, WARNING, identity,
+                "Identity {identity} has {num} subscriptions to {messageset}. "
+                "All will be cancelled.",
+                "{count} identities have {num} subscriptions to "
+                "{messageset}. All will be cancelled.", state=state,
+                num=len(existing_subs),
+                messageset=self.get_messageset(
+                    migrate.from_messageset)['short_name'])
+        return existing_subs
+
+    def add_migrated_identity(self, migrate, identity, state=None):
+        """
+        Records that the identity has been migrated on the run, and forgets
+        its prefetched subscriptions, which have been cancelled, so that the
+        identity isn't migrated again if it is repeated.
+        """
+        migrated = MigratedIdentity(
             migrate_subscription=migrate, identity_uuid=identity)
+        if state is None or state.migrated_identities is None:
+            migrated.save()
+        else:
+            state.migrated_identities.add(migrated)
+        if state is not None and state.prefetched_subscriptions is not None:
+            state.prefetched_subscriptions.pop(str(identity), None)
 
-    def run(self, migrate_subscription_id, **kwargs):
-        migrate = MigrateSubscription.objects.get(pk=migrate_subscription_id)
+    def recreate_subscriptions(self, migrate, identity, mapper, progress):
+        """
+        Creates the subscriptions that the cancelled subscriptions of the
+        identity map to, removing each of them from the progress once it has
+        been created.
+        """
+        while progress.cancelled:
+            sub = progress.cancelled[0]
+            (messageset, sequence) = self.map_subscription(
+                migrate, mapper, sub)
+            self.sbm_client.create_subscription(self.get_new_subscription(
+                identity, self.get_messageset_by_short_name(messageset),
+                sequence, sub))
+            progress.cancelled.pop(0)
+            progress.migrated.add(sub['id'])
+
+    def map_subscription(self, migrate, mapper, sub):
+        """
+        Returns a tuple of (messageset, sequence), the short name of the
+        messageset and the sequence number that the cancelled subscription
+        maps to.
+        """
+        return mapper.map_forward(
+            self.get_messageset(migrate.from_messageset)['short_name'],
+            sub['next_sequence_number'],
+        )
+
+    def get_new_subscription(self, identity, messageset, sequence, sub):
+        """
+        Returns the subscription that the cancelled subscription of the
+        identity maps to, for creating in Stage Based Messaging, given the
+        messageset and sequence number that it maps to.
+        """
+        return {
+            'identity': identity,
+            'messageset': messageset['id'],
+            'initial_sequence_number': sequence,
+            'next_sequence_number': sequence,
+            'lang': sub['lang'],
+            'schedule': self.get_messageset(
+                messageset['id'])['default_schedule'],
+        }
 
+    def migrate_identity_with_retries(
+            self, migrate, identity, state=None, cancelled=None):
+        """
+        Migrates an identity, retrying errors that are signs that Stage Based
+        Messaging is overloaded up to MIGRATION_IDENTITY_RETRIES times, with a
+        jittered exponential backoff. Each retry carries on from where the
+        previous attempt stopped, and `cancelled` are subscriptions that an
+        earlier run cancelled, but didn't recreate. If the identity still
+        can't be migrated, it is recorded as failed, with any subscriptions
+        that are still cancelled, so that the rest of the run can continue.
+        Returns whether the identity was migrated.
+        """
+        progress = IdentityProgress(cancelled)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                self.migrate_identity(migrate, identity, state, progress)
+                return True
+            except (HTTPServiceError, RequestException) as e:
+                if not self.should_retry(e, attempts):
+                    self.record_failure(
+                        migrate, identity, e, attempts, state,
+                        progress.cancelled)
+                    return False
+                time.sleep(self.get_retry_delay(attempts))
+
+    def should_retry(self, error, attempts):
+        """
+        Whether migrating an identity should be attempted again, after the
+        error on its attempt number `attempts`.
+        """
+        return (
+            attempts <= settings.MIGRATION_IDENTITY_RETRIES and
+            is_overloaded(error))
+
+    def get_retry_delay(self, attempts):
+        """
+        Returns the jittered exponential backoff, in seconds, before retrying
+        an identity after its attempt number `attempts`.
+        """
+        delay = settings.MIGRATION_IDENTITY_RETRY_DELAY * 2 ** (attempts - 1)
+        return random.uniform(0, delay) / 1000.0
+
+    def record_failure(
+            self, migrate, identity, error, attempts, state=None,
+            cancelled=None):
+        """
+        Records that the identity couldn't be migrated, so that it can be
+        retried later, along with the subscriptions that were cancelled but
+        not recreated, so that the retry recreates them.
+        """
+        failed = FailedIdentity(
+            migrate_subscription=migrate, identity_uuid=identity,
+            error=force_text(error), attempts=attempts,
+            cancelled_subscriptions=json.dumps(cancelled) if cancelled else '')
+        if state is None or state.failed_identities is None:
+            failed.save()
+        else:
+            state.failed_identities.add(failed)
+        # The full error is kept on the failed identity, the log only has the
+        # reason, so that failures for the same reason get combined
+        response = getattr(error, 'response', None)
+        if response is not None:
+            reason = 'HTTP {code}'.format(code=response.status_code)
+        else:
+            reason = error.__class__.__name__
+        self.log_identity(
+            migrate, ERROR, identity,
+            "Failed to migrate identity {identity} after {attempts} "
+            "attempts: {reason}",
+            "{count} identities failed to migrate after {attempts} attempts: "
+            "{reason}", state=state,
+            attempts=attempts, reason=reason)
+
+    def start_run(self, migrate):
+        """
+        Sets the task ID of the run, and transitions it to the running state.
+        Returns False if the run was not in the starting state, in which case
+        the task should stop.
+        """
         self.log(migrate, INFO, "Setting task ID")
         # Atomically transition to running state, stopping the task if it
         # is not in the starting status
         num = MigrateSubscription.objects.filter(
-            pk=migrate_subscription_id, status=MigrateSubscription.STARTING
+            pk=migrate.pk, status=MigrateSubscription.STARTING
             ).update(
                 task_id=self.request.id, status=MigrateSubscription.RUNNING)
         if num != 1:
             self.log(migrate, INFO, "Stopping task run")
-            return
+            return False
         self.log(
             migrate, INFO,
             "Set task ID to {task_id}".format(task_id=self.request.id))
+        return True
 
-        self.log(migrate, INFO, "Counting identities")
-        migrate.total = self.count_identities(migrate)
-        migrate.save(update_fields=('total',))
+    def run(self, migrate_subscription_id, **kwargs):
+        migrate = MigrateSubscription.objects.get(pk=migrate_subscription_id)
+        if not self.start_run(migrate):
+            return
+
+        state = RunState()
+        if migrate.identity_file:
+            # Counting the identities in a file would mean parsing the whole
+            # file, so we only estimate them from the number of lines
+            migrate.total = self.estimate_file_identities(migrate)
+            migrate.total_is_estimate = True
+            migrate.save(update_fields=('total', 'total_is_estimate'))
+            self.log(
+                migrate, INFO,
+                "Estimated {total} identities".format(total=migrate.total))
+        elif migrate.use_snapshot:
+            # When resuming, we keep using the existing snapshot
+            if migrate.snapshot_table is None:
+                self.log(migrate, INFO, "Creating snapshot of identities")
+                migrate.total = self.create_snapshot(migrate)
+                migrate.total_is_estimate = False
+                migrate.save(update_fields=('total', 'total_is_estimate'))
+                self.log(
+                    migrate, INFO,
+                    "Created snapshot of {total} identities".format(
+                        total=migrate.total))
+        else:
+            # Counting the identities can take a long time, so we start with
+            # an estimate, and replace it with the exact count once it is
+            # complete
+            migrate.total = self.estimate_identities(migrate)
+            migrate.total_is_estimate = True
+            migrate.save(update_fields=('total', 'total_is_estimate'))
+            self.log(
+                migrate, INFO,
+                "Estimated {total} identities".format(total=migrate.total))
+            self.log(migrate, INFO, "Counting identities")
+            state.identity_count = self.count_identities_in_background(
+                migrate)
+
+        completed = False
+        try:
+            if migrate.dry_run:
+                # Planning never changes any subscriptions, so it doesn't need
+                # to be sharded
+                self.log(migrate, INFO, "Planning the migration of identities")
+                completed = self.plan_identities(migrate, state)
+            elif migrate.num_shards > 1:
+                self.dispatch_shards(migrate)
+                self.update_total(migrate, state, wait=True)
+                return
+            else:
+                self.log(migrate, INFO, "Processing identities")
+                completed = self.process_identities(migrate, state=state)
+            if completed:
+                self.update_total(migrate, state, wait=True)
+                self.complete_migration(migrate)
+        finally:
+            # The count is also stopped when the run fails with an error
+            if not completed:
+                self.cancel_count(state)
+
+    def dispatch_shards(self, migrate):
+        """
+        Splits the identities into shards, if that hasn't already been done,
+        and starts a task for each of the shards that isn't complete yet.
+        """
+        if not migrate.shards.exists():
+            self.create_shards(migrate)
+        shards = list(migrate.shards.filter(completed_at__isnull=True))
+        if not shards:
+            self.complete_migration(migrate)
+            return
+        if migrate.prefetch_subscriptions:
+            self.load_messagesets()
+            self.share_subscriptions(migrate)
         self.log(
             migrate, INFO,
-            "Counted {total} identities".format(total=migrate.total))
-
-        self.log(migrate, INFO, "Processing identities")
-        for identity in self.fetch_identities(migrate):
-            # Check to see if the task has been cancelled before each update
-            status = MigrateSubscription.objects.values_list(
-                'status', flat=True).get(pk=migrate_subscription_id)
-            if status != MigrateSubscription.RUNNING:
-                self.log(migrate, INFO, "Stopping task run")
-                return
-            self.migrate_identity(migrate, identity)
-            migrate.current = F('current') + 1
-            migrate.save(update_fields=('current',))
+            "Processing identities in {num} shards".format(num=len(shards)))
+        group(
+            migrate_identity_shard.si(shard.pk) for shard in shards
+        ).apply_async()
 
+    def process_identities(self, migrate, shard=None, state=None):
+        """
+        Migrates all of the remaining identities, or all of the remaining
+        identities in the shard if it is given, keeping the state of the run
+        in `state`. Returns whether all of the identities were processed, or
+        False if the run was stopped.
+
+        Up to MIGRATION_CONCURRENCY identities are migrated at the same time
+        in a pool of threads, or up to MIGRATION_ASYNC_CONCURRENCY with the
+        asyncio engine, but progress is always recorded in the order that the
+        identities were fetched, so that the checkpoint never moves past an
+        identity that hasn't been migrated yet.
+
+        The identities are read in a background thread, and the progress and
+        logs are saved from this thread, with bounded queues between them and
+        the identities being migrated, so that each stage can work while the
+        others are waiting on the network or the database.
+        """
+        if state is None:
+            state = RunState()
+        self.load_messagesets()
+        state.mapper = self.prepare_mapper(migrate)
+        if migrate.prefetch_subscriptions and migrate.subscriptions_file:
+            state.prefetched_subscriptions = self.load_shared_subscriptions(
+                migrate)
+        elif migrate.prefetch_subscriptions:
+            state.prefetched_subscriptions = self.prefetch_subscriptions(
+                migrate)
+
+        state.migrated_identities = BufferedWriter(MigratedIdentity)
+        state.failed_identities = BufferedWriter(FailedIdentity)
+        state.log_events = BufferedWriter(LogEvent)
+        state.identity_logs = LogAggregator()
+        state.pipeline_stats = PipelineStats()
+
+        # Identities can be migrated after the last checkpoint, if the task
+        # stopped before it could save its progress, so we need to skip them
+        # when resuming
+        migrated = self.load_migrated_identities(migrate)
+        if migrated:
+            self.log(
+                migrate, INFO,
+                "Found {num} identities already migrated on this run".format(
+                    num=len(migrated)), state)
+        excluded = self.load_excluded_identities(migrate)
+        if excluded:
+            self.log(
+                migrate, INFO,
+                "Excluding {num} identities from the run".format(
+                    num=len(excluded)), state)
+        previous = None
+
+        concurrency = settings.MIGRATION_CONCURRENCY
+        migrate_identity = self.migrate_identity_with_retries
+        if settings.MIGRATION_ENGINE == 'asyncio':
+            # Only imported when it is used, because it needs Python 3
+            from mapper.async_engine import AsyncEngine
+            concurrency = settings.MIGRATION_ASYNC_CONCURRENCY
+            # Resolved before the run, so that migrating identities in the
+            # event loop never waits for it
+            self.get_messageset(migrate.from_messageset)
+            pool = AsyncEngine(self, concurrency)
+            migrate_identity = pool.migrate_identity_with_retries
+        else:
+            pool = ThreadPool(concurrency) if concurrency > 1 else None
+        # Identities that have been started, with their pool results. Keeping
+        # a backlog of identities for the pool means that its threads stay
+        # busy while the progress is being saved.
+        pending = deque()
+        window = concurrency * 2 if pool is not None else 1
+        progress = Progress()
+        identities = None
+        try:
+            identities = self.read_identities(migrate, state, shard)
+            # The subscriptions of the upcoming identities can be looked up
+            # while the current ones are being migrated. The asyncio engine
+            # already has more lookups in flight than the lookahead would.
+            if (settings.MIGRATION_LOOKAHEAD > 0 and
+                    not migrate.prefetch_subscriptions and
+                    settings.MIGRATION_ENGINE != 'asyncio'):
+                state.lookahead = LookAhead(
+                    identities, settings.MIGRATION_LOOKAHEAD,
+                    partial(self.fetch_existing_subscriptions, migrate),
+                    threads=settings.MIGRATION_LOOKAHEAD_CONCURRENCY,
+                    skip=lambda identity: (
+                        self.contains_identity(migrated, identity) or
+                        self.contains_identity(excluded, identity)))
+            for identity in state.lookahead or identities:
+                if progress.is_due() and state.pipeline_stats.is_due(
+                        settings.MIGRATION_LOG_SUMMARY_INTERVAL):
+                    self.log(migrate, INFO, state.pipeline_stats.report([
+                        ('read', len(identities), identities.size),
+                        ('in flight', len(pending), window),
+                        ('unsaved', progress.count,
+                         settings.MIGRATION_CHECKPOINT_SIZE),
+                    ]), state)
+                # Saving the progress also checks to see if the task has been
+                # cancelled
+                if progress.is_due() and not self.save_progress(
+                        migrate, shard, progress, state):
+                    # Record the identities that have already been started
+                    while pending:
+                        self.finish_identity(
+                            state, progress, *pending.popleft())
+                    self.save_progress(migrate, shard, progress, state)
+                    self.log(migrate, INFO, "Stopping task run", state)
+                    return False
+
+                # Identities are fetched in order, so duplicates are adjacent
+                if identity == previous or self.contains_identity(
+                        migrated, identity):
+                    self.log_identity(
+                        migrate, INFO, identity,
+                        "Identity {identity} has already been migrated on "
+                        "this run. Skipping identity.",
+                        "{count} identities have already been migrated on "
+                        "this run. Skipping identities.", state=state)
+                    pending.append((identity, None, False))
+                elif self.contains_identity(excluded, identity):
+                    pending.append((identity, None, True))
+                elif pool is None:
+                    self.migrate_identity_with_retries(
+                        migrate, identity, state)
+                    pending.append((identity, None, False))
+                else:
+                    pending.append((identity, pool.apply_async(
+                        migrate_identity, (migrate, identity, state)), False))
+                previous = identity
+                if len(pending) >= window:
+                    self.finish_identity(state, progress, *pending.popleft())
+
+            while pending:
+                self.finish_identity(state, progress, *pending.popleft())
+        finally:
+            if identities is not None:
+                identities.close()
+                connections['identities'].allow_thread_sharing = False
+            if state.identity_file is not None:
+                self.log_skipped_lines(migrate, state)
+                state.identity_file = None
+            if pool is not None:
+                # Wait for any identities that are still being migrated
+                pool.close()
+                pool.join()
+            if state.lookahead is not None:
+                # Nothing is waiting on the lookups anymore, so we can cancel
+                # the lookups for identities that won't be migrated
+                state.lookahead.close()
+                state.lookahead = None
+            # Even if there was an error, or the worker is shutting down, we
+            # need to record the identities that were successfully migrated
+            self.save_progress(migrate, shard, progress, state)
+            self.flush_logs(migrate, state, force=True)
+            # Anything logged after processing is saved straight away
+            state.log_events = None
+            state.identity_logs = None
+        return True
+
+    def plan_identities(self, migrate, state):
+        """
+        Plans the migration of all of the identities, without making any
+        changes to subscriptions, and saves the plan to the run's plan file,
+        with a summary of it. Returns whether all of the identities were
+        planned, or False if the run was stopped.
+
+        All of the subscriptions to the messageset are prefetched, and the
+        sequence numbers of each chunk of identities are mapped together.
+        """
+        # Plans always start from the beginning
+        migrate.current = migrate.excluded = 0
+        migrate.last_identity = migrate.last_offset = None
+        MigrateSubscription.objects.filter(pk=migrate.pk).update(
+            current=0, excluded=0, last_identity=None, last_offset=None)
+
+        self.load_messagesets()
+        mapper = self.prepare_mapper(migrate)
+        short_name = self.get_messageset(migrate.from_messageset)['short_name']
+        requests = sbm_limiter.stats()['requests']
+        started = time.time()
+        subscriptions = self.prefetch_subscriptions(migrate)
+        # The projected duration assumes that the requests of the run are as
+        # slow as the requests for the pages of subscriptions
+        latency = (time.time() - started) / max(
+            sbm_limiter.stats()['requests'] - requests, 1)
+        excluded = self.load_excluded_identities(migrate)
+
+        with tempfile.TemporaryFile() as plan_file:
+            plan = MigrationPlan(plan_file)
+            previous = None
+            chunk = []
+            identities = None
+            try:
+                identities = self.read_identities(migrate, state)
+                for identity in identities:
+                    # Identities are fetched in order, so duplicates are
+                    # adjacent
+                    if identity == previous:
+                        continue
+                    previous = identity
+                    if self.contains_identity(excluded, identity):
+                        plan.add_excluded()
+                    else:
+                        chunk.append((identity, subscriptions.get(
+                            str(identity), [])))
+                    if len(chunk) >= self.CHUNK_SIZE:
+                        plan.add_batch(mapper, short_name, chunk)
+                        chunk = []
+                        if not self.save_plan_progress(migrate, plan):
+                            self.log(migrate, INFO, "Stopping task run")
+                            return False
+                plan.add_batch(mapper, short_name, chunk)
+                if not self.save_plan_progress(migrate, plan):
+                    self.log(migrate, INFO, "Stopping task run")
+                    return False
+            finally:
+                if identities is not None:
+                    identities.close()
+                    connections['identities'].allow_thread_sharing = False
+                if state.identity_file is not None:
+                    self.log_skipped_lines(migrate, state)
+                    state.identity_file = None
+                plan.close()
+
+            # Each shard of the run would be processed by its own worker
+            concurrency = min(
+                settings.MIGRATION_CONCURRENCY,
+                settings.STAGE_BASED_MESSAGING_MAX_CONCURRENCY)
+            summary = plan.get_summary(
+                migrate.prefetch_subscriptions, latency,
+                concurrency * migrate.num_shards)
+            if migrate.plan_file:
+                migrate.plan_file.delete(save=False)
+            plan_file.seek(0)
+            migrate.plan_file.save(
+                'plan_{id}.csv.gz'.format(id=migrate.pk), File(plan_file),
+                save=False)
+        migrate.plan_summary = json.dumps(summary)
+        migrate.save(update_fields=('plan_file', 'plan_summary'))
+        self.log_plan_summary(migrate, summary)
+        return True
+
+    def save_plan_progress(self, migrate, plan):
+        """
+        Records how many identities have been planned. Returns whether the run
+        is still running.
+        """
+        return MigrateSubscription.objects.filter(
+            pk=migrate.pk, status=MigrateSubscription.RUNNING).update(
+                current=plan.identities, excluded=plan.excluded) == 1
+
+    def log_plan_summary(self, migrate, summary):
+        self.log(
+            migrate, INFO,
+            "Planned {identities} identities: {subscriptions} subscriptions "
+            "to migrate, {no_subscriptions} identities without subscriptions, "
+            "{multiple_subscriptions} identities with multiple subscriptions, "
+            "{excluded} identities excluded".format(**summary))
+        for messageset, count in sorted(summary['to_messagesets'].items()):
+            self.log(
+                migrate, INFO,
+                "{count} subscriptions would be migrated to {ms}".format(
+                    count=count, ms=messageset))
+        if summary['unmapped']:
+            self.log(
+                migrate, WARNING,
+                "{num} subscriptions have no mapping, and would stop the run"
+                .format(num=summary['unmapped']))
+        self.log(
+            migrate, INFO,
+            "Projected duration of {duration} for {requests} requests".format(
+                duration=timedelta(seconds=summary['projected_seconds']),
+                requests=summary['requests']))
+
+    def log_skipped_lines(self, migrate, state):
+        """
+        Logs the lines of the identity file that were skipped because they
+        weren't identities, or were repeats of earlier identities.
+        """
+        if state.identity_file.invalid:
+            self.log(
+                migrate, WARNING,
+                "Skipped {num} lines of the identity file that aren't "
+                "identity UUIDs".format(num=state.identity_file.invalid),
+                state)
+        if state.identity_file.duplicates:
+            self.log(
+                migrate, INFO,
+                "Skipped {num} repeated identities in the identity file"
+                .format(num=state.identity_file.duplicates), state)
+
+    def finish_identity(self, state, progress, identity, result, excluded):
+        """
+        Waits for the identity to be migrated, raising any error that occurred
+        while migrating it, and then adds it to the progress.
+        """
+        if result is not None:
+            result.get()
+        progress.add(identity, excluded)
+        if state.pipeline_stats is not None:
+            state.pipeline_stats.add('migrated')
+
+    def save_progress(self, migrate, shard, progress, state):
+        """
+        Records the identities that have been processed since the progress was
+        last saved, so that the run can be resumed after them. Returns whether
+        the migration is still running.
+        """
+        # The migrated identities are saved before the checkpoint, so that the
+        # checkpoint never moves past an unrecorded migration
+        if state.migrated_identities is not None:
+            state.migrated_identities.flush()
+        if state.failed_identities is not None:
+            state.failed_identities.flush()
+        self.flush_logs(migrate, state)
+        self.update_total(migrate, state)
+        self.logger.debug(
+            "%(name)s concurrency limit is %(limit)s, with %(in_flight)s "
+            "requests in flight and %(errors)s errors", sbm_limiter.stats())
+        self.logger.debug(
+            "Stage Based Messaging connection pools: %s",
+            clients.describe_pools(self.sbm_client.session))
+
+        running = MigrateSubscription.objects.filter(
+            pk=migrate.pk, status=MigrateSubscription.RUNNING)
+        if progress.count == 0:
+            progress.reset()
+            return running.exists()
+
+        fields = {
+            'current': F('current') + progress.count,
+            'excluded': F('excluded') + progress.excluded,
+        }
+        if shard is None:
+            fields['last_identity'] = str(progress.last_identity)
+            # Identities from a file know where they are in the file
+            offset = getattr(progress.last_identity, 'offset', None)
+            if offset is not None:
+                fields['last_offset'] = offset
+        else:
+            IdentityShard.objects.filter(pk=shard.pk).update(
+                current=F('current') + progress.count,
+                last_identity=str(progress.last_identity))
+        # Only updating the migration if it is still running means that we can
+        # save the progress and check for cancellation in a single query
+        is_running = running.update(**fields) == 1
+        if not is_running:
+            MigrateSubscription.objects.filter(pk=migrate.pk).update(**fields)
+        if state.pipeline_stats is not None:
+            state.pipeline_stats.add('saved', progress.count)
+        progress.reset()
+        return is_running
+
+    def complete_migration(self, migrate):
+        """
+        Marks the run as complete, if all of its shards are complete.
+        """
+        if migrate.shards.filter(completed_at__isnull=True).exists():
+            return
         # Atomically transision to complete state, stopping the task if it
         # is not in the running status
         timestamp = timezone.now()
         num = MigrateSubscription.objects.filter(
-            pk=migrate_subscription_id, status=MigrateSubscription.RUNNING
+            pk=migrate.pk, status=MigrateSubscription.RUNNING
             ).update(
                 completed_at=timestamp,
                 status=MigrateSubscription.COMPLETE)
         if num != 1:
             self.log(migrate, INFO, "Stopping task run")
             return
+        self.drop_snapshot(migrate)
+        self.delete_shared_subscriptions(migrate)
         self.log(
             migrate, INFO,
             "Completed processing identities at {timestamp}".format(
                 timestamp=timestamp))
 
-    def on_failure(self, exc, task_id, args, kwargs, einfo):
+    def get_failed_migration(self, args, kwargs):
+        """
+        Returns the migration run that the failed task was processing.
+        """
         if 'migrate_subscription_id' in kwargs:
             migrate_subscription_id = kwargs['migrate_subscription_id']
         else:
             migrate_subscription_id = args[0]
-        migrate = MigrateSubscription.objects.get(pk=migrate_subscription_id)
+        return MigrateSubscription.objects.get(pk=migrate_subscription_id)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        migrate = self.get_failed_migration(args, kwargs)
 
         self.log(
             migrate, ERROR, "[{class_name}]: {message}.\n{traceback}".format(
@@ -205,3 +1454,79 @@ class MigrateSubscriptionsTask(Task):
 
 
 migrate_subscriptions = MigrateSubscriptionsTask()
+
+
+class MigrateIdentityShardTask(MigrateSubscriptionsTask):
+    """
+    Migrates the identities in a single shard of a sharded migration run.
+    """
+    def run(self, identity_shard_id, **kwargs):
+        shard = IdentityShard.objects.select_related(
+            'migrate_subscription').get(pk=identity_shard_id)
+        migrate = shard.migrate_subscription
+        # The run can have been cancelled while the shard was queued
+        if not MigrateSubscription.objects.filter(
+                pk=migrate.pk, status=MigrateSubscription.RUNNING).exists():
+            self.log(migrate, INFO, "Stopping task run")
+            return
+
+        self.log(
+            migrate, INFO,
+            "Processing shard {index}".format(index=shard.index))
+        if not self.process_identities(migrate, shard):
+            return
+        shard.completed_at = timezone.now()
+        shard.save(update_fields=('completed_at',))
+        self.log(
+            migrate, INFO,
+            "Completed processing shard {index}".format(index=shard.index))
+        self.complete_migration(migrate)
+
+    def get_failed_migration(self, args, kwargs):
+        if 'identity_shard_id' in kwargs:
+            identity_shard_id = kwargs['identity_shard_id']
+        else:
+            identity_shard_id = args[0]
+        return MigrateSubscription.objects.get(shards__pk=identity_shard_id)
+
+
+migrate_identity_shard = MigrateIdentityShardTask()
+
+
+class RetryFailedIdentitiesTask(MigrateSubscriptionsTask):
+    """
+    Retries the identities that failed to migrate on a completed migration
+    run, without reprocessing the rest of the run.
+    """
+    def run(self, migrate_subscription_id, **kwargs):
+        migrate = MigrateSubscription.objects.get(pk=migrate_subscription_id)
+        if not self.start_run(migrate):
+            return
+
+        state = RunState()
+        self.load_messagesets()
+        state.mapper = self.prepare_mapper(migrate)
+        failed_identities = list(migrate.failed_identities.all())
+        self.log(
+            migrate, INFO, "Retrying {num} failed identities".format(
+                num=len(failed_identities)))
+        progress = Progress()
+        for failed in failed_identities:
+            if progress.is_due():
+                progress.reset()
+                if not MigrateSubscription.objects.filter(
+                        pk=migrate.pk,
+                        status=MigrateSubscription.RUNNING).exists():
+                    self.log(migrate, INFO, "Stopping task run")
+                    return
+            # Identities that fail again get recorded with their new error,
+            # so the old failure is only removed once the retry has finished
+            self.migrate_identity_with_retries(
+                migrate, str(failed.identity_uuid), state,
+                failed.get_cancelled_subscriptions())
+            failed.delete()
+            progress.add(failed.identity_uuid)
+        self.complete_migration(migrate)
+
+
+retry_failed_identities = RetryFailedIdentitiesTask()
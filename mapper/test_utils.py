@@ -28,7 +28,7 @@ def mock_get_messageset(messageset_id, messageset_details):
     )
 
 
-def mock_get_subscriptions(subscriptions, querystring=''):
+def mock_get_subscriptions(subscriptions, querystring='', next_page=None):
     responses.add(
         responses.GET,
         '{url}/subscriptions/{querystring}'.format(
@@ -36,7 +36,7 @@ def mock_get_subscriptions(subscriptions, querystring=''):
             querystring=querystring),
         json={
             "count": len(subscriptions),
-            "next": None,
+            "next": next_page,
             "previous": None,
             "results": subscriptions,
         },
@@ -44,6 +44,19 @@ def mock_get_subscriptions(subscriptions, querystring=''):
     )
 
 
+def mock_get_messages(messages, querystring=''):
+    responses.add(
+        responses.GET,
+        '{url}/message/{querystring}'.format(
+            url=settings.STAGE_BASED_MESSAGING_URL, querystring=querystring),
+        json={
+            "count": len(messages),
+            "next": None,
+            "previous": None,
+            "results": messages,
+        }, match_querystring=True)
+
+
 def mock_update_subscription(subscription_id):
     responses.add(
         responses.PATCH,
@@ -249,7 +249,7 @@ class TestRapidproOptoutView(TestCase):
                 })
 
     @responses.activate
-    @mock.patch('mapper.api_views.map_backward')
+    @mock.patch('mapper.sequence_mapper.SequenceMapper.map_backward')
     def test_request_success(self, old_map_backwards):
         """
         If all is in order, all existing active subscriptions for the identity
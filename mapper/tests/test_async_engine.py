@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from demands import HTTPServiceError
+from django.test import TestCase, override_settings
+from django.utils import six
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+from requests import exceptions as requests_exceptions
+from threading import Thread
+from unittest import skipIf
+from uuid import uuid4
+import json
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from mapper.concurrency import AdaptiveLimiter, is_overloaded
+from mapper.models import (
+    FailedIdentity, LogEvent, MigratedIdentity, MigrateSubscription)
+from mapper.tasks import MigrateSubscriptionsTask, migrate_subscriptions
+
+if not six.PY2:
+    import asyncio
+    from mapper.async_engine import AsyncSBMClient
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StandInSBM(object):
+    """
+    A local stand-in for the subscriptions and messageset endpoints of Stage
+    Based Messaging. `subscriptions` is the active subscriptions of each
+    identity, `messagesets` is the messagesets that can be fetched by short
+    name, and `errors` is a list of status codes to respond with, for each
+    path and method, before responding normally. A status code of None drops
+    the connection without a response.
+    """
+    def __init__(self, subscriptions=None, messagesets=None, errors=None):
+        self.subscriptions = subscriptions or {}
+        self.messagesets = messagesets or []
+        self.errors = errors or {}
+        self.created = []
+        self.cancelled = []
+        self.connections = 0
+        stand_in = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                stand_in.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, data=None):
+                body = b'' if data is None else json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(
+                    self.rfile.read(length).decode()) if length else None
+                url = urlparse(self.path)
+                errors = stand_in.errors.get((self.command, url.path))
+                if errors:
+                    status = errors.pop(0)
+                    if status is None:
+                        self.close_connection = True
+                        return
+                    return self.respond(status, {'detail': 'error'})
+                if self.command == 'GET' and url.path.endswith('/messageset/'):
+                    [short_name] = parse_qs(url.query)['short_name']
+                    return self.respond(200, {
+                        'next': None,
+                        'results': [
+                            ms for ms in stand_in.messagesets
+                            if ms['short_name'] == short_name],
+                    })
+                if self.command == 'GET':
+                    [identity] = parse_qs(url.query)['identity']
+                    return self.respond(200, {
+                        'next': None,
+                        'results': stand_in.subscriptions.get(identity, []),
+                    })
+                if self.command == 'PATCH':
+                    stand_in.cancelled.append(
+                        (int(url.path.split('/')[-2]), data))
+                    return self.respond(200, {})
+                stand_in.created.append(data)
+                return self.respond(201, data)
+
+            do_GET = do_PATCH = do_POST = handle_request
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{port}/api/v1'.format(
+            port=self.server.server_address[1])
+        self.thread = Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@skipIf(six.PY2, "The asyncio engine needs Python 3")
+class AsyncSBMClientTest(TestCase):
+    def setUp(self):
+        self.sbm = StandInSBM(
+            subscriptions={'identity1': [{'id': 1}]},
+            errors={('PATCH', '/api/v1/subscriptions/2/'): [503]})
+        self.addCleanup(self.sbm.stop)
+        # The client belongs to the event loop that it is created in
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.limiter = AdaptiveLimiter('test', 1, 20, 1)
+        self.client = AsyncSBMClient(self.sbm.url, 'token', 2, self.limiter)
+        self.addCleanup(self.run_until_complete, self.client.close())
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_requests(self):
+        """
+        The client should make the requests of migrating an identity, reusing
+        its connection for each request.
+        """
+        subs = self.run_until_complete(self.client.get_subscriptions({
+            'identity': 'identity1', 'active': True}))
+        self.run_until_complete(self.client.update_subscription(
+            1, data={'active': False}))
+        created = self.run_until_complete(self.client.create_subscription({
+            'identity': 'a'}))
+
+        self.assertEqual(subs['results'], [{'id': 1}])
+        self.assertEqual(created, {'identity': 'a'})
+        self.assertEqual(self.sbm.cancelled, [(1, {'active': False})])
+        self.assertEqual(self.sbm.created, [{'identity': 'a'}])
+        self.assertEqual(self.client.requests, 3)
+        self.assertEqual(self.client.connections, 1)
+        self.assertEqual(self.sbm.connections, 1)
+        self.assertEqual(self.limiter.requests, 3)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_error(self):
+        """
+        Responses that aren't successful should raise the same errors as the
+        Stage Based Messaging client, so that overloads are retried.
+        """
+        with self.assertRaises(HTTPServiceError) as cm:
+            self.run_until_complete(self.client.update_subscription(
+                2, data={'active': False}))
+        self.assertEqual(cm.exception.response.status_code, 503)
+        self.assertEqual(cm.exception.details, {'detail': 'error'})
+        self.assertTrue(is_overloaded(cm.exception))
+        self.assertEqual(self.limiter.errors, 1)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_limit(self):
+        """
+        Requests should wait for capacity in the limiter.
+        """
+        self.limiter.acquire()
+        request = self.loop.create_task(self.client.get_subscriptions({
+            'identity': 'identity1'}))
+        self.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(request.done())
+        self.assertEqual(self.sbm.connections, 0)
+
+        self.limiter.release(0)
+        subs = self.run_until_complete(request)
+        self.assertEqual(subs['results'], [{'id': 1}])
+
+    def test_retry_idempotent(self):
+        """
+        Requests that are safe to repeat should be retried if the connection
+        fails after they were sent.
+        """
+        self.sbm.errors[('GET', '/api/v1/subscriptions/')] = [None]
+        subs = self.run_until_complete(self.client.get_subscriptions({
+            'identity': 'identity1'}))
+        self.assertEqual(subs['results'], [{'id': 1}])
+        self.assertEqual(self.client.requests, 1)
+        self.assertEqual(self.limiter.requests, 1)
+        self.assertEqual(self.limiter.errors, 0)
+
+    def test_no_retry_not_idempotent(self):
+        """
+        Requests that aren't safe to repeat shouldn't be retried if the
+        connection fails after they were sent.
+        """
+        self.sbm.errors[('POST', '/api/v1/subscriptions/')] = [None]
+        with self.assertRaises(requests_exceptions.ConnectionError):
+            self.run_until_complete(self.client.create_subscription({
+                'identity': 'a'}))
+        self.assertEqual(self.sbm.created, [])
+        self.assertEqual(self.limiter.errors, 1)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+
+@skipIf(six.PY2, "The asyncio engine needs Python 3")
+@override_settings(MIGRATION_ENGINE='asyncio', MIGRATION_ASYNC_CONCURRENCY=3)
+class AsyncEngineTest(TestCase):
+    multi_db = True
+
+    def load_messagesets(self, task):
+        messagesets = [
+            {'id': 1, 'short_name': 'test.gates.messageset.1',
+             'default_schedule': 4},
+            {'id': 2, 'short_name': 'test.gates.messageset.2',
+             'default_schedule': 5},
+        ]
+        task.messagesets = {ms['id']: ms for ms in messagesets}
+        task.messagesets_by_short_name = {
+            ms['short_name']: ms for ms in messagesets}
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run(self, count_identities, fetch_identities):
+        """
+        The asyncio engine should migrate the identities against Stage Based
+        Messaging, with the same migrated and failed identities, logs and
+        progress as the thread engine, retrying overloads.
+        """
+        identities = [str(uuid4()) for _ in range(4)]
+        sub = {'id': 1, 'next_sequence_number': 3, 'lang': 'eng'}
+        sbm = StandInSBM(
+            subscriptions={
+                identities[0]: [sub],
+                identities[2]: [dict(sub, id=3)],
+                identities[3]: [dict(sub, id=4)],
+            },
+            errors={
+                ('PATCH', '/api/v1/subscriptions/3/'): [503],
+                ('PATCH', '/api/v1/subscriptions/4/'): [400],
+            })
+        self.addCleanup(sbm.stop)
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, table_name='table1', column_name='column1')
+        count_identities.return_value = 4
+        fetch_identities.return_value = identities
+
+        with override_settings(STAGE_BASED_MESSAGING_URL=sbm.url), \
+                mock.patch.object(
+                    MigrateSubscriptionsTask, 'load_messagesets',
+                    autospec=True, side_effect=self.load_messagesets):
+            migrate_subscriptions.delay(migrate.pk)
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 4)
+        self.assertEqual(migrate.last_identity, identities[3])
+        self.assertEqual(
+            sorted(sub_id for sub_id, _ in sbm.cancelled), [1, 3])
+        self.assertEqual(sorted(sbm.created, key=lambda s: s['identity']), [{
+            'identity': identity, 'messageset': 2,
+            'initial_sequence_number': 5, 'next_sequence_number': 5,
+            'lang': 'eng', 'schedule': 5,
+        } for identity in sorted(identities[0:3:2])])
+        self.assertEqual(
+            set(str(uuid) for uuid in MigratedIdentity.objects.values_list(
+                'identity_uuid', flat=True)),
+            set(identities[0:3:2]))
+        [failed] = FailedIdentity.objects.all()
+        self.assertEqual(str(failed.identity_uuid), identities[3])
+        self.assertEqual(failed.attempts, 1)
+        self.assertTrue(LogEvent.objects.filter(
+            message__contains='has no existing subscriptions').exists())
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_fetch_messageset(self, count_identities, fetch_identities):
+        """
+        Messagesets that the subscriptions map to, which haven't been fetched
+        yet, should be fetched through the asyncio client, so that the event
+        loop isn't blocked.
+        """
+        identity = str(uuid4())
+        sbm = StandInSBM(
+            subscriptions={identity: [
+                {'id': 1, 'next_sequence_number': 3, 'lang': 'eng'}]},
+            messagesets=[
+                {'id': 2, 'short_name': 'test.gates.messageset.2',
+                 'default_schedule': 5}])
+        self.addCleanup(sbm.stop)
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, table_name='table1', column_name='column1')
+        count_identities.return_value = 1
+        fetch_identities.return_value = [identity]
+
+        def load_messagesets(task):
+            task.messagesets = {1: {
+                'id': 1, 'short_name': 'test.gates.messageset.1',
+                'default_schedule': 4}}
+            task.messagesets_by_short_name = {}
+
+        with override_settings(STAGE_BASED_MESSAGING_URL=sbm.url), \
+                mock.patch.object(
+                    MigrateSubscriptionsTask, 'load_messagesets',
+                    autospec=True, side_effect=load_messagesets), \
+                mock.patch.object(
+                    MigrateSubscriptionsTask, 'sbm_client') as sbm_client:
+            migrate_subscriptions.delay(migrate.pk)
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(sbm.created, [{
+            'identity': identity, 'messageset': 2,
+            'initial_sequence_number': 5, 'next_sequence_number': 5,
+            'lang': 'eng', 'schedule': 5,
+        }])
+        sbm_client.get_messagesets.assert_not_called()
+        sbm_client.get_messageset.assert_not_called()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from requests import Session
+from temba_client.exceptions import (
+    TembaNoSuchObjectError, TembaRateExceededError)
+import responses
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from mapper.clients import (
+    PooledTembaClient, describe_pools, get_sbm_client, mount_pool,
+    pool_stats)
+from mapper.test_utils import mock_get_messageset
+
+
+class ConnectionPoolTests(TestCase):
+    @override_settings(HTTP_POOL_HOSTS=3, HTTP_POOL_SIZE=7, HTTP_RETRIES=2)
+    def test_mount_pool(self):
+        """
+        The session's adapters should use the configured pool sizes and
+        retries.
+        """
+        session = mount_pool(Session())
+        adapter = session.get_adapter('https://example.org/')
+        self.assertIs(session.get_adapter('http://example.org/'), adapter)
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        # Requests that were sent shouldn't be retried if they aren't
+        # idempotent
+        self.assertFalse(adapter.max_retries._is_method_retryable('POST'))
+
+    @override_settings(HTTP_POOL_SIZE=7)
+    def test_pool_stats(self):
+        """
+        Should report the utilisation of each of the connection pools.
+        """
+        session = mount_pool(Session())
+        self.assertEqual(pool_stats(session), [])
+        self.assertEqual(describe_pools(session), "no connections")
+
+        session.get_adapter('http://example.org/').poolmanager\
+            .connection_from_url('http://example.org/')
+        self.assertEqual(pool_stats(session), [{
+            'host': 'example.org',
+            'size': 7,
+            'in_use': 0,
+            'connections': 0,
+            'requests': 0,
+        }])
+        self.assertEqual(
+            describe_pools(session),
+            "example.org 0/7 in use, 0 connections opened, 0 requests")
+
+
+class ClientTests(TestCase):
+    @override_settings(HTTP_CONNECT_TIMEOUT=2, HTTP_READ_TIMEOUT=10)
+    @responses.activate
+    def test_sbm_client(self):
+        """
+        The Stage Based Messaging client should make its requests through a
+        pooled session, with the configured timeouts.
+        """
+        mock_get_messageset(1, {'id': 1, 'short_name': 'messageset'})
+        client = get_sbm_client()
+
+        self.assertEqual(client.session._shared_request_params['timeout'], (
+            2, 10))
+        self.assertEqual(
+            client.session.get_adapter(
+                settings.STAGE_BASED_MESSAGING_URL)._pool_maxsize,
+            settings.HTTP_POOL_SIZE)
+        self.assertEqual(
+            client.get_messageset(1), {'id': 1, 'short_name': 'messageset'})
+
+    @responses.activate
+    def test_rapidpro_client(self):
+        """
+        The Rapidpro client should make its requests through its pooled
+        session, and raise the same errors as the client it extends.
+        """
+        client = PooledTembaClient(
+            settings.RAPIDPRO_URL, settings.RAPIDPRO_TOKEN)
+        client.session.request = mock.Mock(wraps=client.session.request)
+        url = '{}api/v2/contacts.json'.format(settings.RAPIDPRO_URL)
+        responses.add(
+            responses.GET, url, json={'detail': 'Not found'}, status=404)
+        with self.assertRaises(TembaNoSuchObjectError):
+            client.get_contacts().first()
+
+        responses.reset()
+        responses.add(
+            responses.GET, url, json={}, status=429,
+            adding_headers={'Retry-After': '0'})
+        with self.assertRaises(TembaRateExceededError):
+            client.get_contacts().first()
+        self.assertEqual(
+            client.session.get_adapter(url)._pool_maxsize,
+            settings.HTTP_POOL_SIZE)
+        self.assertEqual(client.session.request.call_count, 2)
+        self.assertEqual(
+            client.session.request.call_args[1]['timeout'],
+            (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.test import TestCase
+from functools import partial
+from requests import exceptions as requests_exceptions
+import requests
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from mapper.concurrency import AdaptiveLimiter, LimitedClient, is_overloaded
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests_exceptions.HTTPError(response=response)
+
+
+class IsOverloadedTests(TestCase):
+    def test_rate_limited(self):
+        """
+        Rate limiting and server errors are signs of overload.
+        """
+        self.assertTrue(is_overloaded(http_error(429)))
+        self.assertTrue(is_overloaded(http_error(503)))
+
+    def test_connection_errors(self):
+        """
+        Connection errors and timeouts are signs of overload.
+        """
+        self.assertTrue(is_overloaded(requests_exceptions.ConnectionError()))
+        self.assertTrue(is_overloaded(requests_exceptions.ReadTimeout()))
+
+    def test_client_errors(self):
+        """
+        Client errors, and errors that aren't from requests, are not signs of
+        overload.
+        """
+        self.assertFalse(is_overloaded(http_error(404)))
+        self.assertFalse(is_overloaded(ValueError()))
+
+
+class AdaptiveLimiterTests(TestCase):
+    def test_additive_increase(self):
+        """
+        Fast, successful responses should increase the limit by one for every
+        window of `limit` responses, up to the maximum.
+        """
+        limiter = AdaptiveLimiter('test', 1, 3, 1)
+        for expected in [2, 2, 3, 3, 3, 3]:
+            limiter.acquire()
+            limiter.release(0.1)
+            self.assertEqual(limiter.current_limit, expected)
+
+    def test_multiplicative_decrease(self):
+        """
+        An overload error should halve the limit, down to the minimum.
+        """
+        limiter = AdaptiveLimiter('test', 2, 20, 1)
+        limiter.limit = 16.0
+        limiter.responses_since_backoff = 16
+
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.current_limit, 8)
+        self.assertEqual(limiter.errors, 1)
+        self.assertEqual(limiter.backoffs, 1)
+
+        limiter.limit = 3.0
+        limiter.responses_since_backoff = 3
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.current_limit, 2)
+
+    def test_slow_response(self):
+        """
+        A response slower than the latency threshold should reduce the limit.
+        """
+        limiter = AdaptiveLimiter('test', 1, 20, 1)
+        limiter.limit = 10.0
+        limiter.responses_since_backoff = 10
+
+        limiter.acquire()
+        limiter.release(1.5)
+        self.assertEqual(limiter.current_limit, 5)
+        self.assertEqual(limiter.errors, 0)
+
+    def test_decrease_once_per_window(self):
+        """
+        A burst of errors from the requests of the same window should only
+        reduce the limit once.
+        """
+        limiter = AdaptiveLimiter('test', 1, 20, 1)
+        limiter.limit = 10.0
+        limiter.responses_since_backoff = 10
+
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.current_limit, 5)
+        self.assertEqual(limiter.errors, 4)
+        self.assertEqual(limiter.backoffs, 1)
+
+    def test_request(self):
+        """
+        Requests should be counted while in flight, and errors that are signs
+        of overload should reduce the limit before being raised.
+        """
+        limiter = AdaptiveLimiter('test', 1, 20, 1)
+        limiter.limit = 4.0
+        limiter.responses_since_backoff = 4
+
+        with limiter.request():
+            self.assertEqual(limiter.in_flight, 1)
+        self.assertEqual(limiter.in_flight, 0)
+
+        with self.assertRaises(requests_exceptions.HTTPError):
+            with limiter.request():
+                raise http_error(429)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.current_limit, 2)
+
+    def test_stats(self):
+        """
+        The stats should expose the current limits and counters.
+        """
+        limiter = AdaptiveLimiter('test', 1, 20, 1)
+        with limiter.request():
+            pass
+        self.assertEqual(limiter.stats(), {
+            'name': 'test',
+            'limit': 2,
+            'min_limit': 1,
+            'max_limit': 20,
+            'in_flight': 0,
+            'requests': 1,
+            'errors': 0,
+            'backoffs': 0,
+        })
+
+
+class LimitedClientTests(TestCase):
+    def test_method_calls(self):
+        """
+        Method calls should be passed through to the client, within the
+        limiter, and other attributes should be returned unchanged.
+        """
+        client = mock.MagicMock()
+        client.url = 'http://sbm/'
+        client.get_messageset.return_value = {'id': 1}
+        limiter = AdaptiveLimiter('test', 1, 20, 1)
+        limited = LimitedClient(client, limiter)
+
+        self.assertEqual(limited.get_messageset(1), {'id': 1})
+        client.get_messageset.assert_called_once_with(1)
+        self.assertEqual(limited.url, 'http://sbm/')
+        self.assertEqual(limiter.requests, 1)
+
+    def test_method_metadata(self):
+        """
+        The wrapped methods should keep the name and docstring of the client's
+        methods, and callables without them, like partials, should still be
+        wrapped.
+        """
+        class Client(object):
+            def get_messageset(self, messageset_id):
+                """Gets the messageset."""
+                return {'id': messageset_id}
+
+        client = Client()
+        client.get_partial = partial(client.get_messageset, 2)
+        limited = LimitedClient(client, AdaptiveLimiter('test', 1, 20, 1))
+
+        self.assertEqual(limited.get_messageset.__name__, 'get_messageset')
+        self.assertEqual(
+            limited.get_messageset.__doc__, 'Gets the messageset.')
+        self.assertEqual(limited.get_partial(), {'id': 2})
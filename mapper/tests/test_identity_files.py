@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.test import TestCase
+from uuid import uuid4
+import os
+import tempfile
+
+from mapper.identity_files import IdentityFile
+
+
+class IdentityFileTests(TestCase):
+    def setUp(self):
+        self.uuids = [str(uuid4()) for _ in range(5)]
+
+    def write_file(self, content):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_uuid_per_line(self):
+        """
+        Each line of the file should be an identity, and blank lines should
+        be ignored.
+        """
+        path = self.write_file('\n'.join(self.uuids[:3]) + '\n\n')
+        self.assertEqual(list(IdentityFile(path)), self.uuids[:3])
+
+    def test_csv(self):
+        """
+        For CSV files, the identity is in the first column. The header, and
+        any other lines that aren't identity UUIDs, should be skipped and
+        counted.
+        """
+        path = self.write_file(
+            '\ufeffidentity,name\r\n' +
+            ''.join('"{}",name\r\n'.format(u) for u in self.uuids[:2]) +
+            'unknown,name\r\n')
+        identity_file = IdentityFile(path)
+        self.assertEqual(list(identity_file), self.uuids[:2])
+        self.assertEqual(identity_file.invalid, 2)
+
+    def test_duplicates(self):
+        """
+        Repeats of identities should be skipped and counted, regardless of
+        how the UUID is formatted.
+        """
+        path = self.write_file('\n'.join([
+            self.uuids[0], self.uuids[1], self.uuids[0].upper(),
+            self.uuids[2], self.uuids[1]]))
+        identity_file = IdentityFile(path)
+        self.assertEqual(list(identity_file), self.uuids[:3])
+        self.assertEqual(identity_file.duplicates, 2)
+
+    def test_duplicates_window(self):
+        """
+        Only repeats of the identities in the window of recently read
+        identities should be skipped.
+        """
+        path = self.write_file('\n'.join([
+            self.uuids[0], self.uuids[1], self.uuids[1], self.uuids[2],
+            self.uuids[0]]))
+        identity_file = IdentityFile(path, window=2)
+        self.assertEqual(
+            list(identity_file), self.uuids[:3] + self.uuids[:1])
+        self.assertEqual(identity_file.duplicates, 1)
+
+    def test_offsets(self):
+        """
+        Each identity should have the byte offset just after its line, and
+        reading from that offset should continue with the next identity.
+        """
+        content = ''.join(u + '\n' for u in self.uuids)
+        path = self.write_file(content)
+        identities = list(IdentityFile(path))
+        self.assertEqual(
+            [i.offset for i in identities],
+            [37 * n for n in range(1, 6)])
+        self.assertEqual(
+            list(IdentityFile(path, offset=identities[1].offset)),
+            self.uuids[2:])
+        self.assertEqual(list(IdentityFile(path, offset=len(content))), [])
+
+    def test_chunks(self):
+        """
+        Lines that cross the boundaries between chunks, or are longer than
+        the chunk size, should be read in full.
+        """
+        content = ''.join('{},{}\n'.format(u, 'x' * n) for n, u in enumerate(
+            self.uuids))
+        path = self.write_file(content.rstrip('\n'))
+        for chunk_size in (1, 10, 50, 100):
+            identities = list(IdentityFile(path, chunk_size=chunk_size))
+            self.assertEqual(identities, self.uuids)
+            self.assertEqual(identities[-1].offset, len(content) - 1)
+
+    def test_empty_file(self):
+        """
+        An empty file has no identities.
+        """
+        path = self.write_file('')
+        self.assertEqual(list(IdentityFile(path)), [])
+        self.assertEqual(IdentityFile(path).count_lines(), 0)
+
+    def test_count_lines(self):
+        """
+        Counting the lines should count the last line, even if it doesn't end
+        with a newline.
+        """
+        path = self.write_file('identity\n' + '\n'.join(self.uuids))
+        self.assertEqual(IdentityFile(path, chunk_size=10).count_lines(), 6)
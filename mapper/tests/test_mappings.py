@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase
+from importlib import import_module
+
+from mapper.mappings import MappingRegistry, compile_rules
+from mapper.models import MappingRule, MappingVersion
+from mapper import sequence_mapper
+
+
+class MappingRegistryTests(TestCase):
+    def create_rule(self, **kwargs):
+        rule = MappingRule.objects.create(**kwargs)
+        MappingVersion.create_from_rules()
+        return rule
+
+    def test_compile_rules(self):
+        """
+        The rules should be compiled into the forward and backward mappings
+        of a SequenceMapper.
+        """
+        mapper = compile_rules([{
+            'direction': MappingRule.FORWARD, 'from_messageset': 'a',
+            'start': 1, 'to_messageset': 'b', 'scale': 2, 'divisor': 1,
+            'offset': 0,
+        }, {
+            'direction': MappingRule.BACKWARD, 'from_messageset': 'b',
+            'start': 1, 'to_messageset': 'a', 'scale': 1, 'divisor': 2,
+            'offset': 1,
+        }])
+        self.assertEqual(mapper.map_forward('a', 3), ('b', 6))
+        self.assertEqual(mapper.map_backward('b', 6), ('a', 4))
+        self.assertRaises(
+            sequence_mapper.NoMappingFound, mapper.map_forward, 'b', 3)
+
+    def test_latest_version(self):
+        """
+        Every change to the rules should be a new version, and there is no
+        version until the rules have been changed.
+        """
+        self.assertEqual(MappingVersion.get_latest_id(), None)
+        self.create_rule(from_messageset='a', start=1, to_messageset='b')
+        first = MappingVersion.get_latest_id()
+        self.create_rule(from_messageset='a', start=5, to_messageset='c')
+        second = MappingVersion.get_latest_id()
+        self.assertGreater(second, first)
+        self.assertEqual(
+            len(MappingVersion.objects.get(pk=second).get_rules()),
+            MappingRule.objects.count())
+
+    def test_code_mappings_seeded(self):
+        """
+        The mappings in the code should be seeded as rules, so that a version
+        created from the rules maps the same as the code.
+        """
+        rules = [rule.to_dict() for rule in MappingRule.objects.all()]
+        self.assertEqual(len(rules), 3)
+        mapper = compile_rules(rules)
+        for sequence in range(1, 20):
+            self.assertEqual(
+                mapper.map_forward('test.gates.messageset.1', sequence),
+                sequence_mapper.mapper.map_forward(
+                    'test.gates.messageset.1', sequence))
+            self.assertEqual(
+                mapper.map_backward('test.gates.messageset.2', sequence),
+                sequence_mapper.mapper.map_backward(
+                    'test.gates.messageset.2', sequence))
+
+    def test_seed_code_mappings_new_version(self):
+        """
+        If the rules have already been changed, seeding the mappings in the
+        code should keep the existing rules for their messagesets, and
+        create a new version with the merged rules.
+        """
+        seed = import_module(
+            'mapper.migrations.0022_mappingrule_sequences').seed_code_mappings
+        MappingRule.objects.filter(
+            direction=MappingRule.FORWARD).update(scale=3)
+        MappingRule.objects.filter(direction=MappingRule.BACKWARD).delete()
+        version = MappingVersion.create_from_rules()
+
+        with connection.schema_editor() as schema_editor:
+            seed(apps, schema_editor)
+
+        self.assertGreater(MappingVersion.get_latest_id(), version.pk)
+        rules = MappingVersion.objects.first().get_rules()
+        self.assertEqual(len(rules), 3)
+        self.assertEqual(
+            [r['scale'] for r in rules if r['direction'] == 'F'], [3, 3])
+
+    def test_table_rule(self):
+        """
+        A rule with sequences should be compiled into a table, and round trip
+        with the table mappings in the code.
+        """
+        table = sequence_mapper.Table('b', 2, [4, None, 7])
+        [rule] = sequence_mapper.mappings_to_rules({'a': table})
+        rule['direction'] = MappingRule.FORWARD
+        mapper = compile_rules([rule])
+        self.assertEqual(mapper.map_forward('a', 2), ('b', 4))
+        self.assertEqual(mapper.map_forward('a', 4), ('b', 7))
+        self.assertRaises(
+            sequence_mapper.NoMappingFound, mapper.map_forward, 'a', 3)
+
+        rule = MappingRule.objects.create(
+            from_messageset='a', start=2, to_messageset='b',
+            sequences='[4, null, 7]')
+        self.assertEqual(rule.to_dict()['sequences'], [4, None, 7])
+
+    def test_clean_table_rule(self):
+        """
+        A table rule should have a list of sequence numbers, and be the only
+        rule for its messageset and direction.
+        """
+        rule = MappingRule(
+            from_messageset='a', start=1, to_messageset='b',
+            sequences='[1, "2"]')
+        self.assertRaises(ValidationError, rule.clean)
+        rule.sequences = '[1, null, 2]'
+        rule.clean()
+        rule.save()
+        other = MappingRule(from_messageset='a', start=5, to_messageset='b')
+        self.assertRaises(ValidationError, other.clean)
+        other.from_messageset = 'c'
+        other.clean()
+
+    def test_get(self):
+        """
+        Each version should be compiled the first time it is used, and then
+        used without querying the database. Changing the rules shouldn't
+        change the mappings of existing versions. Without a version, the
+        mappings in the code should be used.
+        """
+        registry = MappingRegistry()
+        self.assertIs(registry.get(None), sequence_mapper.mapper)
+
+        rule = self.create_rule(
+            from_messageset='a', start=1, to_messageset='b', scale=2)
+        version = MappingVersion.get_latest_id()
+        with self.assertNumQueries(1):
+            mapper = registry.get(version)
+        with self.assertNumQueries(0):
+            self.assertIs(registry.get(version), mapper)
+            self.assertEqual(mapper.map_forward('a', 3), ('b', 6))
+
+        rule.scale = 3
+        rule.save()
+        MappingVersion.create_from_rules()
+        self.assertEqual(
+            registry.get(version).map_forward('a', 3), ('b', 6))
+        self.assertEqual(
+            registry.get(MappingVersion.get_latest_id()).map_forward('a', 3),
+            ('b', 9))
+
+    def test_get_precomputed(self):
+        """
+        The precomputed mapping should be reused while the lengths of the
+        messagesets are the same, and verified again if they change.
+        """
+        registry = MappingRegistry()
+        lengths = {
+            'test.gates.messageset.1': 10,
+            'test.gates.messageset.2': 19,
+        }
+        mapper = registry.get_precomputed(
+            None, 'test.gates.messageset.1', lengths.get, 1)
+        self.assertIs(
+            registry.get_precomputed(
+                None, 'test.gates.messageset.1', lengths.get, 1),
+            mapper)
+
+        lengths['test.gates.messageset.1'] = 11
+        lengths['test.gates.messageset.2'] = 21
+        recomputed = registry.get_precomputed(
+            None, 'test.gates.messageset.1', lengths.get, 1)
+        self.assertIsNot(recomputed, mapper)
+        self.assertEqual(
+            recomputed.map_forward('test.gates.messageset.1', 11),
+            ('test.gates.messageset.2', 21))
+
+        lengths['test.gates.messageset.2'] = 20
+        self.assertRaises(
+            sequence_mapper.MappingError, registry.get_precomputed,
+            None, 'test.gates.messageset.1', lengths.get, 1)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from django.db import connections
 from django.test import TestCase
 import logging
 
@@ -20,3 +21,43 @@ class LogEventModelTests(TestCase):
             migrate_subscription=migrate, log_level=logging.INFO,
             message='Test log')
         self.assertEqual(str(l), '{} [Info]: Test log'.format(l.created_at))
+
+
+class MigrateSubscriptionModelTests(TestCase):
+    multi_db = True
+
+    def test_delete_drops_snapshot(self):
+        """
+        Deleting a run should drop its snapshot of the identities.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, status=MigrateSubscription.CANCELLED,
+            table_name='table1', column_name='column1', use_snapshot=True,
+        )
+        migrate.snapshot_table = migrate.get_snapshot_table_name()
+        migrate.save()
+        with connections['identities'].cursor() as cursor:
+            cursor.execute('CREATE TABLE {} (identity TEXT)'.format(
+                migrate.snapshot_table))
+
+        migrate.delete()
+
+        self.assertNotIn(
+            migrate.snapshot_table,
+            connections['identities'].introspection.table_names())
+
+    def test_delete_without_snapshot(self):
+        """
+        Deleting a run without a snapshot shouldn't drop any tables.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        with connections['identities'].cursor() as cursor:
+            cursor.execute('CREATE TABLE table1 (column1 INTEGER)')
+
+        migrate.delete()
+
+        self.assertIn(
+            'table1', connections['identities'].introspection.table_names())
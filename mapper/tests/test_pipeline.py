@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.test import TestCase
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from mapper.pipeline import LookAhead, PipelineStats, ReadAhead
+
+
+class PipelineStatsTests(TestCase):
+    def test_report(self):
+        """
+        The report should include the count and throughput of each stage, and
+        the depth of each queue.
+        """
+        stats = PipelineStats()
+        stats.add('read', 10)
+        stats.add('migrated', 4)
+        stats.add('saved')
+        stats.started_at -= 2
+        with mock.patch('time.time', return_value=stats.started_at + 2):
+            report = stats.report([('read', 6, 10), ('in flight', 2, 2)])
+        self.assertEqual(
+            report,
+            "Identities read 10 (5.0/s), migrated 4 (2.0/s), saved 1 "
+            "(0.5/s). Queues read 6/10, in flight 2/2.")
+
+    def test_is_due(self):
+        """
+        A report should be due once the interval has passed since the last
+        report.
+        """
+        stats = PipelineStats()
+        self.assertFalse(stats.is_due(60))
+        stats.reported_at -= 61
+        self.assertTrue(stats.is_due(60))
+        stats.report([])
+        self.assertFalse(stats.is_due(60))
+
+
+class ReadAheadTests(TestCase):
+    def test_iterate(self):
+        """
+        Should yield all of the items in order, counting them as read, after
+        calling setup in the reading thread.
+        """
+        stats = PipelineStats()
+        setup = mock.MagicMock()
+        reader = ReadAhead(iter(range(100)), 10, stats, setup)
+        self.assertEqual(list(reader), list(range(100)))
+        reader.close()
+        setup.assert_called_once_with()
+        self.assertEqual(stats.counts['read'], 100)
+
+    def test_error(self):
+        """
+        Errors raised while reading should be raised by the iterator, after
+        the items before the error.
+        """
+        def items():
+            yield 1
+            raise ValueError('Test error')
+
+        reader = ReadAhead(items(), 10)
+        result = []
+        with self.assertRaises(ValueError):
+            for item in reader:
+                result.append(item)
+        reader.close()
+        self.assertEqual(result, [1])
+
+    def test_close(self):
+        """
+        Closing the reader should stop it, even if its queue is full, and
+        close the generator that it is reading.
+        """
+        closed = []
+
+        def items():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.append(True)
+
+        reader = ReadAhead(items(), 2)
+        self.assertEqual(next(iter(reader)), 0)
+        reader.close()
+        self.assertFalse(reader.thread.is_alive())
+        self.assertEqual(closed, [True])
+
+
+class LookAheadTests(TestCase):
+    def test_iterate(self):
+        """
+        Should yield all of the items in order, having started the work for
+        up to `size` items ahead of the yielded item, except for skipped
+        items.
+        """
+        started = []
+
+        def items():
+            for i in range(5):
+                started.append(sorted(lookahead.results.keys()))
+                yield i
+
+        lookahead = LookAhead(
+            items(), 2, lambda i: i * 10, skip=lambda i: i == 3)
+        result = []
+        for item in lookahead:
+            lookup = lookahead.pop(item)
+            result.append(lookup.get() if lookup is not None else None)
+        lookahead.close()
+
+        self.assertEqual(result, [0, 10, 20, None, 40])
+        # The first item is only yielded after the two items after it have
+        # been read, so nothing had been popped yet
+        self.assertEqual(started[2], ['0', '1'])
+
+    def test_close(self):
+        """
+        Closing should discard the results that weren't popped.
+        """
+        lookahead = LookAhead(range(5), 2, lambda i: i)
+        next(iter(lookahead))
+        lookahead.close()
+        self.assertEqual(lookahead.results, {})
+        self.assertIsNone(lookahead.pop(1))
+
+    def test_threads(self):
+        """
+        The pool should have `threads` threads, however far ahead it looks,
+        but never more threads than items that it looks ahead.
+        """
+        with mock.patch('mapper.pipeline.ThreadPool') as pool:
+            LookAhead(range(5), 100, lambda i: i, threads=4)
+            pool.assert_called_once_with(4)
+        with mock.patch('mapper.pipeline.ThreadPool') as pool:
+            LookAhead(range(5), 2, lambda i: i, threads=4)
+            pool.assert_called_once_with(2)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.test import TestCase
+import gzip
+import io
+
+from mapper.plans import MigrationPlan
+from mapper.sequence_mapper import mapper
+
+
+class MigrationPlanTests(TestCase):
+    def read_rows(self, fileobj):
+        fileobj.seek(0)
+        with gzip.GzipFile(fileobj=fileobj, mode='rb') as f:
+            return [
+                line.split(',') for line in
+                f.read().decode('utf-8').splitlines()]
+
+    def test_add_batch(self):
+        """
+        Each subscription should be mapped and written to the plan, and the
+        identities without subscriptions, or with multiple subscriptions,
+        should be counted.
+        """
+        fileobj = io.BytesIO()
+        plan = MigrationPlan(fileobj)
+        plan.add_batch(mapper, 'test.gates.messageset.1', [
+            ('identity1', [{'id': 1, 'next_sequence_number': 3}]),
+            ('identity2', []),
+            ('identity3', [
+                {'id': 2, 'next_sequence_number': 1},
+                {'id': 3, 'next_sequence_number': -1},
+            ]),
+        ])
+        plan.add_excluded()
+        plan.close()
+
+        self.assertEqual(self.read_rows(fileobj), [
+            ['identity', 'subscription', 'sequence', 'to_messageset',
+             'to_sequence'],
+            ['identity1', '1', '3', 'test.gates.messageset.2', '5'],
+            ['identity3', '2', '1', 'test.gates.messageset.2', '1'],
+            ['identity3', '3', '-1', '', ''],
+        ])
+        self.assertEqual(plan.get_summary(False, 0.5, 2), {
+            'identities': 4,
+            'excluded': 1,
+            'no_subscriptions': 1,
+            'multiple_subscriptions': 1,
+            'subscriptions': 3,
+            'unmapped': 1,
+            'to_messagesets': {'test.gates.messageset.2': 2},
+            'requests': 9,
+            'projected_seconds': 2,
+        })
+
+    def test_count_requests(self):
+        """
+        Runs that prefetch the subscriptions don't look up the subscriptions
+        of each identity.
+        """
+        plan = MigrationPlan(io.BytesIO())
+        plan.add_batch(mapper, 'test.gates.messageset.1', [
+            ('identity1', [{'id': 1, 'next_sequence_number': 3}]),
+            ('identity2', []),
+        ])
+        self.assertEqual(plan.count_requests(prefetched=False), 4)
+        self.assertEqual(plan.count_requests(prefetched=True), 2)
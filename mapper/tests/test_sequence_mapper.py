@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from array import array
 from django.test import TestCase
 
-from mapper.sequence_mapper import map_forward, map_backward, NoMappingFound
+from mapper.sequence_mapper import (
+    map_forward, map_backward, map_backward_batch, mapper, MappingError,
+    NoMappingFound, PrecomputedMapping, Segment, SequenceMapper, Table)
 
 
 class MapSubscriptionsTest(TestCase):
@@ -37,3 +40,150 @@ class MapSubscriptionsTest(TestCase):
             ms, seq = map_backward('test.gates.messageset.2', seq_from)
             self.assertEqual(ms, 'test.gates.messageset.1')
             self.assertEqual(seq, seq_to)
+
+    def test_segments(self):
+        """
+        Each sequence number should be mapped with the segment that it falls
+        in, and sequence numbers before the first segment have no mapping.
+        """
+        mapper = SequenceMapper(forward={
+            'from': [
+                Segment(10, 'to.late', offset=-9),
+                Segment(1, 'to.early', scale=3, divisor=2),
+            ],
+        }, backward={})
+        self.assertEqual(mapper.map_forward('from', 1), ('to.early', 1))
+        self.assertEqual(mapper.map_forward('from', 9), ('to.early', 13))
+        self.assertEqual(mapper.map_forward('from', 10), ('to.late', 1))
+        self.assertEqual(mapper.map_forward('from', 100), ('to.late', 91))
+        self.assertRaises(NoMappingFound, mapper.map_forward, 'from', 0)
+        self.assertRaises(NoMappingFound, mapper.map_backward, 'to.late', 1)
+
+    def test_table(self):
+        """
+        A table should map each sequence number in it to its entry, and
+        sequence numbers outside the table, or without an entry, have no
+        mapping.
+        """
+        mapper = SequenceMapper(forward={
+            'from': Table('to', 1, [1, 1, None, 2]),
+        }, backward={})
+        self.assertEqual(mapper.map_forward('from', 1), ('to', 1))
+        self.assertEqual(mapper.map_forward('from', 2), ('to', 1))
+        self.assertEqual(mapper.map_forward('from', 4), ('to', 2))
+        self.assertRaises(NoMappingFound, mapper.map_forward, 'from', 0)
+        self.assertRaises(NoMappingFound, mapper.map_forward, 'from', 3)
+        self.assertRaises(NoMappingFound, mapper.map_forward, 'from', 5)
+        self.assertRaises(NoMappingFound, mapper.map_forward, 'from', None)
+
+    def test_map_forward_batch(self):
+        """
+        Mapping a batch should give the same results as mapping each sequence
+        number, with the sequence numbers that have no mapping masked out.
+        """
+        mapper = SequenceMapper(forward={
+            'segments': [Segment(1, 'to', scale=2)],
+            'table': Table('to', 1, [5, None, 7]),
+        }, backward={})
+        sequences = array('l', [0, 1, 2, 3, 4])
+
+        batch = mapper.map_forward_batch('segments', sequences)
+        self.assertEqual(batch.messagesets, [None, 'to', 'to', 'to', 'to'])
+        self.assertEqual(list(batch.sequences), [0, 2, 4, 6, 8])
+        self.assertEqual(list(batch.mask), [0, 1, 1, 1, 1])
+
+        batch = mapper.map_forward_batch('table', sequences)
+        self.assertEqual(batch.messagesets, [None, 'to', None, 'to', None])
+        self.assertEqual(list(batch.sequences), [0, 5, 0, 7, 0])
+        self.assertEqual(list(batch.mask), [0, 1, 0, 1, 0])
+
+        batch = mapper.map_forward_batch('unknown', sequences)
+        self.assertEqual(batch.messagesets, [None] * 5)
+        self.assertEqual(list(batch.mask), [0] * 5)
+
+    def test_map_backward_batch(self):
+        """
+        The default backward mappings should also be available in batches.
+        """
+        batch = map_backward_batch(
+            'test.gates.messageset.2', array('l', [1, 2, 3, 4, 5]))
+        self.assertEqual(
+            batch.messagesets, ['test.gates.messageset.1'] * 5)
+        self.assertEqual(list(batch.sequences), [1, 2, 2, 3, 3])
+        self.assertEqual(list(batch.mask), [1] * 5)
+
+
+class PrecomputeMappingTest(TestCase):
+    lengths = {
+        'test.gates.messageset.1': 10,
+        'test.gates.messageset.2': 19,
+    }
+
+    def test_precompute_forward(self):
+        """
+        The precomputed mapping should map the same as the rules, for the
+        sequence numbers of the messageset, and for any others.
+        """
+        precomputed = mapper.precompute_forward(
+            'test.gates.messageset.1', self.lengths.get)
+        self.assertIsInstance(
+            precomputed.forward['test.gates.messageset.1'],
+            PrecomputedMapping)
+        for sequence in range(0, 15):
+            self.assertEqual(
+                precomputed.map_forward('test.gates.messageset.1', sequence),
+                map_forward('test.gates.messageset.1', sequence))
+        batch = precomputed.map_forward_batch(
+            'test.gates.messageset.1', array('l', [1, 10, 11]))
+        self.assertEqual(list(batch.sequences), [1, 19, 21])
+        # The original mapper is unchanged
+        self.assertNotIsInstance(
+            mapper.forward['test.gates.messageset.1'], PrecomputedMapping)
+
+    def test_precompute_forward_past_end(self):
+        """
+        Sequence numbers that map past the end of the messageset that they
+        map to should be reported.
+        """
+        lengths = dict(self.lengths, **{str('test.gates.messageset.2'): 17})
+        with self.assertRaises(MappingError) as context:
+            mapper.precompute_forward('test.gates.messageset.1', lengths.get)
+        self.assertEqual(
+            str(context.exception),
+            "The mapping for messageset test.gates.messageset.1 has 1 "
+            "problems: test.gates.messageset.1 10 maps to "
+            "test.gates.messageset.2 19, which is past the end of "
+            "test.gates.messageset.2")
+
+    def test_precompute_forward_round_trip(self):
+        """
+        Sequence numbers that can't be mapped back, or map back too far from
+        where they started, should be reported.
+        """
+        drifting = SequenceMapper(forward={
+            'a': [Segment(1, 'b', scale=3)],
+        }, backward={
+            'b': [Segment(4, 'a', divisor=3, offset=2)],
+        })
+        lengths = {'a': 3, 'b': 9}
+        with self.assertRaises(MappingError) as context:
+            drifting.precompute_forward('a', lengths.get)
+        self.assertEqual(
+            str(context.exception),
+            "The mapping for messageset a has 3 problems: a 1 maps to b 3, "
+            "which has no mapping back; a 2 maps to b 6, which maps back to "
+            "a 4; a 3 maps to b 9, which maps back to a 5")
+        with self.assertRaises(MappingError) as context:
+            drifting.precompute_forward('a', lengths.get, max_drift=2)
+        self.assertEqual(
+            str(context.exception),
+            "The mapping for messageset a has 1 problems: a 1 maps to b 3, "
+            "which has no mapping back")
+
+    def test_precompute_forward_no_mapping(self):
+        """
+        Messagesets without a mapping can't be precomputed.
+        """
+        self.assertRaises(
+            MappingError, mapper.precompute_forward, 'unknown',
+            self.lengths.get)
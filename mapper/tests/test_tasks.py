@@ -1,29 +1,51 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from django.db import connections
+from django.db import OperationalError, connections
 from django.conf import settings
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from requests import exceptions as requests_exceptions
 from testfixtures import LogCapture
 from uuid import uuid4
+import gzip
 import json
 import responses
 import logging
+import os
+import requests
+import shutil
+import tempfile
+import time
 try:
     import mock
 except ImportError:
     import unittest.mock as mock
 
-from mapper.models import LogEvent, MigratedIdentity, MigrateSubscription
-from mapper.tasks import migrate_subscriptions
+from mapper.identity_files import IdentityFile
+from mapper.models import (
+    FailedIdentity, IdentityShard, LogEvent, MappingRule, MappingVersion,
+    MigratedIdentity, MigrateSubscription, RevertedIdentity)
+from mapper.tasks import (
+    BackgroundCount, RunState, migrate_identity_shard, migrate_subscriptions,
+    retry_failed_identities)
 from mapper.test_utils import (
     get_calls_to_url, mock_create_subscription, mock_get_subscriptions,
-    mock_get_messageset, mock_update_subscription, mock_get_messagesets)
+    mock_get_messageset, mock_update_subscription, mock_get_messagesets,
+    mock_get_messages)
+from mapper import sequence_mapper
 
 
 class MigrateSubscriptionsTaskTest(TestCase):
     multi_db = True
 
+    def setUp(self):
+        # The task caches the messagesets, so we need to clear the cache to
+        # ensure that the messagesets of one test don't affect another
+        migrate_subscriptions.messagesets = None
+        migrate_subscriptions.messagesets_by_short_name = None
+
     def test_log(self):
         """
         The logging function should create a new LogEvent object, as well as
@@ -63,6 +85,39 @@ class MigrateSubscriptionsTaskTest(TestCase):
 
         self.assertEqual(migrate_subscriptions.count_identities(migrate), 25)
 
+    def test_estimate_identities(self):
+        """
+        The estimate_identities function should return the query planner's
+        estimate of the number of identities.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 TEXT)")
+            # Create the rows that we want
+            for i in range(25):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [str(i)])
+            # Update the planner statistics
+            cursor.execute("ANALYZE table1")
+
+        self.assertEqual(
+            migrate_subscriptions.estimate_identities(migrate), 25)
+
+    def test_estimate_identities_missing_table(self):
+        """
+        If there is no estimate for the table, None should be returned.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        self.assertEqual(
+            migrate_subscriptions.estimate_identities(migrate), None)
+
     def test_fetch_identities(self):
         """
         The fetch_identities function should return all the values of the
@@ -86,17 +141,38 @@ class MigrateSubscriptionsTaskTest(TestCase):
         # 3. Fetch first batch
         # 4. Fetch second batch
         # 5. Fetch third (empty) batch
-        # 6. End transaction/savepoint
-        with self.assertNumQueries(6, using='identities'):
+        # 6. Close cursor
+        # 7. End transaction/savepoint
+        with self.assertNumQueries(7, using='identities'):
             identities = sorted(
                 migrate_subscriptions.fetch_identities(migrate))
         self.assertEqual(identities, list(range(20)))
 
+    def test_background_count_cancel(self):
+        """
+        Cancelling a background count should stop its query.
+        """
+        def count():
+            with connections['identities'].cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(30)')
+
+        started = time.time()
+        background = BackgroundCount(count)
+        while background.connection is None and not background.ready():
+            time.sleep(0.01)
+        # Give the query time to start
+        time.sleep(0.1)
+        background.cancel()
+        with self.assertRaises(OperationalError):
+            background.get()
+        self.assertLess(time.time() - started, 10)
+
     def test_fetch_identities_with_offset(self):
         """
-        When we are resuming processing of identities, we want to resume from
-        where we left off. If `current` is not 0, we should only return
-        the identities that haven't yet been processed
+        When we are resuming processing of identities for a run that has no
+        checkpoint, we want to resume from where we left off. If `current` is
+        not 0, we should only return the identities that haven't yet been
+        processed
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
@@ -113,10 +189,224 @@ class MigrateSubscriptionsTaskTest(TestCase):
             migrate_subscriptions.fetch_identities(migrate))
         self.assertEqual(identities, list(range(10, 20)))
 
+    def test_fetch_identities_with_checkpoint(self):
+        """
+        When we are resuming processing of identities and we have a checkpoint
+        of the last processed identity, we should seek past that identity
+        instead of counting from the start, so that rows inserted before the
+        checkpoint don't shift where we resume from.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', current=10,
+            last_identity='14',
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(20):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+
+        identities = list(migrate_subscriptions.fetch_identities(migrate))
+        self.assertEqual(identities, list(range(15, 20)))
+
+    def test_generate_identity_query_with_checkpoint(self):
+        """
+        If there is a checkpoint, the query should seek past it using a
+        parameter, rather than using an offset.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', current=10,
+            last_identity='abc',
+        )
+        query, params = migrate_subscriptions.generate_identity_query(migrate)
+        self.assertEqual(
+            query,
+            'SELECT column1 FROM table1 WHERE column1 > %s ORDER BY column1')
+        self.assertEqual(params, ['abc'])
+
+    def test_generate_identity_query_with_filter(self):
+        """
+        If the run has a filter, the query should only select the matching
+        rows, using a parameter for the filter value.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            filter_column='cohort', filter_operator='=', filter_value='a',
+            last_identity='abc',
+        )
+        query, params = migrate_subscriptions.generate_identity_query(migrate)
+        self.assertEqual(
+            query,
+            'SELECT column1 FROM table1 WHERE cohort = %s AND column1 > %s '
+            'ORDER BY column1')
+        self.assertEqual(params, ['a', 'abc'])
+
+        migrate.filter_operator = 'IS NULL'
+        query, params = migrate_subscriptions.generate_identity_query(migrate)
+        self.assertEqual(
+            query,
+            'SELECT column1 FROM table1 WHERE cohort IS NULL AND column1 > %s '
+            'ORDER BY column1')
+        self.assertEqual(params, ['abc'])
+
+    def test_get_filter_condition_invalid_operator(self):
+        """
+        Operators that aren't one of the filter operators shouldn't make it
+        into the query.
+        """
+        migrate = MigrateSubscription(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            filter_column='cohort', filter_operator='; DROP TABLE table1',
+        )
+        with self.assertRaises(ValueError):
+            migrate_subscriptions.get_filter_condition(migrate)
+
+    def test_filtered_identities(self):
+        """
+        Fetching, counting and estimating the identities of a run with a
+        filter should only include the rows that match the filter.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            filter_column='cohort', filter_operator='>=', filter_value='15',
+        )
+        with connections['identities'].cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE table1 (column1 INTEGER, cohort INTEGER)")
+            for i in range(25):
+                cursor.execute("INSERT INTO table1 VALUES (%s, %s)", [i, i])
+            cursor.execute("ANALYZE table1")
+
+        self.assertEqual(
+            list(migrate_subscriptions.fetch_identities(migrate)),
+            list(range(15, 25)))
+        self.assertEqual(migrate_subscriptions.count_identities(migrate), 10)
+        self.assertAlmostEqual(
+            migrate_subscriptions.estimate_identities(migrate), 10, delta=2)
+
+    def test_create_snapshot(self):
+        """
+        The create_snapshot function should copy the distinct identities into
+        a snapshot table, which the identities are then fetched from.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', use_snapshot=True,
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want, with duplicates and nulls
+            for i in range(20):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i % 10])
+            cursor.execute("INSERT INTO table1 VALUES (NULL)")
+
+        self.assertEqual(migrate_subscriptions.create_snapshot(migrate), 10)
+        migrate.refresh_from_db()
+        self.assertEqual(
+            migrate.snapshot_table, 'mapper_snapshot_{}'.format(migrate.pk))
+
+        # Changes to the identities table shouldn't affect the snapshot
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("INSERT INTO table1 VALUES (100)")
+        self.assertEqual(
+            list(migrate_subscriptions.fetch_identities(migrate)),
+            list(range(10)))
+
+        migrate_subscriptions.drop_snapshot(migrate)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.snapshot_table, None)
+        self.assertNotIn(
+            'mapper_snapshot_{}'.format(migrate.pk),
+            connections['identities'].introspection.table_names())
+
+    def test_create_shards(self):
+        """
+        The create_shards function should split the identities into ranges
+        that cover all of the identities.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', num_shards=4,
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(1, 21):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+
+        migrate_subscriptions.create_shards(migrate)
+
+        self.assertEqual(
+            [(s.index, s.lower_bound, s.upper_bound)
+             for s in migrate.shards.all()],
+            [(0, None, '5'), (1, '5', '10'), (2, '10', '15'), (3, '15', None)])
+
+    def test_create_shards_duplicate_bounds(self):
+        """
+        If there are more shards than distinct identities, we shouldn't create
+        multiple shards with the same range.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', num_shards=4,
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(20):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i % 2])
+
+        migrate_subscriptions.create_shards(migrate)
+
+        self.assertEqual(
+            [(s.index, s.lower_bound, s.upper_bound)
+             for s in migrate.shards.all()],
+            [(0, None, '0'), (1, '0', '1'), (2, '1', None)])
+
+    def test_fetch_identities_shard(self):
+        """
+        If a shard is specified, only the identities in that shard that
+        haven't yet been processed should be returned.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', num_shards=2,
+        )
+        shard = IdentityShard.objects.create(
+            migrate_subscription=migrate, index=1, lower_bound='5',
+            upper_bound='15')
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(20):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+
+        identities = list(
+            migrate_subscriptions.fetch_identities(migrate, shard))
+        self.assertEqual(identities, list(range(6, 16)))
+
+        shard.last_identity = '10'
+        identities = list(
+            migrate_subscriptions.fetch_identities(migrate, shard))
+        self.assertEqual(identities, list(range(11, 16)))
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run(self, count_identities, fetch_identities, migrate_identity):
+    def test_run(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
         """
         Running the task should call the various functions with correct
         parameters.
@@ -132,299 +422,1815 @@ class MigrateSubscriptionsTaskTest(TestCase):
         migrate_subscriptions.delay(migrate.pk)
 
         count_identities.assert_called_once_with(migrate)
-        fetch_identities.assert_called_once_with(migrate)
+        fetch_identities.assert_called_once_with(migrate, None)
         self.assertEqual(migrate_identity.call_count, 2)
-        migrate_identity.assert_any_call(migrate, 'identity1')
-        migrate_identity.assert_any_call(migrate, 'identity2')
+        migrate_identity.assert_any_call(
+            migrate, 'identity1', mock.ANY, mock.ANY)
+        migrate_identity.assert_any_call(
+            migrate, 'identity2', mock.ANY, mock.ANY)
 
         migrate.refresh_from_db()
         self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
         self.assertNotEqual(migrate.task_id, None)
         self.assertNotEqual(migrate.completed_at, None)
         self.assertEqual(migrate.total, 2)
+        self.assertFalse(migrate.total_is_estimate)
         self.assertEqual(migrate.current, 2)
+        self.assertEqual(migrate.last_identity, 'identity2')
 
-    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @override_settings(MIGRATION_CONCURRENCY=3)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run_failure_args(self, count_identities, log):
+    def test_run_concurrent(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
         """
-        If the task raises an exception, and the migration object was provided
-        in the args, it should create a log object for it and log it, and set
-        the status to error.
+        If the migration concurrency is more than 1, then the identities
+        should be migrated in a thread pool, and the progress should be
+        recorded for all of them.
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
             table_name='table1', column_name='column1',
         )
-
-        def error_effect(migrate):
-            raise Exception('Test error')
-        count_identities.side_effect = error_effect
+        identities = ['identity{}'.format(i) for i in range(10)]
+        count_identities.return_value = 10
+        fetch_identities.return_value = identities
 
         migrate_subscriptions.delay(migrate.pk)
 
-        log_args = log.call_args[0]
-        self.assertEqual(log_args[0], migrate)
-        self.assertEqual(log_args[1], logging.ERROR)
-        self.assertTrue('Exception' in log_args[2])
-        self.assertTrue('Test error' in log_args[2])
+        self.assertEqual(migrate_identity.call_count, 10)
+        for identity in identities:
+            migrate_identity.assert_any_call(
+                migrate, identity, mock.ANY, mock.ANY)
+
         migrate.refresh_from_db()
-        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 10)
+        self.assertEqual(migrate.last_identity, 'identity9')
 
-    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @override_settings(MIGRATION_CONCURRENCY=3)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run_failure_kwargs(self, count_identities, log):
+    def test_run_concurrent_failure(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
         """
-        If the task raises an exception, and the migration object was provided
-        in the kwargs, it should create a log object for it and log it, and set
-        the status to error.
+        If migrating an identity in the thread pool fails, then the migration
+        should be set to the error status, and the progress should only
+        include the identities before the one that failed.
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
             table_name='table1', column_name='column1',
         )
+        count_identities.return_value = 10
+        fetch_identities.return_value = [
+            'identity{}'.format(i) for i in range(10)]
 
-        def error_effect(migrate):
-            raise Exception('Test error')
-        count_identities.side_effect = error_effect
+        def error_effect(migrate, identity, state, progress):
+            if identity == 'identity4':
+                raise Exception('Test error')
+        migrate_identity.side_effect = error_effect
 
-        migrate_subscriptions.delay(migrate_subscription_id=migrate.pk)
+        migrate_subscriptions.delay(migrate.pk)
 
-        log_args = log.call_args[0]
-        self.assertEqual(log_args[0], migrate)
-        self.assertEqual(log_args[1], logging.ERROR)
-        self.assertTrue('Exception' in log_args[2])
-        self.assertTrue('Test error' in log_args[2])
         migrate.refresh_from_db()
         self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+        self.assertEqual(migrate.current, 4)
+        self.assertEqual(migrate.last_identity, 'identity3')
 
-    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run_invalid_status(self, count_identities, log):
+    def test_run_sharded(
+            self, count_identities, migrate_identity, load_messagesets):
         """
-        If the migration is not in the starting status when the task starts,
-        then we should not take any actions.
+        If the migration has multiple shards, then each of the shards should
+        be processed by its own task, which reports its progress to the
+        migration, and the migration should be completed once all the shards
+        are complete.
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
-            table_name='table1', column_name='column1',
-            status=MigrateSubscription.CANCELLED)
+            table_name='table1', column_name='column1', num_shards=2,
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(1, 21):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+        count_identities.return_value = 20
 
         migrate_subscriptions.delay(migrate.pk)
 
-        count_identities.assert_not_called()
-        log.assert_any_call(migrate, logging.INFO, "Stopping task run")
+        self.assertEqual(migrate_identity.call_count, 20)
+        for i in range(1, 21):
+            migrate_identity.assert_any_call(migrate, i, mock.ANY, mock.ANY)
+
+        [shard1, shard2] = migrate.shards.all()
+        self.assertEqual(shard1.current, 10)
+        self.assertEqual(shard1.last_identity, '10')
+        self.assertNotEqual(shard1.completed_at, None)
+        self.assertEqual(shard2.current, 10)
+        self.assertEqual(shard2.last_identity, '20')
+        self.assertNotEqual(shard2.completed_at, None)
+
         migrate.refresh_from_db()
-        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertNotEqual(migrate.completed_at, None)
+        self.assertEqual(migrate.current, 20)
 
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
-    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.prefetch_subscriptions')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run_cancelled_midway(
-            self, count_identities, fetch_identities, migrate_identities):
+    def test_run_sharded_prefetch_subscriptions(
+            self, count_identities, prefetch_subscriptions, migrate_identity,
+            load_messagesets):
         """
-        If a migration is cancelled midway, then we should stop running the
-        task.
+        A sharded run that prefetches subscriptions should prefetch them once,
+        and share them with all of the shards, removing them once the run is
+        complete.
         """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
         migrate = MigrateSubscription.objects.create(
-            from_messageset=1,
-            table_name='table1', column_name='column1')
-
-        count_identities.return_value = 2
-        fetch_identities.return_value = ['identity1', 'identity2']
+            from_messageset=1, prefetch_subscriptions=True,
+            table_name='table1', column_name='column1', num_shards=2,
+        )
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            for i in range(1, 5):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+        count_identities.return_value = 4
+        prefetch_subscriptions.return_value = {
+            str(i): [{'id': i, 'next_sequence_number': 1, 'lang': 'eng'}]
+            for i in range(1, 5)}
+        subscriptions = []
 
-        # By setting the side effect of the migrate identity function to
-        # cancelling the migration, this will have the effect of cancelling
-        # the task when the first identity gets processed.
-        def cancel_migration(*args):
-            migrate.status = MigrateSubscription.CANCELLED
-            migrate.save(update_fields=('status',))
-        migrate_identities.side_effect = cancel_migration
+        def get_subscriptions(migrate, identity, state, progress):
+            subscriptions.append(
+                migrate_subscriptions.get_existing_subscriptions(
+                    migrate, identity, state))
+        migrate_identity.side_effect = get_subscriptions
 
         migrate_subscriptions.delay(migrate.pk)
 
-        count_identities.assert_called_once_with(migrate)
-        fetch_identities.assert_called_once_with(migrate)
-        # Ensure that this is only called once, then the task stopped
-        migrate_identities.assert_called_once_with(migrate, 'identity1')
-
+        prefetch_subscriptions.assert_called_once_with(migrate)
+        self.assertEqual(
+            sorted(sub['id'] for subs in subscriptions for sub in subs),
+            [1, 2, 3, 4])
         migrate.refresh_from_db()
-        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
-        self.assertEqual(migrate.current, 1)
-        self.assertEqual(LogEvent.objects.last().message, "Stopping task run")
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertFalse(migrate.subscriptions_file)
+        self.assertEqual(
+            os.listdir(os.path.join(media_root, 'subscriptions')), [])
 
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
-    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
     @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
-    def test_run_cancelled_after_processing_identities(
-            self, count_identities, fetch_identities, migrate_identities):
+    def test_run_sharded_resume(
+            self, count_identities, migrate_identity, load_messagesets):
         """
-        If a migration is cancelled after processing all the identities, then
-        we should stop running the task.
+        When resuming a sharded migration, only the shards that haven't yet
+        been completed should be processed, from where they left off.
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
-            table_name='table1', column_name='column1')
-
-        count_identities.return_value = 1
-        fetch_identities.return_value = ['identity1']
-
-        # By setting the side effect of the migrate identity function to
-        # cancelling the migration, this will have the effect of cancelling
-        # the task when all the identities have been processed, since we only
-        # have one identity
-        def cancel_migration(*args):
-            migrate.status = MigrateSubscription.CANCELLED
-            migrate.save(update_fields=('status',))
-        migrate_identities.side_effect = cancel_migration
+            table_name='table1', column_name='column1', num_shards=2,
+            current=12,
+        )
+        IdentityShard.objects.create(
+            migrate_subscription=migrate, index=0, upper_bound='10',
+            current=10, last_identity='10', completed_at=timezone.now())
+        IdentityShard.objects.create(
+            migrate_subscription=migrate, index=1, lower_bound='10',
+            current=2, last_identity='12')
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(1, 21):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i])
+        count_identities.return_value = 20
 
         migrate_subscriptions.delay(migrate.pk)
 
-        count_identities.assert_called_once_with(migrate)
-        fetch_identities.assert_called_once_with(migrate)
-        # Ensure that this is only called once, then the task stopped
-        migrate_identities.assert_called_once_with(migrate, 'identity1')
-
+        self.assertEqual(
+            [c[0][1] for c in migrate_identity.call_args_list],
+            list(range(13, 21)))
         migrate.refresh_from_db()
-        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
-        self.assertEqual(migrate.current, 1)
-        self.assertEqual(LogEvent.objects.last().message, "Stopping task run")
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 20)
 
-    @responses.activate
-    def test_migrate_identity_no_existing_subs(self):
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    def test_run_shard_failure(self, fetch_identities, log, load_messagesets):
         """
-        If an identity doesn't have any existing subscriptions to the specified
-        from messageset, then it should be skipped, and the appropriate log
+        If a shard task raises an exception, then the migration that the shard
+        belongs to should be set to the error status.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, status=MigrateSubscription.RUNNING,
+            table_name='table1', column_name='column1', num_shards=2,
+        )
+        shard = IdentityShard.objects.create(
+            migrate_subscription=migrate, index=0)
+        fetch_identities.side_effect = Exception('Test error')
+
+        migrate_identity_shard.delay(shard.pk)
+
+        log_args = log.call_args[0]
+        self.assertEqual(log_args[0], migrate)
+        self.assertEqual(log_args[1], logging.ERROR)
+        self.assertTrue('Test error' in log_args[2])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.process_identities')
+    def test_run_shard_cancelled(self, process_identities):
+        """
+        If the migration was cancelled while the shard task was queued, then
+        the shard shouldn't be processed.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, status=MigrateSubscription.CANCELLED,
+            table_name='table1', column_name='column1', num_shards=2,
+        )
+        shard = IdentityShard.objects.create(
+            migrate_subscription=migrate, index=0)
+
+        migrate_identity_shard.delay(shard.pk)
+
+        process_identities.assert_not_called()
+        shard.refresh_from_db()
+        self.assertIsNone(shard.completed_at)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertTrue(LogEvent.objects.filter(
+            migrate_subscription=migrate,
+            message="Stopping task run").exists())
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_snapshot(
+            self, count_identities, migrate_identity, load_messagesets):
+        """
+        If the migration uses a snapshot, then the snapshot should be created
+        and used for the total and the identities, and removed once the
+        migration is complete.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', use_snapshot=True,
+        )
+        with connections['identities'].cursor() as cursor:
+            # Create the table that we want
+            cursor.execute("CREATE TABLE table1 (column1 INTEGER)")
+            # Create the rows that we want
+            for i in range(10):
+                cursor.execute("INSERT INTO table1 VALUES (%s)", [i % 5])
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count_identities.assert_not_called()
+        self.assertEqual(
+            [c[0][1] for c in migrate_identity.call_args_list],
+            list(range(5)))
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.total, 5)
+        self.assertFalse(migrate.total_is_estimate)
+        self.assertEqual(migrate.current, 5)
+        self.assertEqual(migrate.snapshot_table, None)
+        self.assertNotIn(
+            'mapper_snapshot_{}'.format(migrate.pk),
+            connections['identities'].introspection.table_names())
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.estimate_identities')
+    def test_run_estimated_total(
+            self, estimate_identities, count_identities, fetch_identities,
+            migrate_identity, load_messagesets):
+        """
+        The total should be set to the estimate before any identities are
+        processed, and then replaced by the exact count.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        estimate_identities.return_value = 10
+        count_identities.return_value = 2
+        fetch_identities.return_value = ['identity1', 'identity2']
+        totals = []
+
+        def record_total(migrate, identity, state, progress):
+            totals.append(MigrateSubscription.objects.values_list(
+                'total', 'total_is_estimate').get(pk=migrate.pk))
+        migrate_identity.side_effect = record_total
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertIn((10, True), totals)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.total, 2)
+        self.assertFalse(migrate.total_is_estimate)
+        messages = list(LogEvent.objects.values_list('message', flat=True))
+        self.assertIn('Estimated 10 identities', messages)
+        self.assertIn('Counted 2 identities', messages)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.estimate_identities')
+    def test_run_failure_args(self, estimate_identities, log):
+        """
+        If the task raises an exception, and the migration object was provided
+        in the args, it should create a log object for it and log it, and set
+        the status to error.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+
+        def error_effect(migrate):
+            raise Exception('Test error')
+        estimate_identities.side_effect = error_effect
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        log_args = log.call_args[0]
+        self.assertEqual(log_args[0], migrate)
+        self.assertEqual(log_args[1], logging.ERROR)
+        self.assertTrue('Exception' in log_args[2])
+        self.assertTrue('Test error' in log_args[2])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.estimate_identities')
+    def test_run_failure_kwargs(self, estimate_identities, log):
+        """
+        If the task raises an exception, and the migration object was provided
+        in the kwargs, it should create a log object for it and log it, and set
+        the status to error.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+
+        def error_effect(migrate):
+            raise Exception('Test error')
+        estimate_identities.side_effect = error_effect
+
+        migrate_subscriptions.delay(migrate_subscription_id=migrate.pk)
+
+        log_args = log.call_args[0]
+        self.assertEqual(log_args[0], migrate)
+        self.assertEqual(log_args[1], logging.ERROR)
+        self.assertTrue('Exception' in log_args[2])
+        self.assertTrue('Test error' in log_args[2])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.log')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_invalid_status(self, count_identities, log):
+        """
+        If the migration is not in the starting status when the task starts,
+        then we should not take any actions.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            status=MigrateSubscription.CANCELLED)
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count_identities.assert_not_called()
+        log.assert_any_call(migrate, logging.INFO, "Stopping task run")
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+
+    @override_settings(MIGRATION_CHECKPOINT_SIZE=1)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_cancelled_midway(
+            self, count_identities, fetch_identities, migrate_identities,
+            load_messagesets):
+        """
+        If a migration is cancelled midway, then we should stop running the
+        task.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+
+        count_identities.return_value = 2
+        fetch_identities.return_value = ['identity1', 'identity2']
+
+        # By setting the side effect of the migrate identity function to
+        # cancelling the migration, this will have the effect of cancelling
+        # the task when the first identity gets processed.
+        def cancel_migration(*args):
+            migrate.status = MigrateSubscription.CANCELLED
+            migrate.save(update_fields=('status',))
+        migrate_identities.side_effect = cancel_migration
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count_identities.assert_called_once_with(migrate)
+        fetch_identities.assert_called_once_with(migrate, None)
+        # Ensure that this is only called once, then the task stopped
+        migrate_identities.assert_called_once_with(
+            migrate, 'identity1', mock.ANY, mock.ANY)
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertEqual(migrate.current, 1)
+        self.assertEqual(LogEvent.objects.last().message, "Stopping task run")
+
+    @override_settings(MIGRATION_CHECKPOINT_SIZE=1)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch(
+        'mapper.tasks.MigrateSubscriptionsTask.count_identities_in_background')
+    def test_run_cancelled_cancels_count(
+            self, count_identities_in_background, fetch_identities,
+            migrate_identity, load_messagesets):
+        """
+        If the run is cancelled before the identities have been counted, the
+        count should be cancelled, instead of waited for.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        count = count_identities_in_background.return_value
+        count.ready.return_value = False
+        fetch_identities.return_value = ['identity1', 'identity2']
+
+        def cancel_migration(*args):
+            MigrateSubscription.objects.filter(pk=migrate.pk).update(
+                status=MigrateSubscription.CANCELLED)
+        migrate_identity.side_effect = cancel_migration
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count.cancel.assert_called_once_with()
+        count.get.assert_not_called()
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertTrue(migrate.total_is_estimate)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.prepare_mapper')
+    @mock.patch(
+        'mapper.tasks.MigrateSubscriptionsTask.count_identities_in_background')
+    def test_run_error_cancels_count(
+            self, count_identities_in_background, prepare_mapper,
+            load_messagesets):
+        """
+        If the run fails with an error before the identities have been
+        counted, the count should be cancelled, instead of left running.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        count = count_identities_in_background.return_value
+        prepare_mapper.side_effect = sequence_mapper.MappingError('Bad rule')
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count.cancel.assert_called_once_with()
+        count.get.assert_not_called()
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_cancelled_after_processing_identities(
+            self, count_identities, fetch_identities, migrate_identities,
+            load_messagesets):
+        """
+        If a migration is cancelled after processing all the identities, then
+        we should stop running the task.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+
+        count_identities.return_value = 1
+        fetch_identities.return_value = ['identity1']
+
+        # By setting the side effect of the migrate identity function to
+        # cancelling the migration, this will have the effect of cancelling
+        # the task when all the identities have been processed, since we only
+        # have one identity
+        def cancel_migration(*args):
+            migrate.status = MigrateSubscription.CANCELLED
+            migrate.save(update_fields=('status',))
+        migrate_identities.side_effect = cancel_migration
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        count_identities.assert_called_once_with(migrate)
+        fetch_identities.assert_called_once_with(migrate, None)
+        # Ensure that this is only called once, then the task stopped
+        migrate_identities.assert_called_once_with(
+            migrate, 'identity1', mock.ANY, mock.ANY)
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertEqual(migrate.current, 1)
+        self.assertEqual(LogEvent.objects.last().message, "Stopping task run")
+
+    @responses.activate
+    def test_prefetch_subscriptions(self):
+        """
+        The prefetch_subscriptions function should fetch all pages of the
+        active subscriptions to the from messageset, and return them indexed
+        by identity.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        mock_get_messageset(1, {'short_name': 'from_messageset'})
+        mock_get_subscriptions(
+            [{'id': 1, 'identity': 'identity1', 'next_sequence_number': 1,
+              'lang': 'eng', 'messageset': 1, 'active': True},
+             {'id': 2, 'identity': 'identity2', 'next_sequence_number': 2,
+              'lang': 'eng', 'messageset': 1, 'active': True}],
+            '?messageset=1&active=True',
+            next_page='{}/subscriptions/?messageset=1&active=True&cursor=2'
+            .format(settings.STAGE_BASED_MESSAGING_URL))
+        mock_get_subscriptions(
+            [{'id': 3, 'identity': 'identity1', 'next_sequence_number': 3,
+              'lang': 'afr', 'messageset': 1, 'active': True}],
+            '?messageset=1&active=True&cursor=2')
+
+        subscriptions = migrate_subscriptions.prefetch_subscriptions(migrate)
+
+        self.assertEqual(subscriptions, {
+            'identity1': [
+                {'id': 1, 'next_sequence_number': 1, 'lang': 'eng'},
+                {'id': 3, 'next_sequence_number': 3, 'lang': 'afr'},
+            ],
+            'identity2': [
+                {'id': 2, 'next_sequence_number': 2, 'lang': 'eng'},
+            ],
+        })
+        self.assertEqual(
+            LogEvent.objects.last().message,
+            'Prefetched 3 subscriptions for 2 identities')
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.prefetch_subscriptions')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_prefetch_subscriptions(
+            self, count_identities, prefetch_subscriptions, fetch_identities,
+            migrate_identity, load_messagesets):
+        """
+        If the migration prefetches subscriptions, then the subscriptions
+        should be fetched before processing the identities, and used to look
+        up each identity's subscriptions.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, prefetch_subscriptions=True,
+            table_name='table1', column_name='column1',
+        )
+        count_identities.return_value = 1
+        fetch_identities.return_value = ['identity1']
+        prefetched = {'identity1': [
+            {'id': 1, 'next_sequence_number': 1, 'lang': 'eng'}]}
+        prefetch_subscriptions.return_value = prefetched
+
+        def check_subscriptions(migrate, identity, state, progress):
+            self.assertEqual(
+                migrate_subscriptions.get_existing_subscriptions(
+                    migrate, identity, state),
+                prefetched['identity1'])
+            self.assertEqual(
+                migrate_subscriptions.get_existing_subscriptions(
+                    migrate, 'identity2', state),
+                [])
+        migrate_identity.side_effect = check_subscriptions
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        prefetch_subscriptions.assert_called_once_with(migrate)
+        migrate_identity.assert_called_once_with(
+            migrate, 'identity1', mock.ANY, mock.ANY)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+
+    @override_settings(
+        MIGRATION_CHECKPOINT_SIZE=2, MIGRATION_CHECKPOINT_INTERVAL=60000)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_checkpoint_size(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        The progress should only be saved, and cancellation checked, after
+        every MIGRATION_CHECKPOINT_SIZE identities.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        count_identities.return_value = 5
+        fetch_identities.return_value = [
+            'identity{}'.format(i) for i in range(5)]
+
+        def cancel_migration(*args):
+            MigrateSubscription.objects.filter(pk=migrate.pk).update(
+                status=MigrateSubscription.CANCELLED)
+        migrate_identity.side_effect = cancel_migration
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        # The cancellation is only noticed when the progress is saved
+        self.assertEqual(migrate_identity.call_count, 2)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertEqual(migrate.current, 2)
+        self.assertEqual(migrate.last_identity, 'identity1')
+        self.assertEqual(LogEvent.objects.last().message, "Stopping task run")
+
+    @override_settings(
+        MIGRATION_CHECKPOINT_SIZE=100, MIGRATION_CHECKPOINT_INTERVAL=0)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_checkpoint_interval(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        The progress should be saved, and cancellation checked, if
+        MIGRATION_CHECKPOINT_INTERVAL has passed, even if there are fewer than
+        MIGRATION_CHECKPOINT_SIZE identities to save.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        count_identities.return_value = 5
+        fetch_identities.return_value = [
+            'identity{}'.format(i) for i in range(5)]
+
+        def cancel_migration(*args):
+            MigrateSubscription.objects.filter(pk=migrate.pk).update(
+                status=MigrateSubscription.CANCELLED)
+        migrate_identity.side_effect = cancel_migration
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        migrate_identity.assert_called_once_with(
+            migrate, 'identity0', mock.ANY, mock.ANY)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.CANCELLED)
+        self.assertEqual(migrate.current, 1)
+        self.assertEqual(migrate.last_identity, 'identity0')
+
+    @override_settings(
+        MIGRATION_CHECKPOINT_SIZE=2, MIGRATION_CHECKPOINT_INTERVAL=60000)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_buffers_migrated_identities(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        The MigratedIdentity objects created while processing identities
+        should only be saved when the progress is saved, and all of them
+        should be saved by the end of the run.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        identities = [str(uuid4()) for _ in range(5)]
+        count_identities.return_value = 5
+        fetch_identities.return_value = identities
+
+        saved_counts = []
+
+        states = set()
+
+        def buffer_migrated_identity(migrate, identity, state, progress):
+            saved_counts.append(MigratedIdentity.objects.count())
+            states.add(state)
+            state.migrated_identities.add(MigratedIdentity(
+                migrate_subscription=migrate, identity_uuid=identity))
+        migrate_identity.side_effect = buffer_migrated_identity
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(saved_counts, [0, 0, 2, 2, 4])
+        self.assertEqual(
+            sorted(str(m.identity_uuid)
+                   for m in MigratedIdentity.objects.all()),
+            sorted(identities))
+        # All of the identities of the run should share the state of the run,
+        # and nothing should be left in its buffer
+        [state] = states
+        self.assertEqual(state.migrated_identities.flush(), 0)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_failure_saves_migrated_identities(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        If the run fails, then the buffered MigratedIdentity objects for the
+        identities that were migrated before the failure should be saved.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        identities = [str(uuid4()) for _ in range(3)]
+        count_identities.return_value = 3
+        fetch_identities.return_value = identities
+
+        def buffer_migrated_identity(migrate, identity, state, progress):
+            if identity == identities[2]:
+                raise Exception('Test error')
+            state.migrated_identities.add(MigratedIdentity(
+                migrate_subscription=migrate, identity_uuid=identity))
+        migrate_identity.side_effect = buffer_migrated_identity
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(
+            sorted(str(m.identity_uuid)
+                   for m in MigratedIdentity.objects.all()),
+            sorted(identities[:2]))
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.ERROR)
+        self.assertEqual(migrate.current, 2)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_combines_identity_logs(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        Repeated log messages about individual identities during a run should
+        be saved as a single log event.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1')
+        count_identities.return_value = 3
+        fetch_identities.return_value = [
+            'identity{}'.format(i) for i in range(3)]
+
+        states = set()
+
+        def log_identity(migrate, identity, state, progress):
+            states.add(state)
+            migrate_subscriptions.log_identity(
+                migrate, logging.ERROR, identity,
+                "Identity {identity} has no existing subscriptions to {ms}.",
+                "{count} identities have no existing subscriptions to {ms}.",
+                state=state, ms='from_messageset')
+        migrate_identity.side_effect = log_identity
+
+        with LogCapture() as l:
+            migrate_subscriptions.delay(migrate.pk)
+
+        # Each message should still be logged normally
+        messages = [r.getMessage() for r in l.records]
+        for i in range(3):
+            self.assertIn(
+                'Identity identity{} has no existing subscriptions to '
+                'from_messageset.'.format(i), messages)
+        [log] = LogEvent.objects.filter(log_level=logging.ERROR)
+        self.assertEqual(
+            log.message,
+            '3 identities have no existing subscriptions to from_messageset. '
+            'Identities: identity0, identity1, identity2')
+        # Anything logged after the identities are processed shouldn't be
+        # buffered
+        [state] = states
+        self.assertEqual(state.identity_logs, None)
+        self.assertEqual(state.log_events, None)
+
+    @responses.activate
+    def test_migrate_identity_no_existing_subs(self):
+        """
+        If an identity doesn't have any existing subscriptions to the specified
+        from messageset, then it should be skipped, and the appropriate log
         message should be created.
         """
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
             table_name='table', column_name='column')
-        mock_get_subscriptions(
-            [], '?messageset=1&identity=test-identity&active=True')
-        # To get the messageset name for the log entry
-        mock_get_messageset(1, {'short_name': 'from_messageset'})
+        mock_get_subscriptions(
+            [], '?messageset=1&identity=test-identity&active=True')
+        # To get the messageset name for the log entry
+        mock_get_messageset(1, {'short_name': 'from_messageset'})
+
+        migrate_subscriptions.migrate_identity(migrate, 'test-identity')
+
+        log = LogEvent.objects.last()
+        self.assertEqual(log.log_level, logging.ERROR)
+        self.assertEqual(
+            log.message,
+            'Identity test-identity has no existing subscriptions to '
+            'from_messageset. Not migrating identity.')
+
+    @responses.activate
+    @mock.patch('mapper.sequence_mapper.SequenceMapper.map_forward')
+    def test_migrate_identity_multiple_subscriptions(self, map_forward):
+        """
+        If an identity has multiple subscriptions to the specified from
+        messageset, then a warning should be logged, and all of those
+        messagesets should be disabled. A MigratedIdentity object should also
+        be created.
+        """
+        def new_map_forward(messageset, sequence):
+            return messageset, sequence
+        map_forward.side_effect = new_map_forward
+        uuid = str(uuid4())
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        mock_get_subscriptions(
+            [{'id': 1, 'next_sequence_number': 1, 'lang': 'afr'},
+             {'id': 2, 'next_sequence_number': 2, 'lang': 'eng'}],
+            '?messageset=1&identity={}&active=True'.format(uuid))
+        mock_update_subscription(1)
+        mock_update_subscription(2)
+        # To get the messageset name for the log entry + mapping
+        messagesets = [
+            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
+            {'short_name': 'to_messageset', 'default_schedule': 4, 'id': 2},
+        ]
+        mock_get_messageset(1, messagesets[0])
+        mock_get_messageset(2, messagesets[1])
+        mock_get_messagesets(messagesets[1:2], '?short_name=from_messageset')
+        mock_create_subscription()
+
+        migrate_subscriptions.migrate_identity(migrate, uuid)
+
+        log = LogEvent.objects.last()
+        self.assertEqual(log.log_level, logging.WARNING)
+        self.assertEqual(
+            log.message, 'Identity {} has 2 subscriptions to from_messageset. '
+            'All will be cancelled.'.format(uuid))
+
+        [cancel_sub1] = list(get_calls_to_url(
+            '{url}/subscriptions/{subscription_id}/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
+        self.assertEqual(cancel_sub1.request.method, responses.PATCH)
+        self.assertEqual(
+            json.loads(cancel_sub1.request.body), {'active': False})
+
+        [cancel_sub2] = list(get_calls_to_url(
+            '{url}/subscriptions/{subscription_id}/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=2)))
+        self.assertEqual(cancel_sub2.request.method, responses.PATCH)
+        self.assertEqual(
+            json.loads(cancel_sub2.request.body), {'active': False})
+
+        [migrated_identity] = MigratedIdentity.objects.all()
+        self.assertEqual(migrated_identity.migrate_subscription, migrate)
+        self.assertEqual(str(migrated_identity.identity_uuid), uuid)
+
+    @responses.activate
+    @mock.patch('mapper.sequence_mapper.SequenceMapper.map_forward')
+    def test_migrate_identity_single_subscription(self, map_forward):
+        """
+        If the identity has a single subscription to the from messageset, then
+        that should be cancelled, and a new subscription should be created
+        for the to messageset. A MigratedIdentity object should also be created
+        """
+        def new_map_forward(messageset, sequence):
+            return messageset, sequence
+        map_forward.side_effect = new_map_forward
+        uuid = str(uuid4())
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        mock_get_subscriptions(
+            [{'id': 1, 'next_sequence_number': 5, 'lang': 'eng'}],
+            '?messageset=1&identity={}&active=True'.format(uuid))
+        mock_update_subscription(1)
+        # To get the messageset name for the log entry + mapping
+        messagesets = [
+            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
+            {'short_name': 'to_messageset', 'default_schedule': 4, 'id': 2},
+        ]
+        mock_get_messageset(1, messagesets[0])
+        mock_get_messageset(2, messagesets[1])
+        mock_get_messagesets(messagesets[1:2], '?short_name=from_messageset')
+        mock_create_subscription()
+
+        migrate_subscriptions.migrate_identity(migrate, uuid)
+
+        self.assertEqual(LogEvent.objects.count(), 0)
+
+        [cancel_sub1] = list(get_calls_to_url(
+            '{url}/subscriptions/{subscription_id}/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
+        self.assertEqual(cancel_sub1.request.method, responses.PATCH)
+        self.assertEqual(
+            json.loads(cancel_sub1.request.body), {'active': False})
+
+        [create_sub] = list(get_calls_to_url(
+            '{url}/subscriptions/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
+        self.assertEqual(create_sub.request.method, responses.POST)
+        self.assertEqual(json.loads(create_sub.request.body), {
+            'identity': uuid,
+            'initial_sequence_number': 5,
+            'next_sequence_number': 5,
+            'lang': 'eng',
+            'messageset': 2,
+            'schedule': 4,
+        })
+
+        [migrated_identity] = MigratedIdentity.objects.all()
+        self.assertEqual(migrated_identity.migrate_subscription, migrate)
+        self.assertEqual(str(migrated_identity.identity_uuid), uuid)
+
+    @responses.activate
+    def test_migrate_identity_mapping_version(self):
+        """
+        The sequence numbers should be mapped with the version of the mapping
+        rules that the run is pinned to, even if the rules have changed since.
+        """
+        rule = MappingRule.objects.create(
+            from_messageset='from_messageset', start=1,
+            to_messageset='to_messageset', scale=2)
+        version = MappingVersion.create_from_rules()
+        rule.scale = 3
+        rule.save()
+        MappingVersion.create_from_rules()
+        uuid = str(uuid4())
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column',
+            mapping_version=version)
+        mock_get_subscriptions(
+            [{'id': 1, 'next_sequence_number': 5, 'lang': 'eng'}],
+            '?messageset=1&identity={}&active=True'.format(uuid))
+        mock_update_subscription(1)
+        messagesets = [
+            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
+            {'short_name': 'to_messageset', 'default_schedule': 4, 'id': 2},
+        ]
+        mock_get_messageset(1, messagesets[0])
+        mock_get_messageset(2, messagesets[1])
+        mock_get_messagesets(messagesets[1:2], '?short_name=to_messageset')
+        mock_create_subscription()
+
+        migrate_subscriptions.migrate_identity(migrate, uuid)
+
+        [create_sub] = list(get_calls_to_url(
+            '{url}/subscriptions/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL)))
+        body = json.loads(create_sub.request.body)
+        self.assertEqual(body['messageset'], 2)
+        self.assertEqual(body['next_sequence_number'], 10)
+
+    @responses.activate
+    def test_load_messagesets(self):
+        """
+        The load_messagesets function should fetch all pages of messagesets,
+        and cache them by ID and short name.
+        """
+        messagesets = [
+            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
+            {'short_name': 'to_messageset', 'default_schedule': 5, 'id': 2},
+        ]
+        responses.add(
+            responses.GET,
+            '{}/messageset/'.format(settings.STAGE_BASED_MESSAGING_URL),
+            json={
+                'count': 2,
+                'next': '{}/messageset/?cursor=2'.format(
+                    settings.STAGE_BASED_MESSAGING_URL),
+                'previous': None,
+                'results': messagesets[:1],
+            }, match_querystring=True)
+        mock_get_messagesets(messagesets[1:], '?cursor=2')
+
+        migrate_subscriptions.load_messagesets()
+
+        self.assertEqual(
+            migrate_subscriptions.get_messageset(2), messagesets[1])
+        self.assertEqual(
+            migrate_subscriptions.get_messageset_by_short_name(
+                'from_messageset'),
+            messagesets[0])
+        self.assertEqual(len(responses.calls), 2)
+
+    def mock_messageset_lengths(self, lengths):
+        """
+        Mocks the messagesets, with `lengths` messages in each.
+        """
+        messagesets = [
+            {'short_name': short_name, 'default_schedule': 4, 'id': id}
+            for id, short_name in enumerate(sorted(lengths), start=1)]
+        mock_get_messagesets(messagesets)
+        for messageset in messagesets:
+            mock_get_messages([
+                {'messageset': messageset['id'], 'sequence_number': n}
+                for n in range(1, lengths[messageset['short_name']] + 1)],
+                '?messageset={}'.format(messageset['id']))
+        migrate_subscriptions.load_messagesets()
+
+    @responses.activate
+    @override_settings(MIGRATION_VERIFY_MAPPINGS=True)
+    def test_prepare_mapper(self):
+        """
+        If the mappings are verified, then every sequence number of the
+        messageset should be mapped forward and back using the lengths of the
+        messagesets, and the mapping should be precomputed.
+        """
+        self.mock_messageset_lengths({
+            'test.gates.messageset.1': 10,
+            'test.gates.messageset.2': 19,
+        })
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, table_name='table', column_name='column')
+
+        mapper = migrate_subscriptions.prepare_mapper(migrate)
+
+        self.assertIsInstance(
+            mapper.forward['test.gates.messageset.1'],
+            sequence_mapper.PrecomputedMapping)
+        self.assertEqual(
+            mapper.map_forward('test.gates.messageset.1', 10),
+            ('test.gates.messageset.2', 19))
+        log = LogEvent.objects.last()
+        self.assertEqual(
+            log.message,
+            "Verified the mapping of 10 sequence numbers of "
+            "test.gates.messageset.1")
+
+    @responses.activate
+    @override_settings(MIGRATION_VERIFY_MAPPINGS=True)
+    def test_prepare_mapper_invalid(self):
+        """
+        If a sequence number maps past the end of the messageset that it maps
+        to, then the run shouldn't start.
+        """
+        self.mock_messageset_lengths({
+            'test.gates.messageset.1': 10,
+            'test.gates.messageset.2': 17,
+        })
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, table_name='table', column_name='column')
+
+        self.assertRaises(
+            sequence_mapper.MappingError,
+            migrate_subscriptions.prepare_mapper, migrate)
+
+    def test_prepare_mapper_not_verified(self):
+        """
+        If the mappings aren't verified, then the mapper of the run's mapping
+        version should be used as is.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, table_name='table', column_name='column')
+        self.assertIs(
+            migrate_subscriptions.prepare_mapper(migrate),
+            sequence_mapper.mapper)
+
+    @responses.activate
+    @mock.patch('mapper.sequence_mapper.SequenceMapper.map_forward')
+    def test_migrate_identity_loaded_messagesets(self, map_forward):
+        """
+        If the messagesets have been loaded, then migrating an identity
+        shouldn't make any requests to resolve the messagesets.
+        """
+        map_forward.return_value = ('to_messageset', 3)
+        uuid = str(uuid4())
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        mock_get_messagesets([
+            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
+            {'short_name': 'to_messageset', 'default_schedule': 5, 'id': 2},
+        ])
+        mock_get_subscriptions(
+            [{'id': 1, 'next_sequence_number': 5, 'lang': 'eng'}],
+            '?messageset=1&identity={}&active=True'.format(uuid))
+        mock_update_subscription(1)
+        mock_create_subscription()
+        migrate_subscriptions.load_messagesets()
+
+        migrate_subscriptions.migrate_identity(migrate, uuid)
+
+        self.assertEqual(
+            [r.request.url for r in responses.calls
+             if '/messageset/' in r.request.url],
+            ['{}/messageset/'.format(settings.STAGE_BASED_MESSAGING_URL)])
+        [create_sub] = list(get_calls_to_url(
+            '{url}/subscriptions/'.format(
+                url=settings.STAGE_BASED_MESSAGING_URL)))
+        self.assertEqual(json.loads(create_sub.request.body), {
+            'identity': uuid,
+            'initial_sequence_number': 3,
+            'next_sequence_number': 3,
+            'lang': 'eng',
+            'messageset': 2,
+            'schedule': 5,
+        })
+
+    @override_settings(MIGRATION_IDENTITY_RETRIES=3)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_migrate_identity_with_retries(self, migrate_identity):
+        """
+        If migrating an identity fails with a sign of overload, it should be
+        retried until it succeeds.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        migrate_identity.side_effect = [
+            requests_exceptions.ConnectionError(),
+            requests_exceptions.ConnectionError(),
+            None,
+        ]
+        uuid = str(uuid4())
+
+        self.assertTrue(
+            migrate_subscriptions.migrate_identity_with_retries(
+                migrate, uuid))
+        self.assertEqual(migrate_identity.call_count, 3)
+        self.assertEqual(FailedIdentity.objects.count(), 0)
+
+    @override_settings(MIGRATION_IDENTITY_RETRIES=2)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_migrate_identity_retries_exhausted(self, migrate_identity):
+        """
+        If migrating an identity keeps failing, it should be recorded as a
+        failed identity, and the error should be logged.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        migrate_identity.side_effect = requests_exceptions.ConnectionError(
+            'Connection refused')
+        uuid = str(uuid4())
+
+        self.assertFalse(
+            migrate_subscriptions.migrate_identity_with_retries(
+                migrate, uuid))
+        self.assertEqual(migrate_identity.call_count, 3)
+
+        [failed] = FailedIdentity.objects.all()
+        self.assertEqual(failed.migrate_subscription, migrate)
+        self.assertEqual(str(failed.identity_uuid), uuid)
+        self.assertEqual(failed.attempts, 3)
+        self.assertEqual(failed.error, 'Connection refused')
+
+        log = LogEvent.objects.last()
+        self.assertEqual(log.log_level, logging.ERROR)
+        self.assertEqual(
+            log.message,
+            'Failed to migrate identity {} after 3 attempts: '
+            'ConnectionError'.format(uuid))
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_migrate_identity_client_error(self, migrate_identity):
+        """
+        If migrating an identity fails with an error that isn't a sign of
+        overload, it shouldn't be retried.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        response = requests.Response()
+        response.status_code = 400
+        migrate_identity.side_effect = requests_exceptions.HTTPError(
+            'Bad request', response=response)
+
+        self.assertFalse(
+            migrate_subscriptions.migrate_identity_with_retries(
+                migrate, str(uuid4())))
+        self.assertEqual(migrate_identity.call_count, 1)
+        [failed] = FailedIdentity.objects.all()
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(
+            LogEvent.objects.last().message.split(': ')[-1], 'HTTP 400')
+
+    def mock_sbm_client(self, sbm_client, subscriptions, create_errors):
+        """
+        Sets up the mocked Stage Based Messaging client with the
+        subscriptions of an identity, which are gone once they have been
+        cancelled, and errors for the first attempts to create subscriptions.
+        """
+        cancelled = set()
+        sbm_client.get_subscriptions.side_effect = lambda params: {
+            'results': [
+                sub for sub in subscriptions if sub['id'] not in cancelled]}
+        sbm_client.update_subscription.side_effect = (
+            lambda sub_id, data: cancelled.add(sub_id))
+        sbm_client.create_subscription.side_effect = create_errors + [
+            {}] * len(subscriptions)
+
+    def overloaded_error(self):
+        response = requests.Response()
+        response.status_code = 503
+        return requests_exceptions.HTTPError(response=response)
+
+    @override_settings(MIGRATION_IDENTITY_RETRIES=1)
+    @mock.patch(
+        'mapper.tasks.MigrateSubscriptionsTask.get_messageset_by_short_name')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.get_messageset')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.sbm_client')
+    def test_migrate_identity_retry_recreates_cancelled(
+            self, sbm_client, get_messageset, get_messageset_by_short_name):
+        """
+        If creating the new subscription fails after the old one was
+        cancelled, the retry should create the new subscription, instead of
+        finding no subscriptions to migrate.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        sub = {'id': 1, 'next_sequence_number': 3, 'lang': 'eng'}
+        self.mock_sbm_client(sbm_client, [sub], [self.overloaded_error()])
+        get_messageset.return_value = {
+            'id': 1, 'short_name': 'from_messageset', 'default_schedule': 4}
+        get_messageset_by_short_name.return_value = {'id': 2}
+        state = RunState()
+        state.mapper = mock.Mock()
+        state.mapper.map_forward.return_value = ('to_messageset', 5)
+        uuid = str(uuid4())
+
+        self.assertTrue(
+            migrate_subscriptions.migrate_identity_with_retries(
+                migrate, uuid, state))
+        sbm_client.update_subscription.assert_called_once_with(
+            1, data={'active': False})
+        self.assertEqual(sbm_client.create_subscription.call_count, 2)
+        sbm_client.create_subscription.assert_called_with({
+            'identity': uuid,
+            'messageset': 2,
+            'initial_sequence_number': 5,
+            'next_sequence_number': 5,
+            'lang': 'eng',
+            'schedule': 4,
+        })
+        self.assertEqual(FailedIdentity.objects.count(), 0)
+        self.assertTrue(MigratedIdentity.objects.filter(
+            identity_uuid=uuid).exists())
+
+    @override_settings(MIGRATION_IDENTITY_RETRIES=0)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.prepare_mapper')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch(
+        'mapper.tasks.MigrateSubscriptionsTask.get_messageset_by_short_name')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.get_messageset')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.sbm_client')
+    def test_retry_failed_identity_recreates_cancelled(
+            self, sbm_client, get_messageset, get_messageset_by_short_name,
+            load_messagesets, prepare_mapper):
+        """
+        If an identity fails after its subscriptions were cancelled, the
+        cancelled subscriptions should be recorded with the failure, and
+        recreated when the failed identities are retried.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table', column_name='column')
+        subs = [
+            {'id': 1, 'next_sequence_number': 3, 'lang': 'eng'},
+            {'id': 2, 'next_sequence_number': 4, 'lang': 'afr'},
+        ]
+        self.mock_sbm_client(sbm_client, subs, [{}, self.overloaded_error()])
+        get_messageset.return_value = {
+            'id': 1, 'short_name': 'from_messageset', 'default_schedule': 4}
+        get_messageset_by_short_name.return_value = {'id': 2}
+        mapper = mock.Mock()
+        mapper.map_forward.side_effect = (
+            lambda messageset, sequence: ('to_messageset', sequence))
+        prepare_mapper.return_value = mapper
+        state = RunState()
+        state.mapper = mapper
+        uuid = str(uuid4())
 
-        migrate_subscriptions.migrate_identity(migrate, 'test-identity')
+        migrate_subscriptions.migrate_identity_with_retries(
+            migrate, uuid, state)
+        [failed] = FailedIdentity.objects.all()
+        self.assertEqual(failed.get_cancelled_subscriptions(), [subs[1]])
 
-        log = LogEvent.objects.last()
-        self.assertEqual(log.log_level, logging.ERROR)
+        MigrateSubscription.objects.filter(pk=migrate.pk).update(
+            status=MigrateSubscription.STARTING)
+        retry_failed_identities.delay(migrate.pk)
+
+        # Each subscription is only cancelled and recreated once
+        self.assertEqual(sbm_client.update_subscription.call_count, 2)
         self.assertEqual(
-            log.message,
-            'Identity test-identity has no existing subscriptions to '
-            'from_messageset. Not migrating identity.')
+            [c[0][0]['next_sequence_number'] for c in
+             sbm_client.create_subscription.call_args_list],
+            [3, 4, 4])
+        self.assertEqual(FailedIdentity.objects.count(), 0)
+        self.assertTrue(MigratedIdentity.objects.filter(
+            identity_uuid=uuid).exists())
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
 
-    @responses.activate
-    @mock.patch('mapper.tasks.map_forward')
-    def test_migrate_identity_multiple_subscriptions(self, map_forward):
+    @override_settings(MIGRATION_IDENTITY_RETRIES=0)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_failed_identities(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
         """
-        If an identity has multiple subscriptions to the specified from
-        messageset, then a warning should be logged, and all of those
-        messagesets should be disabled. A MigratedIdentity object should also
-        be created.
+        If an identity fails to migrate, the run should continue with the
+        rest of the identities, and complete with the identity recorded as
+        failed.
         """
-        def new_map_forward(messageset, sequence):
-            return messageset, sequence
-        map_forward.side_effect = new_map_forward
-        uuid = str(uuid4())
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
-            table_name='table', column_name='column')
-        mock_get_subscriptions(
-            [{'id': 1, 'next_sequence_number': 1, 'lang': 'afr'},
-             {'id': 2, 'next_sequence_number': 2, 'lang': 'eng'}],
-            '?messageset=1&identity={}&active=True'.format(uuid))
-        mock_update_subscription(1)
-        mock_update_subscription(2)
-        # To get the messageset name for the log entry + mapping
-        messagesets = [
-            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
-            {'short_name': 'to_messageset', 'default_schedule': 4, 'id': 2},
-        ]
-        mock_get_messageset(1, messagesets[0])
-        mock_get_messageset(2, messagesets[1])
-        mock_get_messagesets(messagesets[1:2], '?short_name=from_messageset')
-        mock_create_subscription()
+            table_name='table1', column_name='column1',
+        )
+        count_identities.return_value = 5
+        identities = [str(uuid4()) for _ in range(5)]
+        fetch_identities.return_value = identities
 
-        migrate_subscriptions.migrate_identity(migrate, uuid)
+        def error_effect(migrate, identity, state, progress):
+            if identity == identities[2]:
+                raise requests_exceptions.ConnectionError()
+        migrate_identity.side_effect = error_effect
 
-        log = LogEvent.objects.last()
-        self.assertEqual(log.log_level, logging.WARNING)
+        migrate_subscriptions.delay(migrate.pk)
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 5)
         self.assertEqual(
-            log.message, 'Identity {} has 2 subscriptions to from_messageset. '
-            'All will be cancelled.'.format(uuid))
+            [str(f.identity_uuid) for f in migrate.failed_identities.all()],
+            [identities[2]])
+
+    @override_settings(MIGRATION_IDENTITY_RETRIES=0)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_retry_failed_identities(self, migrate_identity, load_messagesets):
+        """
+        Retrying the failed identities of a run should only migrate those
+        identities, keep the ones that fail again, and complete the run.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            status=MigrateSubscription.STARTING, current=10, total=10,
+        )
+        [uuid1, uuid2] = [uuid4(), uuid4()]
+        FailedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid1, error='Error')
+        FailedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid2, error='Error')
+
+        def error_effect(migrate, identity, state, progress):
+            if identity == str(uuid2):
+                raise requests_exceptions.ConnectionError('New error')
+        migrate_identity.side_effect = error_effect
+
+        retry_failed_identities.delay(migrate.pk)
 
-        [cancel_sub1] = list(get_calls_to_url(
-            '{url}/subscriptions/{subscription_id}/'.format(
-                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
-        self.assertEqual(cancel_sub1.request.method, responses.PATCH)
         self.assertEqual(
-            json.loads(cancel_sub1.request.body), {'active': False})
+            [c[0][1] for c in migrate_identity.call_args_list],
+            [str(uuid1), str(uuid2)])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 10)
+        [failed] = migrate.failed_identities.all()
+        self.assertEqual(failed.identity_uuid, uuid2)
+        self.assertEqual(failed.error, 'New error')
+
+    def test_load_migrated_identities(self):
+        """
+        Should return the UUIDs of the identities migrated on the run, and not
+        those of other runs.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        other = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        uuid1, uuid2 = uuid4(), uuid4()
+        MigratedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid1)
+        MigratedIdentity.objects.create(
+            migrate_subscription=other, identity_uuid=uuid2)
+
+        migrated = migrate_subscriptions.load_migrated_identities(migrate)
+        self.assertEqual(migrated, set([uuid1]))
+        self.assertTrue(migrate_subscriptions.contains_identity(
+            migrated, str(uuid1)))
+        self.assertFalse(migrate_subscriptions.contains_identity(
+            migrated, str(uuid2)))
+        self.assertFalse(migrate_subscriptions.contains_identity(
+            migrated, 'not-a-uuid'))
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_skips_migrated_identities(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        When resuming a run, identities that were already migrated on the run
+        after the last checkpoint, and repeats of the same identity, should be
+        skipped without being migrated again, but still counted.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        uuids = sorted(str(uuid4()) for _ in range(3))
+        MigratedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuids[1])
+        count_identities.return_value = 4
+        fetch_identities.return_value = [
+            uuids[0], uuids[1], uuids[2], uuids[2]]
+
+        migrate_subscriptions.delay(migrate.pk)
 
-        [cancel_sub2] = list(get_calls_to_url(
-            '{url}/subscriptions/{subscription_id}/'.format(
-                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=2)))
-        self.assertEqual(cancel_sub2.request.method, responses.PATCH)
         self.assertEqual(
-            json.loads(cancel_sub2.request.body), {'active': False})
+            [c[0][1] for c in migrate_identity.call_args_list],
+            [uuids[0], uuids[2]])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 4)
+        self.assertTrue(LogEvent.objects.filter(
+            migrate_subscription=migrate,
+            message="Found 1 identities already migrated on this run"
+        ).exists())
 
-        [migrated_identity] = MigratedIdentity.objects.all()
-        self.assertEqual(migrated_identity.migrate_subscription, migrate)
-        self.assertEqual(str(migrated_identity.identity_uuid), uuid)
+    def test_load_excluded_identities(self):
+        """
+        Should return the UUIDs of the reverted identities, and of the
+        identities migrated on earlier runs, depending on the options of the
+        run.
+        """
+        earlier = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        uuid1, uuid2, uuid3 = uuid4(), uuid4(), uuid4()
+        RevertedIdentity.objects.create(
+            migrate_subscription=earlier, identity_uuid=uuid1)
+        MigratedIdentity.objects.create(
+            migrate_subscription=earlier, identity_uuid=uuid2)
+        MigratedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid3)
 
-    @responses.activate
-    @mock.patch('mapper.tasks.map_forward')
-    def test_migrate_identity_single_subscription(self, map_forward):
+        self.assertEqual(
+            migrate_subscriptions.load_excluded_identities(migrate), set())
+
+        migrate.exclude_reverted = True
+        self.assertEqual(
+            migrate_subscriptions.load_excluded_identities(migrate),
+            set([uuid1]))
+
+        migrate.exclude_migrated = True
+        self.assertEqual(
+            migrate_subscriptions.load_excluded_identities(migrate),
+            set([uuid1, uuid2]))
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_excludes_reverted_identities(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
         """
-        If the identity has a single subscription to the from messageset, then
-        that should be cancelled, and a new subscription should be created
-        for the to messageset. A MigratedIdentity object should also be created
+        If the run excludes reverted identities, they should be counted as
+        processed and excluded, without being migrated or logged.
         """
-        def new_map_forward(messageset, sequence):
-            return messageset, sequence
-        map_forward.side_effect = new_map_forward
-        uuid = str(uuid4())
+        earlier = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
         migrate = MigrateSubscription.objects.create(
             from_messageset=1,
-            table_name='table', column_name='column')
-        mock_get_subscriptions(
-            [{'id': 1, 'next_sequence_number': 5, 'lang': 'eng'}],
-            '?messageset=1&identity={}&active=True'.format(uuid))
+            table_name='table1', column_name='column1',
+            exclude_reverted=True,
+        )
+        uuids = sorted(str(uuid4()) for _ in range(3))
+        RevertedIdentity.objects.create(
+            migrate_subscription=earlier, identity_uuid=uuids[1])
+        count_identities.return_value = 3
+        fetch_identities.return_value = uuids
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(
+            [c[0][1] for c in migrate_identity.call_args_list],
+            [uuids[0], uuids[2]])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 3)
+        self.assertEqual(migrate.excluded, 1)
+        self.assertFalse(LogEvent.objects.filter(
+            message__contains=uuids[1]).exists())
+
+    @override_settings(
+        MIGRATION_CHECKPOINT_SIZE=1, MIGRATION_LOG_SUMMARY_INTERVAL=0)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_reports_pipeline(
+            self, count_identities, fetch_identities, migrate_identity,
+            load_messagesets):
+        """
+        While processing identities, the throughput of each stage and the
+        depth of the queues between them should be logged every
+        MIGRATION_LOG_SUMMARY_INTERVAL seconds.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        count_identities.return_value = 3
+        fetch_identities.return_value = ['identity1', 'identity2', 'identity3']
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        reports = LogEvent.objects.filter(
+            migrate_subscription=migrate,
+            message__startswith='Identities read')
+        self.assertEqual(reports.count(), 2)
+        self.assertIn('Queues read', reports.first().message)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.current, 3)
+
+    @override_settings(MIGRATION_LOOKAHEAD=2)
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch(
+        'mapper.tasks.MigrateSubscriptionsTask.fetch_existing_subscriptions')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.fetch_identities')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.count_identities')
+    def test_run_lookahead(
+            self, count_identities, fetch_identities, migrate_identity,
+            fetch_existing_subscriptions, load_messagesets):
+        """
+        With a lookahead, the subscriptions of the upcoming identities should
+        be looked up in the background, and used when the identities are
+        migrated. Excluded identities shouldn't be looked up.
+        """
+        earlier = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            exclude_reverted=True,
+        )
+        uuids = sorted(str(uuid4()) for _ in range(4))
+        RevertedIdentity.objects.create(
+            migrate_subscription=earlier, identity_uuid=uuids[2])
+        count_identities.return_value = 4
+        fetch_identities.return_value = uuids
+        fetch_existing_subscriptions.side_effect = (
+            lambda migrate, identity: [{'id': identity}])
+        subscriptions = []
+        lookaheads = []
+
+        def get_subscriptions(migrate, identity, state, progress):
+            lookaheads.append(state.lookahead)
+            subscriptions.append(
+                migrate_subscriptions.get_existing_subscriptions(
+                    migrate, identity, state))
+        migrate_identity.side_effect = get_subscriptions
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(subscriptions, [
+            [{'id': uuids[0]}], [{'id': uuids[1]}], [{'id': uuids[3]}]])
+        self.assertEqual(
+            sorted(c[0][1] for c in
+                   fetch_existing_subscriptions.call_args_list),
+            [uuids[0], uuids[1], uuids[3]])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        # The lookahead should be closed after the run
+        self.assertEqual(lookaheads[-1].results, {})
+
+    def create_file_migration(self, content, **kwargs):
+        """
+        Creates a migration run that reads its identities from a file with
+        the given content, in a temporary media directory.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1, **kwargs)
+        migrate.identity_file.save(
+            'identities.csv', ContentFile(content.encode('utf-8')))
+        return migrate
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_run_identity_file(self, migrate_identity, load_messagesets):
+        """
+        A run with an identity file should migrate the identities in the
+        file, skipping the header and repeated identities, and checkpoint the
+        byte offset after the last processed identity.
+        """
+        uuids = [str(uuid4()) for _ in range(3)]
+        migrate = self.create_file_migration(
+            'identity\n' + ''.join(u + '\n' for u in uuids + uuids[:1]))
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(
+            [c[0][1] for c in migrate_identity.call_args_list], uuids)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.total, 5)
+        self.assertTrue(migrate.total_is_estimate)
+        self.assertEqual(migrate.current, 3)
+        self.assertEqual(migrate.last_identity, uuids[2])
+        self.assertEqual(migrate.last_offset, 9 + 3 * 37)
+        messages = set(LogEvent.objects.filter(
+            migrate_subscription=migrate).values_list('message', flat=True))
+        self.assertIn(
+            "Skipped 1 lines of the identity file that aren't identity UUIDs",
+            messages)
+        self.assertIn(
+            "Skipped 1 repeated identities in the identity file", messages)
+
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.load_messagesets')
+    @mock.patch('mapper.tasks.MigrateSubscriptionsTask.migrate_identity')
+    def test_run_identity_file_resume(
+            self, migrate_identity, load_messagesets):
+        """
+        Resuming a run with an identity file should continue from the byte
+        offset after the last processed identity.
+        """
+        uuids = [str(uuid4()) for _ in range(3)]
+        migrate = self.create_file_migration(
+            ''.join(u + '\n' for u in uuids), current=1,
+            last_identity=uuids[0], last_offset=37)
+
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(
+            [c[0][1] for c in migrate_identity.call_args_list], uuids[1:])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 3)
+        self.assertEqual(migrate.last_offset, 3 * 37)
+
+    @responses.activate
+    def test_run_identity_file_prefetch_repeated(self):
+        """
+        An identity that is repeated in the identity file further apart than
+        the window of recently read identities shouldn't be migrated again
+        from its prefetched subscriptions.
+        """
+        uuids = [str(uuid4()) for _ in range(2)]
+        migrate = self.create_file_migration(
+            ''.join(u + '\n' for u in uuids + uuids[:1]),
+            prefetch_subscriptions=True)
+        mock_get_messagesets([
+            {'short_name': 'test.gates.messageset.1', 'default_schedule': 4,
+             'id': 1},
+            {'short_name': 'test.gates.messageset.2', 'default_schedule': 4,
+             'id': 2},
+        ])
+        mock_get_subscriptions([
+            {'id': 1, 'identity': uuids[0], 'next_sequence_number': 3,
+             'lang': 'eng', 'messageset': 1, 'active': True},
+        ], '?messageset=1&active=True')
         mock_update_subscription(1)
-        # To get the messageset name for the log entry + mapping
-        messagesets = [
-            {'short_name': 'from_messageset', 'default_schedule': 4, 'id': 1},
-            {'short_name': 'to_messageset', 'default_schedule': 4, 'id': 2},
-        ]
-        mock_get_messageset(1, messagesets[0])
-        mock_get_messageset(2, messagesets[1])
-        mock_get_messagesets(messagesets[1:2], '?short_name=from_messageset')
         mock_create_subscription()
 
-        migrate_subscriptions.migrate_identity(migrate, uuid)
-
-        self.assertEqual(LogEvent.objects.count(), 0)
+        with mock.patch(
+                'mapper.tasks.MigrateSubscriptionsTask.open_identity_file',
+                side_effect=lambda migrate: IdentityFile(
+                    migrate.identity_file.path, window=1)):
+            migrate_subscriptions.delay(migrate.pk)
 
-        [cancel_sub1] = list(get_calls_to_url(
-            '{url}/subscriptions/{subscription_id}/'.format(
-                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
-        self.assertEqual(cancel_sub1.request.method, responses.PATCH)
+        self.assertEqual(len(list(get_calls_to_url(
+            '{}/subscriptions/'.format(
+                settings.STAGE_BASED_MESSAGING_URL)))), 1)
         self.assertEqual(
-            json.loads(cancel_sub1.request.body), {'active': False})
+            [str(uuid) for uuid in MigratedIdentity.objects.values_list(
+                'identity_uuid', flat=True)], uuids[:1])
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 3)
 
-        [create_sub] = list(get_calls_to_url(
-            '{url}/subscriptions/'.format(
-                url=settings.STAGE_BASED_MESSAGING_URL, subscription_id=1)))
-        self.assertEqual(create_sub.request.method, responses.POST)
-        self.assertEqual(json.loads(create_sub.request.body), {
-            'identity': uuid,
-            'initial_sequence_number': 5,
-            'next_sequence_number': 5,
-            'lang': 'eng',
-            'messageset': 2,
-            'schedule': 4,
-        })
+    @responses.activate
+    def test_run_dry_run(self):
+        """
+        A dry run should plan the migration of every identity, using the
+        prefetched subscriptions, and save the plan and its summary, without
+        changing any subscriptions.
+        """
+        uuids = [str(uuid4()) for _ in range(4)]
+        migrate = self.create_file_migration(
+            ''.join(u + '\n' for u in uuids), dry_run=True,
+            exclude_reverted=True)
+        RevertedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuids[3])
+        mock_get_messagesets([
+            {'short_name': 'test.gates.messageset.1', 'default_schedule': 4,
+             'id': 1},
+            {'short_name': 'test.gates.messageset.2', 'default_schedule': 4,
+             'id': 2},
+        ])
+        mock_get_subscriptions([
+            {'id': 1, 'identity': uuids[0], 'next_sequence_number': 3,
+             'lang': 'eng', 'messageset': 1, 'active': True},
+            {'id': 2, 'identity': uuids[1], 'next_sequence_number': 1,
+             'lang': 'eng', 'messageset': 1, 'active': True},
+            {'id': 3, 'identity': uuids[1], 'next_sequence_number': 5,
+             'lang': 'afr', 'messageset': 1, 'active': True},
+            {'id': 4, 'identity': uuids[3], 'next_sequence_number': 2,
+             'lang': 'eng', 'messageset': 1, 'active': True},
+        ], '?messageset=1&active=True')
 
-        [migrated_identity] = MigratedIdentity.objects.all()
-        self.assertEqual(migrated_identity.migrate_subscription, migrate)
-        self.assertEqual(str(migrated_identity.identity_uuid), uuid)
+        migrate_subscriptions.delay(migrate.pk)
+
+        self.assertEqual(
+            set(r.request.method for r in responses.calls), {'GET'})
+        self.assertEqual(MigratedIdentity.objects.count(), 0)
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.COMPLETE)
+        self.assertEqual(migrate.current, 4)
+        self.assertEqual(migrate.excluded, 1)
+        summary = migrate.get_plan_summary()
+        summary.pop('projected_seconds')
+        self.assertEqual(summary, {
+            'identities': 4,
+            'excluded': 1,
+            'no_subscriptions': 1,
+            'multiple_subscriptions': 1,
+            'subscriptions': 3,
+            'unmapped': 0,
+            'to_messagesets': {'test.gates.messageset.2': 3},
+            'requests': 9,
+        })
+        with gzip.open(migrate.plan_file.path, 'rb') as f:
+            rows = f.read().decode('utf-8').splitlines()
+        self.assertEqual(rows, [
+            'identity,subscription,sequence,to_messageset,to_sequence',
+            '{},1,3,test.gates.messageset.2,5'.format(uuids[0]),
+            '{},2,1,test.gates.messageset.2,1'.format(uuids[1]),
+            '{},3,5,test.gates.messageset.2,9'.format(uuids[1]),
+        ])
+        messages = set(LogEvent.objects.filter(
+            migrate_subscription=migrate).values_list('message', flat=True))
+        self.assertIn(
+            "Planned 4 identities: 3 subscriptions to migrate, 1 identities "
+            "without subscriptions, 1 identities with multiple subscriptions, "
+            "1 identities excluded", messages)
+        self.assertIn(
+            "3 subscriptions would be migrated to test.gates.messageset.2",
+            messages)
@@ -5,18 +5,24 @@ from django.db import connections
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import naturaltime
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
+from uuid import uuid4
 import json
 import responses
 import logging
+import shutil
+import tempfile
 try:
     import mock
 except ImportError:
     import unittest.mock as mock
 
-from mapper.models import LogEvent, MigrateSubscription
+from mapper.models import (
+    FailedIdentity, LogEvent, MappingVersion, MigrateSubscription)
 from mapper.tasks import migrate_subscriptions
 from mapper.test_utils import mock_get_messagesets
 
@@ -188,6 +194,32 @@ class MigrationSubscriptionsListViewTests(TestCase):
         response = self.client.get(reverse('migration-list'))
         self.assertContains(response, expected, html=True)
 
+    @responses.activate
+    def test_retry_failed_button(self):
+        """
+        If a listed migration is complete, and has failed identities, then
+        there should be a button to retry the failed identities.
+        """
+        expected = (
+            '<button class="mdl-button mdl-js-button mdl-button--colored '
+            'mdl-button--raised mdl-js-ripple-effect" type="submit">'
+            'Retry failed</button>'
+        )
+        m = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='test-table', column_name='test-column',
+            status=MigrateSubscription.COMPLETE)
+        mock_get_messagesets([])
+        self.client.force_login(User.objects.create_user('testuser'))
+
+        response = self.client.get(reverse('migration-list'))
+        self.assertNotContains(response, expected, html=True)
+
+        FailedIdentity.objects.create(
+            migrate_subscription=m, identity_uuid=uuid4(), error='Error')
+        response = self.client.get(reverse('migration-list'))
+        self.assertContains(response, expected, html=True)
+
     @responses.activate
     def test_cancel_button(self):
         """
@@ -275,6 +307,31 @@ class CreateSubscriptionMigrationFormTests(TestCase):
             'class="mdl-textfield__input">{}</select>'.format(tables),
             html=True)
 
+    @responses.activate
+    def test_form_display_tables_excludes_snapshots(self):
+        """
+        The snapshot tables of migrations shouldn't be displayed in the form
+        table selection.
+        """
+        mock_get_messagesets([])
+        with connections['identities'].cursor() as cursor:
+            # We first need to remove all existing tables. Django performs
+            # migrations on all dbs in tests, and we want a clean DB
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+            # Create the tables that we want
+            cursor.execute("CREATE TABLE testtable1()")
+            cursor.execute("CREATE TABLE mapper_snapshot_1()")
+        self.client.force_login(User.objects.create_user('testuser'))
+
+        response = self.client.get(reverse('migration-list'))
+        self.assertContains(
+            response,
+            '<select name="table_name" id="id_table_name" '
+            'class="mdl-textfield__input"><option value="testtable1">'
+            'testtable1</option></select>',
+            html=True)
+
     @responses.activate
     def test_form_display_columns(self):
         """
@@ -400,6 +457,144 @@ class CreateSubscriptionMigrationFormTests(TestCase):
 
         migrate_subscriptions.assert_called_once_with(migration.pk)
 
+    @responses.activate
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    @mock.patch.object(migrate_subscriptions, 'delay')
+    def test_form_pins_mapping_version(self, migrate_subscriptions):
+        """
+        New migrations should be pinned to the latest version of the mapping
+        rules.
+        """
+        mock_get_messagesets([{'id': 1, 'short_name': 'test.messageset.1'}])
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+            cursor.execute("CREATE TABLE testtable1(column1 TEXT)")
+        MappingVersion.create_from_rules()
+        version = MappingVersion.create_from_rules()
+        self.client.force_login(User.objects.create_user('testuser'))
+
+        self.client.post(reverse('migration-list'), data={
+            'table_name': 'testtable1',
+            'column_name': 'column1',
+            'from_messageset': 1,
+        })
+
+        [migration] = MigrateSubscription.objects.all()
+        self.assertEqual(migration.mapping_version, version)
+
+    @responses.activate
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    @mock.patch.object(migrate_subscriptions, 'delay')
+    def test_form_identity_file_submission(self, migrate_subscriptions):
+        """
+        Uploading a file of identities should create a migration that reads
+        from the file instead of a table.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        mock_get_messagesets([{'id': 1, 'short_name': 'test.messageset.1'}])
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+            cursor.execute("CREATE TABLE testtable1(column1 TEXT)")
+        self.client.force_login(User.objects.create_user('testuser'))
+
+        with self.settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('migration-list'), data={
+                'table_name': 'testtable1',
+                'column_name': 'column1',
+                'from_messageset': 1,
+                'identity_file': SimpleUploadedFile(
+                    'identities.csv', str(uuid4()).encode('utf-8')),
+            })
+        self.assertRedirects(response, reverse('migration-list'))
+
+        [migration] = MigrateSubscription.objects.all()
+        self.assertEqual(migration.identity_file.name,
+                         'identity_files/identities.csv')
+        self.assertEqual(migration.table_name, '')
+        self.assertEqual(migration.column_name, '')
+        migrate_subscriptions.assert_called_once_with(migration.pk)
+
+    @responses.activate
+    def test_form_identity_file_validation(self):
+        """
+        Runs from a file of identities cannot be sharded, and runs need either
+        a file or a table and column.
+        """
+        mock_get_messagesets([{'id': 1, 'short_name': 'test.messageset.1'}])
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+        self.client.force_login(User.objects.create_user('testuser'))
+
+        response = self.client.post(reverse('migration-list'), data={
+            'from_messageset': 1,
+            'num_shards': 2,
+            'identity_file': SimpleUploadedFile(
+                'identities.csv', str(uuid4()).encode('utf-8')),
+        })
+        self.assertContains(
+            response,
+            '<span class="mdl-textfield__error">Runs from a file of '
+            'identities cannot be sharded</span>', html=True)
+
+        response = self.client.post(reverse('migration-list'), data={
+            'from_messageset': 1,
+        })
+        self.assertContains(
+            response,
+            '<p class="mdl-color-text--accent">Choose a table and column, or '
+            'a file of identities</p>', html=True)
+        self.assertFalse(MigrateSubscription.objects.exists())
+
+    @responses.activate
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
+    @mock.patch.object(migrate_subscriptions, 'delay')
+    def test_form_filter(self, migrate_subscriptions):
+        """
+        The filter column should be a column in the selected table, and needs
+        an operator.
+        """
+        mock_get_messagesets([{'id': 1, 'short_name': 'test.messageset.1'}])
+        with connections['identities'].cursor() as cursor:
+            cursor.execute("DROP SCHEMA public CASCADE")
+            cursor.execute("CREATE SCHEMA public")
+            cursor.execute(
+                "CREATE TABLE testtable1(column1 TEXT, cohort TEXT)")
+            cursor.execute("CREATE TABLE testtable2(column2 TEXT)")
+        self.client.force_login(User.objects.create_user('testuser'))
+        data = {
+            'table_name': 'testtable1',
+            'column_name': 'column1',
+            'from_messageset': 1,
+        }
+
+        response = self.client.post(reverse('migration-list'), data=dict(
+            data, filter_column='column2', filter_operator='='))
+        self.assertContains(
+            response,
+            '<span class="mdl-textfield__error">Column column2 is not a '
+            'column in testtable1</span>', html=True)
+
+        response = self.client.post(reverse('migration-list'), data=dict(
+            data, filter_column='cohort'))
+        self.assertContains(
+            response,
+            '<span class="mdl-textfield__error">Choose an operator for the '
+            'filter</span>', html=True)
+
+        response = self.client.post(reverse('migration-list'), data=dict(
+            data, filter_column='cohort', filter_operator='=',
+            filter_value='a'))
+        self.assertRedirects(response, reverse('migration-list'))
+        [migration] = MigrateSubscription.objects.all()
+        self.assertEqual(migration.filter_column, 'cohort')
+        self.assertEqual(migration.filter_operator, '=')
+        self.assertEqual(migration.filter_value, 'a')
+        self.assertEqual(migration.get_filter_display(), 'cohort equals a')
+
 
 class TestLogListView(TestCase):
     def test_login_required(self):
@@ -584,6 +779,91 @@ class TestRetrySubscriptionMigrate(TestCase):
         migrate_subscriptions.assert_called_once_with(migrate.pk)
 
 
+class TestRetryFailedIdentities(TestCase):
+    def test_login_required(self):
+        """
+        You must be logged in to be able to use this endpoint.
+        """
+        url = reverse('migration-retry-failed', kwargs={'migration_id': 1})
+        response = self.client.post(url)
+        self.assertRedirects(
+            response,
+            '{}?next={}'.format(reverse('login'), url)
+        )
+
+    def test_no_failed_identities(self):
+        """
+        If a migration doesn't have any failed identities, a bad request error
+        should be returned.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            status=MigrateSubscription.COMPLETE,
+        )
+        self.client.force_login(User.objects.create_user('testuser'))
+        response = self.client.post(reverse(
+            'migration-retry-failed', kwargs={'migration_id': migrate.pk}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_complete_migration(self):
+        """
+        If a migration is not complete, then we cannot retry its failed
+        identities, so a bad request error should be returned.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            status=MigrateSubscription.ERROR,
+        )
+        FailedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid4(),
+            error='Error')
+        self.client.force_login(User.objects.create_user('testuser'))
+        response = self.client.post(reverse(
+            'migration-retry-failed', kwargs={'migration_id': migrate.pk}))
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('mapper.tasks.retry_failed_identities.delay')
+    @responses.activate
+    def test_successful_retry(self, retry_failed_identities):
+        """
+        On a valid request, the migration status should be set to starting,
+        the action should be logged on the history, a new log object should
+        be created, and the celery task should be started.
+        """
+        mock_get_messagesets([])
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+            status=MigrateSubscription.COMPLETE, completed_at=timezone.now(),
+        )
+        FailedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuid4(),
+            error='Error')
+        user = User.objects.create_user('testuser')
+        self.client.force_login(user)
+        response = self.client.post(reverse(
+            'migration-retry-failed', kwargs={'migration_id': migrate.pk}))
+        self.assertRedirects(response, reverse('migration-list'))
+
+        migrate.refresh_from_db()
+        self.assertEqual(migrate.status, MigrateSubscription.STARTING)
+        self.assertIsNone(migrate.completed_at)
+
+        history = LogEntry.objects.last()
+        self.assertEqual(history.user, user)
+        self.assertEqual(history.action_flag, CHANGE)
+        self.assertEqual(
+            history.change_message, "Retried failed identities")
+
+        log = LogEvent.objects.last()
+        self.assertEqual(log.migrate_subscription, migrate)
+        self.assertEqual(log.message, "Retrying failed identities")
+
+        retry_failed_identities.assert_called_once_with(migrate.pk)
+
+
 class TestCancelSubscriptionMigrate(TestCase):
     def test_login_required(self):
         """
@@ -656,3 +936,49 @@ class TestCancelSubscriptionMigrate(TestCase):
         self.assertEqual(log.migrate_subscription, migrate)
         self.assertEqual(log.log_level, logging.INFO)
         self.assertEqual(log.message, "Cancelling task")
+
+
+class TestPlanDownloadView(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_login_required(self):
+        """
+        You need to be logged in to be able to download the plan.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', dry_run=True,
+        )
+        url = reverse('migration-plan', kwargs={'migration_id': migrate.pk})
+        response = self.client.get(url)
+        self.assertRedirects(
+            response,
+            '{}?next={}'.format(reverse('login'), url)
+        )
+
+    def test_download(self):
+        """
+        The plan file of the dry run should be downloaded, and runs without a
+        plan should give a 404.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1', dry_run=True,
+        )
+        url = reverse('migration-plan', kwargs={'migration_id': migrate.pk})
+        self.client.force_login(User.objects.create_user('testuser'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        migrate.plan_file.save('plan.csv.gz', ContentFile(b'plan'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'plan')
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="plan_{}.csv.gz"'.format(migrate.pk))
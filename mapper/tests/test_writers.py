@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.test import TestCase
+from uuid import uuid4
+import logging
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from mapper.models import MigratedIdentity, MigrateSubscription
+from mapper.writers import BufferedWriter, LogAggregator
+
+
+class BufferedWriterTests(TestCase):
+    def test_add(self):
+        """
+        Adding an instance should buffer it, without saving it.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        writer = BufferedWriter(MigratedIdentity)
+
+        writer.add(MigratedIdentity(
+            migrate_subscription=migrate, identity_uuid=uuid4()))
+
+        self.assertEqual(len(writer), 1)
+        self.assertEqual(MigratedIdentity.objects.count(), 0)
+
+    def test_flush(self):
+        """
+        Flushing should save all the buffered instances in a single query, and
+        empty the buffer.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        writer = BufferedWriter(MigratedIdentity)
+        uuids = sorted(uuid4() for _ in range(3))
+        for uuid in uuids:
+            writer.add(MigratedIdentity(
+                migrate_subscription=migrate, identity_uuid=uuid))
+
+        # The insert is in a savepoint
+        with self.assertNumQueries(3):
+            self.assertEqual(writer.flush(), 3)
+
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(
+            sorted(MigratedIdentity.objects.values_list(
+                'identity_uuid', flat=True)),
+            uuids)
+
+    def test_flush_duplicates(self):
+        """
+        Only one of the buffered instances with the same unique values should
+        be saved.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        writer = BufferedWriter(MigratedIdentity)
+        uuids = sorted(uuid4() for _ in range(2))
+        for uuid in uuids + uuids[:1]:
+            writer.add(MigratedIdentity(
+                migrate_subscription=migrate, identity_uuid=uuid))
+
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(
+            sorted(MigratedIdentity.objects.values_list(
+                'identity_uuid', flat=True)),
+            uuids)
+
+    def test_flush_already_saved(self):
+        """
+        If some of the buffered instances were already saved, the rest of
+        them should still be saved.
+        """
+        migrate = MigrateSubscription.objects.create(
+            from_messageset=1,
+            table_name='table1', column_name='column1',
+        )
+        writer = BufferedWriter(MigratedIdentity)
+        uuids = sorted(uuid4() for _ in range(3))
+        MigratedIdentity.objects.create(
+            migrate_subscription=migrate, identity_uuid=uuids[1])
+        for uuid in uuids:
+            writer.add(MigratedIdentity(
+                migrate_subscription=migrate, identity_uuid=uuid))
+
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(
+            sorted(MigratedIdentity.objects.values_list(
+                'identity_uuid', flat=True)),
+            uuids)
+
+    def test_flush_empty(self):
+        """
+        Flushing an empty buffer shouldn't make any queries.
+        """
+        writer = BufferedWriter(MigratedIdentity)
+        with self.assertNumQueries(0):
+            self.assertEqual(writer.flush(), 0)
+
+
+class LogAggregatorTests(TestCase):
+    def test_single_message(self):
+        """
+        A message for a single identity should use the singular message.
+        """
+        aggregator = LogAggregator()
+        aggregator.add(
+            logging.ERROR, 'identity1', 'Identity {identity} in {ms}',
+            '{count} identities in {ms}', ms='messageset')
+
+        self.assertEqual(
+            aggregator.pop(),
+            [(logging.ERROR, 'Identity identity1 in messageset')])
+        self.assertEqual(len(aggregator), 0)
+
+    def test_repeated_messages(self):
+        """
+        Repeats of the same message should be combined into a single message
+        with a count and a sample of the identities, while different messages
+        should be kept separate.
+        """
+        aggregator = LogAggregator()
+        for i in range(3):
+            aggregator.add(
+                logging.ERROR, 'identity{}'.format(i),
+                'Identity {identity} in {ms}', '{count} identities in {ms}',
+                ms='messageset')
+        aggregator.add(
+            logging.WARNING, 'identity3', 'Identity {identity} has {num}',
+            '{count} identities have {num}', num=2)
+
+        self.assertEqual(aggregator.pop(), [
+            (logging.ERROR,
+             '3 identities in messageset Identities: identity0, identity1, '
+             'identity2'),
+            (logging.WARNING, 'Identity identity3 has 2'),
+        ])
+
+    @mock.patch.object(LogAggregator, 'MAX_SAMPLES', 2)
+    def test_sample_limit(self):
+        """
+        Only a limited sample of the identities should be kept for each
+        message.
+        """
+        aggregator = LogAggregator()
+        for i in range(5):
+            aggregator.add(
+                logging.ERROR, 'identity{}'.format(i), 'Identity {identity}',
+                '{count} identities')
+
+        self.assertEqual(aggregator.pop(), [
+            (logging.ERROR,
+             '5 identities Identities: identity0, identity1, ...'),
+        ])
+
+    def test_is_due(self):
+        """
+        The messages are due once they have been collecting for the interval.
+        """
+        aggregator = LogAggregator()
+        self.assertTrue(aggregator.is_due(0))
+        self.assertFalse(aggregator.is_due(60))
@@ -5,8 +5,8 @@ from django.conf.urls import include, url
 from rest_framework.routers import DefaultRouter
 
 from mapper.views import (
-    LogListView, MigrateSubscriptionListView, RetrySubscriptionView,
-    CancelSubscriptionView)
+    LogListView, MigrateSubscriptionListView, PlanDownloadView,
+    RetrySubscriptionView, RetryFailedIdentitiesView, CancelSubscriptionView)
 from mapper.api_views import RapidproOptout
 
 api_router = DefaultRouter()
@@ -22,8 +22,14 @@ urlpatterns = [
     url(
         r'^migrations/(?P<migration_id>\d+)/retry/$',
         RetrySubscriptionView.as_view(), name='migration-retry'),
+    url(
+        r'^migrations/(?P<migration_id>\d+)/retry_failed/$',
+        RetryFailedIdentitiesView.as_view(), name='migration-retry-failed'),
     url(
         r'^migrations/(?P<migration_id>\d+)/cancel/$',
         CancelSubscriptionView.as_view(), name='migration-cancel'),
+    url(
+        r'^migrations/(?P<migration_id>\d+)/plan/$',
+        PlanDownloadView.as_view(), name='migration-plan'),
     url(r'^api/v1/', include(api_router.urls, namespace='api')),
 ]
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.contenttypes.models import ContentType
-from django.http import HttpResponseBadRequest
+from django.http import FileResponse, Http404, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.encoding import force_text
 from django.urls import reverse_lazy
@@ -19,8 +19,8 @@ from seed_services_client.stage_based_messaging import (
 import logging
 
 from .forms import MigrateSubscriptionForm
-from .models import LogEvent, MigrateSubscription
-from .tasks import migrate_subscriptions
+from .models import LogEvent, MappingVersion, MigrateSubscription
+from .tasks import migrate_subscriptions, retry_failed_identities
 
 
 class MigrateSubscriptionListView(
@@ -49,11 +49,14 @@ class MigrateSubscriptionListView(
     def get_tables(self):
         """
         Returns a sorted list with the names of all the tables in the
-        identities database. The value is cached on the class instance.
+        identities database, excluding the snapshots of migration runs. The
+        value is cached on the class instance.
         """
         if getattr(self, 'table_names', None) is None:
-            self.table_names = (
-                connections['identities'].introspection.table_names())
+            self.table_names = [
+                table for table in
+                connections['identities'].introspection.table_names()
+                if not table.startswith(MigrateSubscription.SNAPSHOT_PREFIX)]
         return self.table_names
 
     def get_table_columns(self, table):
@@ -125,8 +128,10 @@ class MigrateSubscriptionListView(
     def form_valid(self, form):
         """
         Here we add the history of the user that created the object, and start
-        the task to migrate the subscriptions.
+        the task to migrate the subscriptions. The run is pinned to the
+        current version of the mapping rules.
         """
+        form.instance.mapping_version_id = MappingVersion.get_latest_id()
         redirect = super(MigrateSubscriptionListView, self).form_valid(form)
         LogEntry.objects.log_action(
             user_id=self.request.user.pk,
@@ -190,6 +195,50 @@ class RetrySubscriptionView(LoginRequiredMixin, View):
         return redirect('migration-list')
 
 
+class RetryFailedIdentitiesView(LoginRequiredMixin, View):
+    """
+    If a task has completed with identities that failed to migrate, we want to
+    be able to retry just those identities.
+    """
+    def post(self, request, *args, **kwargs):
+        migrate = get_object_or_404(
+            MigrateSubscription, pk=self.kwargs['migration_id'])
+        if not migrate.failed_identities.exists():
+            return HttpResponseBadRequest(
+                "Subscription Migration has no failed identities to retry.")
+
+        # Atomic update if complete
+        count = MigrateSubscription.objects.filter(
+            pk=self.kwargs['migration_id'],
+            status=MigrateSubscription.COMPLETE).update(
+                status=MigrateSubscription.STARTING, completed_at=None)
+        if count != 1:
+            return HttpResponseBadRequest(
+                "Subscription Migration must be in complete state to retry "
+                "its failed identities.")
+
+        # Add to history who retried the failed identities
+        LogEntry.objects.log_action(
+            user_id=request.user.pk,
+            content_type_id=ContentType.objects.get_for_model(
+                MigrateSubscription).pk,
+            object_id=migrate.pk,
+            object_repr=force_text(migrate),
+            action_flag=CHANGE,
+            change_message="Retried failed identities",
+        )
+
+        # Add to the log that the failed identities were retried
+        LogEvent.objects.create(
+            migrate_subscription=migrate,
+            log_level=logging.INFO,
+            message="Retrying failed identities",
+        )
+
+        retry_failed_identities.delay(migrate.pk)
+        return redirect('migration-list')
+
+
 class CancelSubscriptionView(LoginRequiredMixin, View):
     """
     If a task is starting or running, we want to be able to cancel it.
@@ -230,6 +279,24 @@ class CancelSubscriptionView(LoginRequiredMixin, View):
         return redirect('migration-list')
 
 
+class PlanDownloadView(LoginRequiredMixin, View):
+    """
+    Downloads the plan of a dry run, which lists identities, so it is only
+    available to users that are logged in.
+    """
+    def get(self, request, *args, **kwargs):
+        migrate = get_object_or_404(
+            MigrateSubscription, pk=self.kwargs['migration_id'])
+        if not migrate.plan_file:
+            raise Http404("Subscription Migration has no plan.")
+        response = FileResponse(
+            migrate.plan_file.storage.open(migrate.plan_file.name, 'rb'),
+            content_type='application/gzip')
+        response['Content-Disposition'] = \
+            'attachment; filename="plan_{id}.csv.gz"'.format(id=migrate.pk)
+        return response
+
+
 class LogListView(LoginRequiredMixin, ListView):
     model = LogEvent
     paginate_by = 10
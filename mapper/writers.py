@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+from django.db import IntegrityError, transaction
+from threading import Lock
+import time
+
+
+class BufferedWriter(object):
+    """
+    Collects unsaved model instances, and saves them all in a single bulk
+    insert when flushed, instead of one insert per instance. Instances can be
+    added from multiple threads.
+
+    If the model is unique together on some fields, only the first of the
+    buffered instances for each of their values is saved, and instances that
+    were already saved, eg. by an earlier attempt at the same run, are
+    skipped.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.buffer = []
+        self.lock = Lock()
+        if model._meta.unique_together:
+            self.unique_fields = [
+                model._meta.get_field(name).attname
+                for name in model._meta.unique_together[0]]
+        else:
+            self.unique_fields = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def add(self, instance):
+        with self.lock:
+            self.buffer.append(instance)
+
+    def get_key(self, instance):
+        return tuple(getattr(instance, f) for f in self.unique_fields)
+
+    def flush(self):
+        """
+        Saves all of the buffered instances, and returns the number of
+        instances saved.
+        """
+        with self.lock:
+            instances, self.buffer = self.buffer, []
+        if not instances:
+            return 0
+        if self.unique_fields is None:
+            self.model.objects.bulk_create(instances)
+            return len(instances)
+
+        unique = OrderedDict()
+        for instance in instances:
+            unique.setdefault(self.get_key(instance), instance)
+        instances = list(unique.values())
+        try:
+            # The savepoint keeps a duplicate from breaking the transaction
+            # that we're in
+            with transaction.atomic():
+                self.model.objects.bulk_create(instances)
+        except IntegrityError:
+            # Some of the instances were already saved, so each instance is
+            # saved on its own, unless it already exists
+            for instance in instances:
+                self.save_unique(instance)
+        return len(instances)
+
+    def save_unique(self, instance):
+        key = dict(zip(self.unique_fields, self.get_key(instance)))
+        defaults = {
+            f.attname: getattr(instance, f.attname)
+            for f in self.model._meta.concrete_fields
+            if not f.primary_key and f.attname not in key}
+        self.model.objects.get_or_create(defaults=defaults, **key)
+
+
+class LogAggregator(object):
+    """
+    Collects log messages about individual identities, and combines repeats of
+    the same message into a single message with a count and a sample of the
+    identities, so that we don't need a log event for each identity.
+    """
+    MAX_SAMPLES = 10
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def reset(self):
+        # Maps (level, message, plural_message, kwargs) to [count, samples]
+        self.messages = OrderedDict()
+        self.started_at = time.time()
+
+    def add(self, level, identity, message, plural_message, **kwargs):
+        """
+        Adds a message about the identity. `message` is the message for a
+        single identity, and gets formatted with `identity` and the kwargs.
+        `plural_message` is the message for multiple identities, and gets
+        formatted with `count` and the kwargs.
+        """
+        key = (level, message, plural_message, tuple(sorted(kwargs.items())))
+        with self.lock:
+            count_samples = self.messages.setdefault(key, [0, []])
+            count_samples[0] += 1
+            if len(count_samples[1]) < self.MAX_SAMPLES:
+                count_samples[1].append(str(identity))
+
+    def is_due(self, interval):
+        """
+        Whether the messages have been collecting for at least `interval`
+        seconds.
+        """
+        return time.time() - self.started_at >= interval
+
+    def pop(self):
+        """
+        Returns a list of (level, message) for all of the collected messages,
+        and clears them.
+        """
+        with self.lock:
+            messages = self.messages
+            self.reset()
+        result = []
+        for key, (count, samples) in messages.items():
+            level, message, plural_message, kwargs = key
+            kwargs = dict(kwargs)
+            if count == 1:
+                result.append(
+                    (level, message.format(identity=samples[0], **kwargs)))
+                continue
+            if count > len(samples):
+                samples = samples + ['...']
+            result.append((level, "{message} Identities: {samples}".format(
+                message=plural_message.format(count=count, **kwargs),
+                samples=', '.join(samples))))
+        return result